@@ -128,6 +128,30 @@ AUTH_USER_MODEL = 'core.User'
 MEDIA_URL = '/media/'
 MEDIA_ROOT = BASE_DIR / 'media'
 
+# Caches
+# The OCR cache lives in Redis so every Celery worker shares it. Entries always carry a TTL, so
+# running Redis with `--maxmemory <size> --maxmemory-policy volatile-lru` bounds it by LRU
+# eviction without ever evicting the Celery broker's queues.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'ocr': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': 'redis://localhost:6379/1',
+        'KEY_PREFIX': 'ocr',
+        'TIMEOUT': 60 * 60 * 24 * 30,
+    },
+    # Gemini responses for repeated prompts (re-uploads, regrades). Any Django cache backend works here,
+    # e.g. FileBasedCache with a LOCATION directory and OPTIONS {'MAX_ENTRIES': ...} for a local disk cache.
+    'llm': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': 'redis://localhost:6379/1',
+        'KEY_PREFIX': 'llm',
+        'TIMEOUT': 60 * 60 * 24 * 7,
+    },
+}
+
 # REST Framework
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': [
@@ -137,6 +161,8 @@ REST_FRAMEWORK = {
         'rest_framework.permissions.IsAuthenticated',
     ],
 }
+# Rows per page of the list endpoints (cursor paginated, see core.pagination); clients may ask for up to 200
+API_PAGE_SIZE = int(os.getenv('API_PAGE_SIZE', 50))
 
 # Simple JWT Configuration
 SIMPLE_JWT = {
@@ -155,3 +181,91 @@ CELERY_ACCEPT_CONTENT = ['json']
 CELERY_TASK_SERIALIZER = 'json'
 CELERY_RESULT_SERIALIZER = 'json'
 CELERY_TIMEZONE = 'UTC'
+# Grading is split into stages on separate queues so each worker pool can be sized for its bottleneck:
+# 'extraction' (PDF/OCR, CPU-bound, prefork) and 'llm' (Gemini calls, network-bound, threads).
+# Everything else, including persisting grades, runs on the default 'celery' queue.
+CELERY_TASK_ROUTES = {
+    'core.tasks.extract_submission': {'queue': 'extraction'},
+    'core.tasks.extract_answer_key': {'queue': 'extraction'},
+    'core.tasks.grade_extracted_submission': {'queue': 'llm'},
+}
+# Grading tasks are long, so don't let one worker reserve tasks another idle worker could run
+CELERY_WORKER_PREFETCH_MULTIPLIER = 1
+# Acknowledge after running so a crashed worker's task is redelivered; grading stages are idempotent
+CELERY_TASK_ACKS_LATE = True
+CELERY_TASK_REJECT_ON_WORKER_LOST = True
+
+# Gemini
+GOOGLE_API_KEY = os.getenv('GOOGLE_API_KEY')
+# Each worker process keeps one client; requests time out after GEMINI_TIMEOUT_SECONDS and the idle
+# connection is pinged every GEMINI_KEEPALIVE_SECONDS so it stays open between grades
+GEMINI_TIMEOUT_SECONDS = int(os.getenv('GEMINI_TIMEOUT_SECONDS', 120))
+GEMINI_KEEPALIVE_SECONDS = int(os.getenv('GEMINI_KEEPALIVE_SECONDS', 300))
+
+# Gemini quota shared by every worker (0 disables a limit). Buckets hold LLM_RATE_LIMIT_BURST_SECONDS
+# of budget; a queued task waits up to LLM_RATE_LIMIT_MAX_WAIT seconds for it, then re-queues itself
+GEMINI_REQUESTS_PER_MINUTE = int(os.getenv('GEMINI_REQUESTS_PER_MINUTE', 15))
+GEMINI_TOKENS_PER_MINUTE = int(os.getenv('GEMINI_TOKENS_PER_MINUTE', 1_000_000))
+GEMINI_RESPONSE_TOKEN_ESTIMATE = 1000
+LLM_RATE_LIMIT_BACKEND = os.getenv('LLM_RATE_LIMIT_BACKEND', 'redis')  # 'redis' or 'memory' (per process)
+LLM_RATE_LIMIT_REDIS_URL = CELERY_BROKER_URL
+LLM_RATE_LIMIT_BURST_SECONDS = 10
+LLM_RATE_LIMIT_MAX_WAIT = 5
+
+# Answer keys of at least GEMINI_CONTEXT_CACHE_MIN_TOKENS (Gemini's minimum) are uploaded once per assignment as a
+# cached context on this pinned model version ('' disables it), kept alive GEMINI_CONTEXT_CACHE_TTL seconds past last use
+GEMINI_CONTEXT_CACHE_MODEL = os.getenv('GEMINI_CONTEXT_CACHE_MODEL', 'models/gemini-1.5-flash-002')
+GEMINI_CONTEXT_CACHE_MIN_TOKENS = 32768
+GEMINI_CONTEXT_CACHE_TTL = 60 * 60
+
+# Answer keys numbered into questions are graded question by question, this many Gemini calls at a time,
+# when at least GRADING_MIN_ALIGNED of the questions are found in the submission's own numbering
+GRADING_MAX_WORKERS = int(os.getenv('GRADING_MAX_WORKERS', 4))
+GRADING_MIN_ALIGNED = 0.5
+# Answers up to this long (normalized) are memoized per question and reused for identical answers
+ANSWER_MEMO_MAX_CHARS = 200
+
+# Plagiarism: submissions by other students whose estimated Jaccard similarity (MinHash over word shingles)
+# reaches PLAGIARISM_MIN_SIMILARITY are listed in plagiarism_report, the closest PLAGIARISM_MAX_MATCHES of them
+PLAGIARISM_MIN_SIMILARITY = 0.5
+PLAGIARISM_MAX_MATCHES = 10
+# Paraphrase detection: whole texts and aligned answers of at least PLAGIARISM_SEMANTIC_MIN_WORDS words are
+# embedded, and pairs from other students at PLAGIARISM_SEMANTIC_THRESHOLD cosine similarity are reported.
+# EMBEDDING_BACKEND 'auto' runs EMBEDDING_MODEL locally through sentence-transformers when installed, else a
+# hashing vectorizer; 'gemini' uses Gemini's embedding API
+EMBEDDING_BACKEND = os.getenv('EMBEDDING_BACKEND', 'auto')
+EMBEDDING_MODEL = os.getenv('EMBEDDING_MODEL', '')
+PLAGIARISM_SEMANTIC_THRESHOLD = float(os.getenv('PLAGIARISM_SEMANTIC_THRESHOLD', 0.9))
+PLAGIARISM_SEMANTIC_MIN_WORDS = 8
+
+# Submission status changes are pushed to browsers at /api/events/ (server-sent events, needs an ASGI server).
+# EVENTS_BACKEND 'redis' fans them out from the workers to every web process; 'memory' only within one process
+EVENTS_BACKEND = os.getenv('EVENTS_BACKEND', 'redis')
+EVENTS_REDIS_URL = CELERY_BROKER_URL
+EVENTS_KEEPALIVE_SECONDS = 15
+EVENTS_RETRY_MILLISECONDS = 3000
+
+# Cache of Gemini responses by model, prompt and generation config (LLM_CACHE_ALIAS = None disables it)
+LLM_CACHE_ALIAS = 'llm'
+
+# Grading retries on transient Gemini errors, with exponential backoff (seconds) and jitter
+GRADING_MAX_RETRIES = 5
+GRADING_RETRY_BACKOFF = 10
+GRADING_RETRY_BACKOFF_MAX = 600
+
+
+# PDF / OCR Configuration
+# 'auto' uses an in-process tesserocr engine when installed, otherwise the pytesseract binary wrapper
+OCR_BACKEND = os.getenv('OCR_BACKEND', 'auto')
+OCR_LANGUAGE = os.getenv('OCR_LANGUAGE', 'eng')
+# Scanned pages render as 8-bit grayscale at this DPI, scaled down so one page never exceeds OCR_MAX_PAGE_PIXELS
+OCR_TARGET_DPI = int(os.getenv('OCR_TARGET_DPI', 200))
+OCR_MAX_PAGE_PIXELS = int(os.getenv('OCR_MAX_PAGE_PIXELS', 8_000_000))
+# Submission extraction stops after this many pages / characters of text (0 disables the limit);
+# answer keys and question papers are always extracted whole
+EXTRACTION_MAX_PAGES = int(os.getenv('EXTRACTION_MAX_PAGES', 60)) or None
+EXTRACTION_MAX_CHARS = int(os.getenv('EXTRACTION_MAX_CHARS', 200_000)) or None
+# Page OCR results are cached by rendered-page fingerprint in this cache, shared by all workers
+OCR_CACHE_ALIAS = 'ocr'
+# Threads per worker process used to OCR scanned pages concurrently (1 disables the pool)
+OCR_MAX_WORKERS = int(os.getenv('OCR_MAX_WORKERS', min(4, os.cpu_count() or 1)))
@@ -18,7 +18,7 @@ from django.urls import path, include
 from django.conf import settings
 from django.conf.urls.static import static
 from rest_framework.routers import DefaultRouter
-from core.views import AssignmentViewSet, SubmissionViewSet, ClassroomViewSet, register_view, LoginView, assignment_report, join_classroom, current_user_view
+from core.views import AssignmentViewSet, SubmissionViewSet, ClassroomViewSet, register_view, LoginView, assignment_report, assignment_stats, join_classroom, current_user_view, submission_events
 
 # Create a router and register our viewsets with it
 router = DefaultRouter()
@@ -34,6 +34,8 @@ urlpatterns = [
     path('api/user', current_user_view, name='current_user'),
     path('api/join-classroom', join_classroom, name='join_classroom'),
     path('api/assignments/<int:assignment_id>/report/', assignment_report, name='assignment_report'),
+    path('api/assignments/<int:assignment_id>/stats/', assignment_stats, name='assignment_stats'),
+    path('api/events/', submission_events, name='submission_events'),
     path('api-auth/', include('rest_framework.urls')),
 ]
 
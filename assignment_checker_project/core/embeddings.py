@@ -0,0 +1,116 @@
+import re
+import zlib
+from functools import lru_cache
+import numpy as np
+import google.generativeai as genai
+from celery.utils.log import get_task_logger
+from django.conf import settings
+from .llm import get_generative_client
+from .ratelimit import get_rate_limiter
+
+try:
+    from sentence_transformers import SentenceTransformer
+except ImportError:  # Optional dependency, the hashing backend is used instead
+    SentenceTransformer = None
+
+logger = get_task_logger(__name__)
+
+
+class EmbeddingBackend:
+    """Base class for the text embedding models used to spot paraphrased submissions"""
+    name = None
+    model = None
+
+    @property
+    def model_id(self):
+        """Identifies the vector space, vectors of different models are never compared"""
+        return f'{self.name}/{self.model}'
+
+    def embed(self, texts):
+        """Return a float32 array with one unit-length row per text"""
+        return normalize_rows(np.asarray(self.encode(texts), dtype=np.float32))
+
+    def encode(self, texts):
+        """Return one vector per text, of any scale"""
+        raise NotImplementedError
+
+
+class HashingBackend(EmbeddingBackend):
+    """Hashes words and word pairs into a fixed-size vector, with no model to download
+
+    Catches reordered and lightly reworded copies, but not paraphrases that
+    change the vocabulary; install sentence-transformers for those.
+    """
+    name = 'hashing'
+
+    def __init__(self, dimensions=512):
+        self.dimensions = dimensions
+        self.model = str(dimensions)
+
+    def encode(self, texts):
+        vectors = np.zeros((len(texts), self.dimensions), dtype=np.float32)
+        for row, text in enumerate(texts):
+            words = re.findall(r'\w+', text.lower())
+            features = words + [f'{a} {b}' for a, b in zip(words, words[1:])]
+            hashes = np.fromiter((zlib.crc32(f.encode()) for f in features), dtype=np.uint32, count=len(features))
+            # The top bit picks the sign, so unrelated features colliding in a slot tend to cancel out
+            signs = np.where(hashes >> 31, -1.0, 1.0).astype(np.float32)
+            np.add.at(vectors[row], hashes % self.dimensions, signs)
+        # Dampen repeated words, like sublinear term frequency
+        return np.sign(vectors) * np.log1p(np.abs(vectors))
+
+
+class SentenceTransformerBackend(EmbeddingBackend):
+    """Runs a local sentence-transformers model, offline once the model is downloaded"""
+    name = 'sentence-transformers'
+
+    def __init__(self, model):
+        self.model = model
+        self._encoder = SentenceTransformer(model)
+
+    def encode(self, texts):
+        return self._encoder.encode(list(texts), batch_size=32, convert_to_numpy=True)
+
+
+class GeminiEmbeddingBackend(EmbeddingBackend):
+    """Gemini's embedding API, sharing the grading calls' client and rate limit"""
+    name = 'gemini'
+
+    def __init__(self, model):
+        self.model = model
+
+    def encode(self, texts):
+        # One batch request; embeddings have no response tokens to estimate
+        get_rate_limiter().acquire(sum(len(text) // 4 for text in texts))
+        result = genai.embed_content(
+            model=self.model, content=list(texts), task_type='semantic_similarity', client=get_generative_client(),
+            request_options={'timeout': settings.GEMINI_TIMEOUT_SECONDS},
+        )
+        return result['embedding']
+
+
+def normalize_rows(vectors):
+    """Scale each row to unit length (all-zero rows stay zero), so dot products are cosine similarities"""
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.where(norms == 0, 1, norms)
+
+
+@lru_cache(maxsize=None)
+def get_embedding_backend():
+    """Return this process's embedding backend, chosen by settings.EMBEDDING_BACKEND
+
+    'auto' runs the local settings.EMBEDDING_MODEL through sentence-transformers
+    when it is installed, and falls back to the hashing backend otherwise.
+    """
+    choice = settings.EMBEDDING_BACKEND
+    if choice == GeminiEmbeddingBackend.name:
+        return GeminiEmbeddingBackend(settings.EMBEDDING_MODEL or 'models/text-embedding-004')
+    if choice in ('auto', SentenceTransformerBackend.name):
+        if SentenceTransformer is not None:
+            try:
+                return SentenceTransformerBackend(settings.EMBEDDING_MODEL or 'all-MiniLM-L6-v2')
+            except Exception as e:
+                logger.warning(f"Could not load embedding model, falling back to hashing: {e}")
+        elif choice == SentenceTransformerBackend.name:
+            logger.warning("EMBEDDING_BACKEND is 'sentence-transformers' but it is not installed, falling back to hashing")
+    return HashingBackend()
@@ -0,0 +1,133 @@
+import json
+import asyncio
+import threading
+from collections import defaultdict
+from functools import lru_cache
+import redis
+import redis.asyncio
+from celery.utils.log import get_task_logger
+from django.conf import settings
+
+logger = get_task_logger(__name__)
+
+
+def user_channel(user_id):
+    """Channel of the events meant for one user, whichever role they have"""
+    return f'user:{user_id}'
+
+
+def format_event(name, data):
+    """Encode an event as a server-sent events message"""
+    return f'event: {name}\ndata: {json.dumps(data)}\n\n'
+
+
+class MemoryEventBackend:
+    """Fans events out to the listeners in this process; enough for tests and a single-process server
+
+    Events can be published from any thread, each listener receives them on its own event loop.
+    """
+
+    def __init__(self):
+        self._listeners = defaultdict(set)
+        self._lock = threading.Lock()
+
+    def publish(self, channel, message):
+        """Send a message (a string) to every listener of the channel"""
+        self.dispatch(channel, message)
+
+    def dispatch(self, channel, message):
+        """Hand a message to this process's listeners of the channel"""
+        with self._lock:
+            listeners = list(self._listeners.get(channel, ()))
+        for loop, queue in listeners:
+            try:
+                loop.call_soon_threadsafe(queue.put_nowait, message)
+            except RuntimeError:  # The listener's loop has closed, it is being removed
+                pass
+
+    async def listen(self, channel, timeout):
+        """Yield the channel's messages as they are published, and None after every timeout seconds of quiet"""
+        listener = (asyncio.get_running_loop(), asyncio.Queue())
+        with self._lock:
+            self._listeners[channel].add(listener)
+        try:
+            while True:
+                try:
+                    yield await asyncio.wait_for(listener[1].get(), timeout)
+                except asyncio.TimeoutError:
+                    yield None
+        finally:
+            with self._lock:
+                self._listeners[channel].discard(listener)
+                if not self._listeners[channel]:
+                    del self._listeners[channel]
+
+
+class RedisEventBackend(MemoryEventBackend):
+    """Publishes through Redis pub/sub, so events from any worker reach clients of any web process
+
+    Each web process holds a single pattern subscription, relaying the events
+    to its own listeners, instead of one Redis connection per open stream.
+    """
+
+    def __init__(self, url, prefix='events'):
+        super().__init__()
+        self.url = url
+        self.prefix = prefix
+        self.client = redis.Redis.from_url(url)
+        self._relay = None
+
+    def publish(self, channel, message):
+        try:
+            self.client.publish(f'{self.prefix}:{channel}', message)
+        except redis.RedisError as e:
+            # Clients see the new status on their next fetch, the grade itself is saved
+            logger.warning(f"Could not publish event to {channel}: {e}")
+
+    async def listen(self, channel, timeout):
+        loop = asyncio.get_running_loop()
+        if self._relay is None or self._relay.done() or self._relay.get_loop() is not loop:
+            self._relay = loop.create_task(self.relay())
+        async for message in super().listen(channel, timeout):
+            yield message
+
+    async def relay(self):
+        """Dispatch every event published through Redis to this process's listeners, reconnecting on errors"""
+        while True:
+            client = redis.asyncio.Redis.from_url(self.url)
+            try:
+                async with client.pubsub() as pubsub:
+                    await pubsub.psubscribe(f'{self.prefix}:*')
+                    async for message in pubsub.listen():
+                        if message['type'] == 'pmessage':
+                            channel = message['channel'].decode()[len(self.prefix) + 1:]
+                            self.dispatch(channel, message['data'].decode())
+            except redis.RedisError as e:
+                logger.warning(f"Lost the event relay's Redis connection, reconnecting: {e}")
+                await asyncio.sleep(1)
+            finally:
+                await client.aclose()
+
+
+@lru_cache(maxsize=None)
+def get_event_backend():
+    """Return this process's event backend, chosen by settings.EVENTS_BACKEND"""
+    if settings.EVENTS_BACKEND == 'memory':
+        return MemoryEventBackend()
+    return RedisEventBackend(settings.EVENTS_REDIS_URL)
+
+
+def publish_event(channels, name, data):
+    """Publish an event to each channel"""
+    backend = get_event_backend()
+    message = format_event(name, data)
+    for channel in channels:
+        backend.publish(channel, message)
+
+
+async def event_stream(channel):
+    """Yield a channel's events as a server-sent events stream, with a comment line to keep quiet streams open"""
+    # Browsers reconnect this many milliseconds after the stream drops
+    yield f'retry: {settings.EVENTS_RETRY_MILLISECONDS}\n\n'
+    async for message in get_event_backend().listen(channel, settings.EVENTS_KEEPALIVE_SECONDS):
+        yield message if message is not None else ': keep-alive\n\n'
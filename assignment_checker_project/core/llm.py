@@ -0,0 +1,163 @@
+import re
+import json
+import hashlib
+from functools import lru_cache
+import google.ai.generativelanguage as glm
+import google.generativeai as genai
+from google.ai.generativelanguage_v1beta.services.generative_service.transports import GenerativeServiceGrpcTransport
+from celery.utils.log import get_task_logger
+from django.conf import settings
+from django.core.cache import caches
+from google.generativeai import caching
+from .ratelimit import get_rate_limiter
+
+logger = get_task_logger(__name__)
+
+
+@lru_cache(maxsize=64)
+def get_gemini_model(model_name, cached_content=None):
+    """Return this process's GenerativeModel for model_name, optionally on top of a cached context
+
+    Every model shares the process's single GenerativeServiceClient, so grading
+    tasks reuse one open connection to the API instead of configuring a client
+    per task. Call it after the worker process has forked (gRPC channels can't
+    be shared across a fork), e.g. from worker_process_init.
+    """
+    model = genai.GenerativeModel(model_name)
+    # GenerativeModel has no public way to pass a client, it otherwise builds one from genai.configure()
+    model._client = get_generative_client()
+    if cached_content:
+        # What from_cached_content() sets, without fetching the cache's metadata on every call
+        model._cached_content = cached_content
+    return model
+
+
+@lru_cache(maxsize=None)
+def get_generative_client():
+    """Create the process-wide Gemini client on a keep-alive gRPC channel"""
+    api_key = settings.GOOGLE_API_KEY
+    if not api_key:
+        logger.error("GOOGLE_API_KEY environment variable is not set. Please set it in your .env file.")
+        raise ValueError("GOOGLE_API_KEY environment variable is required for Gemini integration")
+    # Other genai services (files, context caches) use the globally configured key
+    genai.configure(api_key=api_key)
+    return glm.GenerativeServiceClient(client_options={'api_key': api_key}, transport=keepalive_grpc_transport)
+
+
+def keepalive_grpc_transport(**kwargs):
+    """Build the default gRPC transport with keep-alive pings on its channel"""
+    def create_channel(host, options=(), **channel_kwargs):
+        keepalive = [
+            ('grpc.keepalive_time_ms', settings.GEMINI_KEEPALIVE_SECONDS * 1000),
+            ('grpc.keepalive_timeout_ms', 20_000),
+            ('grpc.keepalive_permit_without_calls', 1),
+            ('grpc.http2.max_pings_without_data', 0),
+        ]
+        return GenerativeServiceGrpcTransport.create_channel(host, options=[*options, *keepalive], **channel_kwargs)
+
+    return GenerativeServiceGrpcTransport(channel=create_channel, **kwargs)
+
+
+def estimate_tokens(prompt):
+    """Rough token count of a request before it is sent: ~4 characters a token plus the expected reply"""
+    return len(prompt) // 4 + settings.GEMINI_RESPONSE_TOKEN_ESTIMATE
+
+
+def generate_text(model_name, prompt, max_wait=None, generation_config=None, use_cache=True, cached_content=None):
+    """Return Gemini's response text for a prompt, answering repeated requests from the response cache
+
+    Responses are cached in settings.LLM_CACHE_ALIAS under response_cache_key();
+    use_cache=False always calls Gemini and leaves the cache untouched.
+    """
+    cache = caches[settings.LLM_CACHE_ALIAS] if use_cache and settings.LLM_CACHE_ALIAS else None
+    key = response_cache_key(model_name, prompt, generation_config, cached_content)
+    if cache is not None:
+        try:
+            cached = cache.get(key)
+        except Exception as e:
+            logger.warning(f"LLM response cache unavailable: {e}")
+            cached = None
+        if cached is not None:
+            logger.info(f"Reusing cached {model_name} response {key}")
+            return cached
+
+    text = generate_content(
+        model_name, prompt, max_wait=max_wait, generation_config=generation_config, cached_content=cached_content
+    ).text
+    if cache is not None and text:
+        try:
+            cache.set(key, text)
+        except Exception as e:
+            logger.warning(f"LLM response cache unavailable: {e}")
+    return text
+
+
+def discard_cached_response(model_name, prompt, generation_config=None, cached_content=None):
+    """Drop a cached response, e.g. one that turned out to be unusable"""
+    if settings.LLM_CACHE_ALIAS:
+        try:
+            key = response_cache_key(model_name, prompt, generation_config, cached_content)
+            caches[settings.LLM_CACHE_ALIAS].delete(key)
+        except Exception as e:
+            logger.warning(f"LLM response cache unavailable: {e}")
+
+
+def normalize_prompt(prompt):
+    """Collapse indentation and runs of spaces and blank lines, which don't change what a prompt asks"""
+    lines = (re.sub(r'[ \t]+', ' ', line).strip() for line in prompt.strip().splitlines())
+    return re.sub(r'\n{3,}', '\n\n', '\n'.join(lines))
+
+
+def response_cache_key(model_name, prompt, generation_config=None, cached_content=None):
+    """Cache key for a request: a hash of the model, the normalized prompt, the generation config and any cached context"""
+    request = [model_name, normalize_prompt(prompt), generation_config or {}]
+    if cached_content:
+        request.append(cached_content)
+    request = json.dumps(request, sort_keys=True, default=str)
+    return f'response:v1:{hashlib.sha256(request.encode()).hexdigest()}'
+
+
+def generate_content(model_name, prompt, max_wait=None, generation_config=None, cached_content=None):
+    """Send a prompt to Gemini on the shared client, bounded by settings.GEMINI_TIMEOUT_SECONDS
+
+    The call first takes its share of the cluster-wide request and token budget,
+    waiting up to max_wait seconds (None: as long as it takes) before raising
+    RateLimited. The estimate is corrected with the reported usage afterwards.
+    """
+    limiter = get_rate_limiter()
+    charged = limiter.acquire(estimate_tokens(prompt), max_wait=max_wait)
+    response = get_gemini_model(model_name, cached_content).generate_content(
+        prompt, generation_config=generation_config, request_options={'timeout': settings.GEMINI_TIMEOUT_SECONDS}
+    )
+    usage = getattr(response, 'usage_metadata', None)
+    if usage is not None:
+        limiter.debit(usage.total_token_count - charged)
+    return response
+
+
+def create_context_cache(model_name, contents, ttl, display_name=None):
+    """Upload contents as a Gemini cached context, returning (cache name, expire time)
+
+    Requests made with cached_content=name are billed and processed as if the
+    contents preceded their prompt, without sending them again.
+    """
+    get_generative_client()
+    cached = caching.CachedContent.create(model=model_name, display_name=display_name, contents=contents, ttl=ttl)
+    return cached.name, cached.expire_time
+
+
+def extend_context_cache(name, ttl):
+    """Push a cached context's expiry ttl from now, returning the new expire time"""
+    get_generative_client()
+    cached = caching.CachedContent(name)
+    cached.update(ttl=ttl)
+    return cached.expire_time
+
+
+def delete_context_cache(name):
+    """Delete a cached context ahead of its expiry, ignoring one that has already gone"""
+    get_generative_client()
+    try:
+        caching.CachedContent(name).delete()
+    except Exception as e:
+        logger.warning(f"Could not delete cached context {name}: {e}")
@@ -0,0 +1,307 @@
+import re
+import ast
+import math
+import random
+import operator
+import unicodedata
+from dataclasses import dataclass
+
+# Functions and constants allowed in expressions; any other word makes a line "not math"
+FUNCTIONS = {
+    'sqrt': math.sqrt, 'sin': math.sin, 'cos': math.cos, 'tan': math.tan,
+    'log': math.log10, 'ln': math.log, 'exp': math.exp, 'abs': abs,
+}
+CONSTANTS = {'pi': math.pi, 'e': math.e}
+
+BINARY_OPERATORS = {
+    ast.Add: operator.add, ast.Sub: operator.sub, ast.Mult: operator.mul,
+    ast.Div: operator.truediv, ast.Pow: operator.pow, ast.Mod: operator.mod,
+}
+UNARY_OPERATORS = {ast.USub: operator.neg, ast.UAdd: operator.pos}
+
+TOKEN = re.compile(r'\s*(?:(\d+(?:\.\d*)?|\.\d+)|([a-zA-Z]+)|(\*\*|[-+*/%()]))')
+NUMBER = re.compile(r'-?\d+(?:\.\d+)?')
+
+# Step numbering and labels in front of the math: "1.", "2)", "Step 3:", "Answer:", "Solve for x:"
+STEP_LABEL = re.compile(r'^\s*(?:\(?\d{1,3}[.)](?=\s)|\([a-h]\)|step\s*\d+\s*[:.)-]|q(?:uestion)?\s*\d+\s*[:.)-]?|[a-z][a-z ]*:)\s*', re.I)
+STEP_SEPARATOR = re.compile(r'→|⇒|=>|->|;')
+
+# Points at which expressions are compared; identical expressions agree at every one of them
+SAMPLE_POINTS = 6
+# A numeric answer this far off (relative) or more gets no partial credit
+PARTIAL_CREDIT_RANGE = 0.2
+# Share of the marks given for the final answer, the rest is for the steps shown
+FINAL_ANSWER_WEIGHT = 0.5
+# Share of lines that must be math for a text to count as a math answer
+MIN_MATH_LINES = 0.6
+# Steps the answer key must show for an answer to be graded locally. A bare one-line answer
+# like "x = 4" or "1000 m" has no working to check, and can't tell a unit from an unknown
+MIN_WORKED_STEPS = 2
+# Longer steps aren't parsed: each operator nests the syntax tree one level deeper, and a long
+# enough line would exceed Python's recursion limit
+MAX_STEP_CHARS = 300
+
+
+class Expression:
+    """An arithmetic expression parsed from student or teacher text, safe to evaluate
+
+    Written maths is turned into Python syntax first (implicit multiplication
+    like 2x or 3(x + 1), ^ for powers, unicode operators), then only numbers,
+    single-letter variables, the known constants and functions, and arithmetic
+    operators are accepted from the AST.
+    """
+
+    def __init__(self, text):
+        self.tree = ast.parse(to_python(text), mode='eval').body
+        self.variables = set()
+        self._check(self.tree)
+
+    def _check(self, node):
+        if isinstance(node, ast.BinOp) and type(node.op) in BINARY_OPERATORS:
+            self._check(node.left)
+            self._check(node.right)
+        elif isinstance(node, ast.UnaryOp) and type(node.op) in UNARY_OPERATORS:
+            self._check(node.operand)
+        elif isinstance(node, ast.Constant) and isinstance(node.value, (int, float)):
+            pass
+        elif isinstance(node, ast.Name):
+            if node.id not in CONSTANTS:
+                self.variables.add(node.id)
+        elif (isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id in FUNCTIONS
+              and len(node.args) == 1 and not node.keywords):
+            self._check(node.args[0])
+        else:
+            raise ValueError(f"Unsupported expression: {ast.dump(node)}")
+
+    def evaluate(self, values):
+        """Evaluate with the given {variable: value}, returning nan where it is undefined"""
+        try:
+            return float(self._evaluate(self.tree, values))
+        except (ArithmeticError, ValueError, TypeError):
+            return math.nan
+
+    def _evaluate(self, node, values):
+        if isinstance(node, ast.BinOp):
+            left, right = self._evaluate(node.left, values), self._evaluate(node.right, values)
+            if isinstance(node.op, ast.Pow) and abs(right) > 100:
+                raise OverflowError("Exponent too large")
+            return BINARY_OPERATORS[type(node.op)](left, right)
+        if isinstance(node, ast.UnaryOp):
+            return UNARY_OPERATORS[type(node.op)](self._evaluate(node.operand, values))
+        if isinstance(node, ast.Constant):
+            # Floats overflow at once where ints would grow without bound, e.g. ((9^99)^99)^99
+            return float(node.value)
+        if isinstance(node, ast.Name):
+            return CONSTANTS[node.id] if node.id in CONSTANTS else values[node.id]
+        return FUNCTIONS[node.func.id](self._evaluate(node.args[0], values))
+
+
+def to_python(text):
+    """Rewrite written maths as a Python expression, raising ValueError for anything else"""
+    text = unicodedata.normalize('NFKC', text)
+    for written, python in (('×', '*'), ('·', '*'), ('÷', '/'), ('−', '-'), ('^', '**'), ('²', '**2'), ('³', '**3')):
+        text = text.replace(written, python)
+    text = re.sub(r'(?<=\d),(?=\d{3}\b)', '', text).strip().rstrip('.')
+
+    tokens = []
+    position = 0
+    while position < len(text):
+        match = TOKEN.match(text, position)
+        if not match:
+            raise ValueError(f"Not a math expression: {text!r}")
+        position = match.end()
+        number, name, symbol = match.groups()
+        if name and len(name) > 1 and name not in FUNCTIONS and name not in CONSTANTS:
+            raise ValueError(f"Not a math expression: {text!r}")
+        kind = 'number' if number else 'name' if name else symbol
+        value = number or name or symbol
+        if tokens:
+            previous_kind, previous = tokens[-1]
+            operand_before = previous_kind in ('number', 'name', ')') and previous not in FUNCTIONS
+            if operand_before and kind in ('number', 'name', '('):
+                if previous_kind == 'number' and kind == 'number':
+                    raise ValueError(f"Not a math expression: {text!r}")
+                tokens.append(('*', '*'))
+        tokens.append((kind, value))
+    if not tokens:
+        raise ValueError("Empty expression")
+    return ' '.join(value for kind, value in tokens)
+
+
+def parse_equation(step):
+    """Parse a step into the list of Expressions on either side of its = signs"""
+    if len(step) > MAX_STEP_CHARS:
+        raise ValueError(f"Step too long to check: {len(step)} characters")
+    return [Expression(side) for side in step.split('=')]
+
+
+def parses_as_math(step):
+    try:
+        parse_equation(step)
+        return True
+    except (SyntaxError, ValueError):
+        return False
+
+
+def parse_steps(text):
+    """Split a worked answer into its steps, one per line or arrow, without numbering or labels"""
+    steps = []
+    for line in text.splitlines():
+        for part in STEP_SEPARATOR.split(line):
+            step = part.strip()
+            # Labels can nest, e.g. "Q1. Solve for x: 2x + 3 = 7"
+            while STEP_LABEL.match(step):
+                step = STEP_LABEL.sub('', step, count=1).strip()
+            # The question restated before its answer is one step
+            if step and (not steps or steps[-1] != step):
+                steps.append(step)
+    return steps
+
+
+def is_math_assignment(teacher_answer, student_answer):
+    """Return whether both answers are mostly equations and arithmetic the local grader can check"""
+    for text in (teacher_answer, student_answer):
+        steps = parse_steps(text)
+        if not steps or sum(1 for step in steps if parses_as_math(step)) < len(steps) * MIN_MATH_LINES:
+            return False
+    return True
+
+
+def _sample_values(variables, seed=0):
+    rng = random.Random(seed)
+    return [{name: rng.uniform(1.5, 4.5) for name in sorted(variables)} for _ in range(SAMPLE_POINTS)]
+
+
+def equivalent_expressions(first, second):
+    """Return whether two Expressions agree wherever both are defined"""
+    agreed = 0
+    for values in _sample_values(first.variables | second.variables):
+        a, b = first.evaluate(values), second.evaluate(values)
+        if math.isnan(a) or math.isnan(b):
+            continue
+        if not math.isclose(a, b, rel_tol=1e-6, abs_tol=1e-9):
+            return False
+        agreed += 1
+    return agreed >= SAMPLE_POINTS // 2
+
+
+def same_step(teacher_step, student_step):
+    """Return whether a student step writes the teacher's step: the same two sides, up to arithmetic and order"""
+    try:
+        teacher, student = parse_equation(teacher_step), parse_equation(student_step)
+    except (SyntaxError, ValueError):
+        return False
+    if len(teacher) == 1 or len(student) == 1:
+        return len(teacher) == len(student) and equivalent_expressions(teacher[0], student[0])
+    t_left, t_right, s_left, s_right = teacher[0], teacher[-1], student[0], student[-1]
+    return ((equivalent_expressions(t_left, s_left) and equivalent_expressions(t_right, s_right))
+            or (equivalent_expressions(t_left, s_right) and equivalent_expressions(t_right, s_left)))
+
+
+def equivalent_answers(teacher_step, student_step):
+    """Return whether two final answers are the same, e.g. "x = 2" and "2 = 4/2 = x" or "60" and "60.0"
+
+    Equations are the same when left - right of one is a constant multiple of
+    the other's, i.e. they have the same solutions.
+    """
+    try:
+        teacher, student = parse_equation(teacher_step), parse_equation(student_step)
+    except (SyntaxError, ValueError):
+        return False
+    variables = set().union(*(side.variables for side in teacher + student))
+    if len(teacher) == 1 or len(student) == 1 or not variables:
+        # A value rather than an equation to solve: compare what each answer ends with
+        return equivalent_expressions(teacher[-1], student[-1])
+
+    ratio = None
+    agreed = 0
+    for values in _sample_values(variables):
+        t = teacher[0].evaluate(values) - teacher[-1].evaluate(values)
+        s = student[0].evaluate(values) - student[-1].evaluate(values)
+        if math.isnan(t) or math.isnan(s):
+            continue
+        if math.isclose(t, 0, abs_tol=1e-9) or math.isclose(s, 0, abs_tol=1e-9):
+            if not (math.isclose(t, 0, abs_tol=1e-9) and math.isclose(s, 0, abs_tol=1e-9)):
+                return False
+        elif ratio is None:
+            ratio = t / s
+        elif not math.isclose(t / s, ratio, rel_tol=1e-6):
+            return False
+        agreed += 1
+    return agreed >= SAMPLE_POINTS // 2
+
+
+def evaluate_stepwise_math(teacher_steps, student_steps):
+    """Score each teacher step out of 100 / number of steps, given when any student step writes it
+
+    Returns {"step_1": score, ...} in the teacher's step order.
+    """
+    if not teacher_steps:
+        return {}
+    share = 100 / len(teacher_steps)
+    return {
+        f"step_{i}": share if any(same_step(step, student_step) for student_step in student_steps) else 0.0
+        for i, step in enumerate(teacher_steps, start=1)
+    }
+
+
+def partial_credit_numeric(teacher_answer, student_answer, max_score):
+    """Credit for the last number in the student's answer against the teacher's, decreasing with relative error
+
+    An exact match gets max_score, and the credit falls linearly to nothing
+    at PARTIAL_CREDIT_RANGE relative error.
+    """
+    expected, given = NUMBER.findall(teacher_answer.replace(',', '')), NUMBER.findall(student_answer.replace(',', ''))
+    if not expected or not given:
+        return 0.0
+    expected, given = float(expected[-1]), float(given[-1])
+    if math.isclose(expected, given, rel_tol=1e-9, abs_tol=1e-12):
+        return float(max_score)
+    if expected == 0:
+        return 0.0
+    error = abs(given - expected) / abs(expected)
+    return round(max_score * max(0.0, 1 - error / PARTIAL_CREDIT_RANGE), 2)
+
+
+@dataclass
+class MathGrade:
+    """Local grade of a math answer; confident is False when some of it couldn't be checked"""
+    score: float
+    feedback: str
+    confident: bool
+
+
+def grade_math(teacher_answer, student_answer, total_marks):
+    """Grade a worked math answer against the answer key's steps and final answer
+
+    FINAL_ANSWER_WEIGHT of the marks is for the final answer (with partial
+    credit for a close number) and the rest for the key's steps the student
+    shows. The grade is only confident when every step of both answers could be
+    checked; otherwise an LLM should have the last word.
+    """
+    teacher_steps, student_steps = parse_steps(teacher_answer), parse_steps(student_answer)
+    if not teacher_steps or not student_steps:
+        return MathGrade(0.0, "No working was found to compare with the answer key.", False)
+    confident = all(parses_as_math(step) for step in teacher_steps + student_steps)
+
+    if equivalent_answers(teacher_steps[-1], student_steps[-1]):
+        final = 1.0
+    else:
+        final = partial_credit_numeric(teacher_steps[-1], student_steps[-1], 1)
+    step_scores = evaluate_stepwise_math(teacher_steps, student_steps)
+    steps = sum(step_scores.values()) / 100
+    weight = FINAL_ANSWER_WEIGHT if len(teacher_steps) > 1 else 1.0
+    score = round(total_marks * (weight * final + (1 - weight) * steps), 2)
+
+    shown = [name.split('_')[1] for name, value in step_scores.items() if value]
+    feedback = "Final answer is correct." if final == 1.0 else (
+        "Final answer is close to the expected value." if final else "Final answer is incorrect."
+    )
+    if len(teacher_steps) > 1:
+        feedback += f" Showed {len(shown)} of {len(teacher_steps)} expected steps."
+    return MathGrade(score, feedback, confident)
+
+
+def grade_math_assignment(student_answer, teacher_answer, total_marks):
+    """Return the local grade of a math answer out of total_marks"""
+    return grade_math(teacher_answer, student_answer, total_marks).score
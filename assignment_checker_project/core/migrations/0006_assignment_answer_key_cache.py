@@ -0,0 +1,23 @@
+# Generated by Django 5.2.6 on 2026-10-18 01:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0005_submission_grading_details_submission_status'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='assignment',
+            name='answer_key_hash',
+            field=models.CharField(blank=True, max_length=64),
+        ),
+        migrations.AddField(
+            model_name='assignment',
+            name='answer_key_text',
+            field=models.TextField(blank=True),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.6 on 2026-10-18 01:11
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0006_assignment_answer_key_cache'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='submission',
+            name='content_hash',
+            field=models.CharField(blank=True, db_index=True, max_length=64),
+        ),
+        migrations.AddField(
+            model_name='submission',
+            name='grading_key',
+            field=models.CharField(blank=True, max_length=64),
+        ),
+    ]
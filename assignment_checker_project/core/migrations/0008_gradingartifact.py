@@ -0,0 +1,26 @@
+# Generated by Django 5.2.6 on 2026-10-18 01:12
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0007_submission_content_hash'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GradingArtifact',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('extracted_text', models.TextField(blank=True)),
+                ('skipped_pages', models.JSONField(blank=True, default=list)),
+                ('answer_key_hash', models.CharField(blank=True, max_length=64)),
+                ('grading_result', models.JSONField(blank=True, null=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('submission', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='grading_artifact', to='core.submission')),
+            ],
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 5.2.6 on 2026-10-18 01:15
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0008_gradingartifact'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='gradingartifact',
+            name='page_confidences',
+            field=models.JSONField(blank=True, default=list),
+        ),
+        migrations.AddField(
+            model_name='gradingartifact',
+            name='prompt',
+            field=models.TextField(blank=True),
+        ),
+        migrations.AddField(
+            model_name='gradingartifact',
+            name='raw_response',
+            field=models.TextField(blank=True),
+        ),
+        migrations.AddField(
+            model_name='gradingartifact',
+            name='stage',
+            field=models.CharField(blank=True, choices=[('extracted', 'Extracted'), ('graded', 'Graded')], max_length=20),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.2.6 on 2026-10-18 01:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0009_gradingartifact_checkpoints'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='assignment',
+            name='answer_key_context_expires',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='assignment',
+            name='answer_key_context_hash',
+            field=models.CharField(blank=True, max_length=64),
+        ),
+        migrations.AddField(
+            model_name='assignment',
+            name='answer_key_context_name',
+            field=models.CharField(blank=True, max_length=255),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.2.6 on 2026-10-18 01:27
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0010_assignment_answer_key_context'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='assignment',
+            name='answer_key_questions',
+            field=models.JSONField(blank=True, default=list),
+        ),
+        migrations.AddField(
+            model_name='assignment',
+            name='answer_key_questions_hash',
+            field=models.CharField(blank=True, max_length=64),
+        ),
+        migrations.AddField(
+            model_name='gradingartifact',
+            name='question_responses',
+            field=models.JSONField(blank=True, default=dict),
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 5.2.6 on 2026-10-18 01:29
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0011_answer_key_questions'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AnswerMemo',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('questions_hash', models.CharField(max_length=64)),
+                ('question_number', models.PositiveIntegerField()),
+                ('answer_hash', models.CharField(max_length=64)),
+                ('normalized_answer', models.TextField()),
+                ('marks_achieved', models.FloatField()),
+                ('feedback', models.TextField(blank=True)),
+                ('hits', models.PositiveIntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('assignment', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='answer_memos', to='core.assignment')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('assignment', 'questions_hash', 'question_number', 'answer_hash'), name='unique_answer_memo')],
+            },
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 5.2.6 on 2026-10-18 01:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0013_plagiarism_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='submissionfingerprint',
+            name='embedding',
+            field=models.BinaryField(null=True),
+        ),
+        migrations.AddField(
+            model_name='submissionfingerprint',
+            name='embedding_model',
+            field=models.CharField(blank=True, max_length=200),
+        ),
+        migrations.AddField(
+            model_name='submissionfingerprint',
+            name='embedding_segments',
+            field=models.JSONField(blank=True, default=list),
+        ),
+        migrations.AlterField(
+            model_name='submissionfingerprint',
+            name='minhash',
+            field=models.BinaryField(null=True),
+        ),
+    ]
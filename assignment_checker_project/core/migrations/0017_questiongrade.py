@@ -0,0 +1,33 @@
+# Generated by Django 5.2.6 on 2026-10-18 01:49
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0016_assignment_stats'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='QuestionGrade',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('position', models.PositiveIntegerField()),
+                ('question_number', models.CharField(max_length=20)),
+                ('question_text', models.TextField(blank=True)),
+                ('marks_allocated', models.FloatField(blank=True, null=True)),
+                ('marks_achieved', models.FloatField(default=0)),
+                ('feedback', models.TextField(blank=True)),
+                ('assignment', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='question_grades', to='core.assignment')),
+                ('submission', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='question_grades', to='core.submission')),
+            ],
+            options={
+                'ordering': ['position'],
+                'indexes': [models.Index(fields=['assignment', 'question_number'], name='question_grade_lookup')],
+                'constraints': [models.UniqueConstraint(fields=('submission', 'position'), name='unique_question_grade')],
+            },
+        ),
+    ]
@@ -0,0 +1,80 @@
+import json
+
+from django.db import migrations
+
+BATCH_SIZE = 500
+
+
+def to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def split_grading_details(apps, schema_editor):
+    """Move the questions out of each (JSON-encoded) grading_details into QuestionGrade rows"""
+    Submission = apps.get_model('core', 'Submission')
+    QuestionGrade = apps.get_model('core', 'QuestionGrade')
+    submissions = Submission.objects.exclude(grading_details=None).only('id', 'assignment_id', 'grading_details')
+    grades, updated = [], []
+    for submission in submissions.iterator(chunk_size=BATCH_SIZE):
+        details = submission.grading_details
+        if isinstance(details, str):
+            try:
+                details = json.loads(details)
+            except ValueError:
+                details = {'overall_feedback': details}
+        if not isinstance(details, dict):
+            details = {}
+        questions = [question for question in details.pop('questions', None) or [] if isinstance(question, dict)]
+        for position, question in enumerate(questions):
+            grades.append(QuestionGrade(
+                submission_id=submission.id,
+                assignment_id=submission.assignment_id,
+                position=position,
+                question_number=str(question.get('question_number', position + 1))[:20],
+                question_text=str(question.get('question_text') or ''),
+                marks_allocated=to_float(question.get('marks_allocated')),
+                marks_achieved=to_float(question.get('marks_achieved')) or 0,
+                feedback=str(question.get('feedback') or ''),
+            ))
+        submission.grading_details = details
+        updated.append(submission)
+        if len(updated) >= BATCH_SIZE:
+            QuestionGrade.objects.bulk_create(grades)
+            Submission.objects.bulk_update(updated, ['grading_details'])
+            grades, updated = [], []
+    QuestionGrade.objects.bulk_create(grades)
+    Submission.objects.bulk_update(updated, ['grading_details'])
+
+
+def join_grading_details(apps, schema_editor):
+    """Put the QuestionGrade rows back into grading_details"""
+    Submission = apps.get_model('core', 'Submission')
+    QuestionGrade = apps.get_model('core', 'QuestionGrade')
+    submissions = Submission.objects.exclude(grading_details=None).only('id', 'grading_details')
+    for submission in submissions.iterator(chunk_size=BATCH_SIZE):
+        grades = QuestionGrade.objects.filter(submission_id=submission.id).order_by('position')
+        submission.grading_details = {**submission.grading_details, 'questions': [
+            {
+                'question_number': int(grade.question_number) if grade.question_number.isdigit() else grade.question_number,
+                'question_text': grade.question_text,
+                'marks_allocated': grade.marks_allocated,
+                'marks_achieved': grade.marks_achieved,
+                'feedback': grade.feedback,
+            }
+            for grade in grades
+        ]}
+        submission.save(update_fields=['grading_details'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0017_questiongrade'),
+    ]
+
+    operations = [
+        migrations.RunPython(split_grading_details, join_grading_details),
+    ]
@@ -0,0 +1,20 @@
+from django.db import migrations
+
+
+def clear_answer_memos(apps, schema_editor):
+    """Drop memoized grades keyed by the old normalization, which stripped brackets
+
+    Under it (a+b)/c and a+b/c shared a memo; the answers are simply graded again.
+    """
+    apps.get_model('core', 'AnswerMemo').objects.all().delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0018_backfill_question_grades'),
+    ]
+
+    operations = [
+        migrations.RunPython(clear_answer_memos, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.6 on 2026-10-18 02:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0019_clear_answer_memos'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='gradingartifact',
+            name='questions_hash',
+            field=models.CharField(blank=True, max_length=64),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.6 on 2026-10-18 02:24
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0020_gradingartifact_questions_hash'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='gradingartifact',
+            name='cached_content',
+            field=models.CharField(blank=True, max_length=255),
+        ),
+        migrations.AddField(
+            model_name='gradingartifact',
+            name='model',
+            field=models.CharField(blank=True, max_length=100),
+        ),
+    ]
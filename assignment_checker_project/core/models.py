@@ -26,6 +26,10 @@ class Classroom(models.Model):
     created_at = models.DateTimeField(default=timezone.now)
     students = models.ManyToManyField(User, related_name='joined_classrooms', blank=True)
 
+    class Meta:
+        # Match the viewsets' filters and their newest-first cursor pagination
+        indexes = [models.Index(fields=['teacher', 'created_at'], name='classroom_teacher_created')]
+
     def save(self, *args, **kwargs):
         if not self.code:
             self.code = self.generate_unique_code()
@@ -52,6 +56,22 @@ class Assignment(models.Model):
     correct_answer_file = models.FileField(upload_to='answers/')
     total_marks = models.PositiveIntegerField(default=100)
     created_at = models.DateTimeField(default=timezone.now)
+    # Extracted text of correct_answer_file, keyed by the file's SHA-256 so it is only re-extracted when the file changes
+    answer_key_text = models.TextField(blank=True)
+    answer_key_hash = models.CharField(max_length=64, blank=True)
+    # Gemini cached context holding the answer key part of the grading prompt, identified by a hash of its contents
+    answer_key_context_name = models.CharField(max_length=255, blank=True)
+    answer_key_context_hash = models.CharField(max_length=64, blank=True)
+    answer_key_context_expires = models.DateTimeField(null=True, blank=True)
+    # The answer key (and question_file) segmented into questions, see core.questions.build_answer_key_questions
+    answer_key_questions = models.JSONField(default=list, blank=True)
+    answer_key_questions_hash = models.CharField(max_length=64, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['teacher', 'created_at'], name='assignment_teacher_created'),
+            models.Index(fields=['classroom', 'created_at'], name='assignment_classroom_created'),
+        ]
 
     def __str__(self):
         return self.title
@@ -74,6 +94,195 @@ class Submission(models.Model):
     status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='pending')
     grading_details = models.JSONField(null=True, blank=True)
     plagiarism_report = models.JSONField(null=True, blank=True)
+    # SHA-256 of submission_file, and of the answer key and grading config the score was produced with
+    content_hash = models.CharField(max_length=64, blank=True, db_index=True)
+    grading_key = models.CharField(max_length=64, blank=True)
+    # Whether this is the grade its assignment's AssignmentStats counts for the student (their latest graded submission)
+    in_stats = models.BooleanField(default=False)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['assignment', 'status'], name='submission_assignment_status'),
+            models.Index(fields=['assignment', 'submission_date'], name='submission_assignment_date'),
+            models.Index(fields=['student', 'submission_date'], name='submission_student_date'),
+        ]
 
     def __str__(self):
         return f"{self.student.username}'s submission for {self.assignment.title}"
+
+    def grading_result(self):
+        """The full grading result: grading_details with its questions from question_grades, None until graded"""
+        if self.grading_details is None:
+            return None
+        return {**self.grading_details, 'questions': [grade.as_result() for grade in self.question_grades.all()]}
+
+
+class QuestionGrade(models.Model):
+    """One question's grade in a graded submission, the rest of the grading result is in Submission.grading_details"""
+    submission = models.ForeignKey(Submission, on_delete=models.CASCADE, related_name='question_grades')
+    # Copied from the submission so per-question aggregates over an assignment don't need a join
+    assignment = models.ForeignKey(Assignment, on_delete=models.CASCADE, related_name='question_grades')
+    # Order of the question in the grading result
+    position = models.PositiveIntegerField()
+    question_number = models.CharField(max_length=20)
+    question_text = models.TextField(blank=True)
+    marks_allocated = models.FloatField(null=True, blank=True)
+    marks_achieved = models.FloatField(default=0)
+    feedback = models.TextField(blank=True)
+
+    class Meta:
+        ordering = ['position']
+        constraints = [
+            models.UniqueConstraint(fields=['submission', 'position'], name='unique_question_grade'),
+        ]
+        indexes = [models.Index(fields=['assignment', 'question_number'], name='question_grade_lookup')]
+
+    def __str__(self):
+        return f"Question {self.question_number} of submission {self.submission_id}"
+
+    def as_result(self):
+        """The grade as an entry of a grading result's "questions" list"""
+        return {
+            "question_number": int(self.question_number) if self.question_number.isdigit() else self.question_number,
+            "question_text": self.question_text,
+            "marks_allocated": self.marks_allocated,
+            "marks_achieved": self.marks_achieved,
+            "feedback": self.feedback,
+        }
+
+    @classmethod
+    def from_result(cls, submission, result):
+        """Build (unsaved) the question grades of a grading result, skipping entries that aren't questions"""
+        grades = []
+        for question in result.get('questions') or []:
+            if not isinstance(question, dict):
+                continue
+            grades.append(cls(
+                submission=submission,
+                assignment_id=submission.assignment_id,
+                position=len(grades),
+                question_number=str(question.get('question_number', len(grades) + 1))[:20],
+                question_text=str(question.get('question_text') or ''),
+                marks_allocated=_to_float(question.get('marks_allocated')),
+                marks_achieved=_to_float(question.get('marks_achieved')) or 0,
+                feedback=str(question.get('feedback') or ''),
+            ))
+        return grades
+
+
+def _to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class GradingArtifact(models.Model):
+    """Intermediate results handed between the stages of a submission's grading pipeline
+
+    Each stage checkpoints its output here so a retried or re-queued grading
+    run resumes from the last finished stage.
+    """
+    STAGE_EXTRACTED = 'extracted'
+    STAGE_GRADED = 'graded'
+    STAGE_CHOICES = (
+        (STAGE_EXTRACTED, 'Extracted'),
+        (STAGE_GRADED, 'Graded'),
+    )
+
+    submission = models.OneToOneField(Submission, on_delete=models.CASCADE, related_name='grading_artifact')
+    stage = models.CharField(max_length=20, choices=STAGE_CHOICES, blank=True)
+    extracted_text = models.TextField(blank=True)
+    skipped_pages = models.JSONField(default=list, blank=True)
+    page_confidences = models.JSONField(default=list, blank=True)
+    answer_key_hash = models.CharField(max_length=64, blank=True)
+    # Assignment.answer_key_questions_hash the prompt and question responses were made under
+    questions_hash = models.CharField(max_length=64, blank=True)
+    # The whole-paper prompt, replaced by the one actually sent once Gemini has answered it
+    prompt = models.TextField(blank=True)
+    # Model and cached answer-key context the prompt was sent with, which the response cache key includes
+    model = models.CharField(max_length=100, blank=True)
+    cached_content = models.CharField(max_length=255, blank=True)
+    raw_response = models.TextField(blank=True)
+    # Gemini's raw response per question number when the submission is graded question by question
+    question_responses = models.JSONField(default=dict, blank=True)
+    grading_result = models.JSONField(null=True, blank=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"Grading artifact for submission {self.submission_id}"
+
+
+class AnswerMemo(models.Model):
+    """Marks and feedback given to a short answer, reused for every answer to the question that normalizes the same
+
+    Rows are only valid for the segmentation they were graded under, identified
+    by Assignment.answer_key_questions_hash.
+    """
+    assignment = models.ForeignKey(Assignment, on_delete=models.CASCADE, related_name='answer_memos')
+    questions_hash = models.CharField(max_length=64)
+    question_number = models.PositiveIntegerField()
+    # SHA-256 of the answer after core.questions.normalize_answer
+    answer_hash = models.CharField(max_length=64)
+    normalized_answer = models.TextField()
+    marks_achieved = models.FloatField()
+    feedback = models.TextField(blank=True)
+    # Answers served from this row instead of Gemini; each row itself was one miss
+    hits = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['assignment', 'questions_hash', 'question_number', 'answer_hash'], name='unique_answer_memo'
+            ),
+        ]
+
+    def __str__(self):
+        return f"Q{self.question_number} of {self.assignment}: {self.normalized_answer[:50]}"
+
+
+class SubmissionFingerprint(models.Model):
+    """MinHash signature of a submission's extracted text, see core.plagiarism"""
+    submission = models.OneToOneField(Submission, on_delete=models.CASCADE, related_name='fingerprint')
+    assignment = models.ForeignKey(Assignment, on_delete=models.CASCADE, related_name='fingerprints')
+    # core.plagiarism.NUM_PERM little-endian uint32s, null when the text has no shingles of its own
+    minhash = models.BinaryField(null=True)
+    # float32 unit vectors, one row per entry of embedding_segments: 0 for the whole text, else a question number
+    embedding = models.BinaryField(null=True)
+    embedding_model = models.CharField(max_length=200, blank=True)
+    embedding_segments = models.JSONField(default=list, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"Fingerprint of submission {self.submission_id}"
+
+
+class LSHBucket(models.Model):
+    """One LSH band of a submission's MinHash signature; submissions sharing a bucket are plagiarism candidates"""
+    assignment = models.ForeignKey(Assignment, on_delete=models.CASCADE, related_name='lsh_buckets')
+    key = models.BigIntegerField()
+    submission = models.ForeignKey(Submission, on_delete=models.CASCADE, related_name='lsh_buckets')
+
+    class Meta:
+        indexes = [models.Index(fields=['assignment', 'key'], name='lsh_bucket_lookup')]
+
+    def __str__(self):
+        return f"Bucket {self.key} of submission {self.submission_id}"
+
+
+class AssignmentStats(models.Model):
+    """Running score statistics of an assignment, updated as grades are saved, see core.stats"""
+    assignment = models.OneToOneField(Assignment, on_delete=models.CASCADE, related_name='stats')
+    # Over each student's latest graded submission
+    graded_count = models.PositiveIntegerField(default=0)
+    score_sum = models.FloatField(default=0)
+    score_sum_squares = models.FloatField(default=0)
+    # Number of scores in each of core.stats.HISTOGRAM_BUCKETS equal slices of the total marks
+    histogram = models.JSONField(default=list)
+    # {question number: {"count", "marks_sum", "marks_allocated"}}
+    question_totals = models.JSONField(default=dict)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"Stats of {self.assignment}"
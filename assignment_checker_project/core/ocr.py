@@ -0,0 +1,226 @@
+import math
+import hashlib
+import threading
+from functools import lru_cache
+import fitz
+import pytesseract
+from PIL import Image
+from celery.utils.log import get_task_logger
+from django.conf import settings
+from django.core.cache import caches
+
+try:
+    import tesserocr
+except ImportError:  # Optional dependency, pytesseract is used instead
+    tesserocr = None
+
+logger = get_task_logger(__name__)
+
+# Assume a single uniform block of text, which suits answer sheets
+PAGE_SEG_MODE = 6
+
+# Images smaller than this (half an inch) on either side are logos or bullets, not answers
+MIN_OCR_REGION_POINTS = 36
+# Image regions whose native text spans at least this share of their area already carry a text layer,
+# like the invisible OCR layer of a searchable scan, and aren't OCRed again. Captions or labels over
+# a photo span far less, while a scan's layer spans its text block, only short of the margins
+OCR_LAYER_MIN_COVERAGE = 0.25
+
+
+class PageImage:
+    """A rendered single-channel page whose pixels stay in the pixmap's buffer"""
+
+    def __init__(self, pixmap):
+        self.pixmap = pixmap
+
+    @property
+    def width(self):
+        return self.pixmap.width
+
+    @property
+    def height(self):
+        return self.pixmap.height
+
+    @property
+    def stride(self):
+        return self.pixmap.stride
+
+    @property
+    def buffer(self):
+        """Zero-copy memoryview over the 8-bit grayscale samples"""
+        return self.pixmap.samples_mv
+
+    def to_pil(self):
+        """Wrap the samples in a PIL image that shares the pixmap's memory"""
+        return Image.frombuffer('L', (self.width, self.height), self.buffer, 'raw', 'L', self.stride, 1)
+
+
+def ocr_zoom(rect):
+    """Return the points-to-pixels scale for a page or region of the given size
+
+    Pages render at settings.OCR_TARGET_DPI, scaled down for large pages (A3 scans)
+    so a render never exceeds settings.OCR_MAX_PAGE_PIXELS.
+    """
+    zoom = settings.OCR_TARGET_DPI / 72
+    area = rect.width * rect.height
+    if area * zoom * zoom > settings.OCR_MAX_PAGE_PIXELS:
+        zoom = math.sqrt(settings.OCR_MAX_PAGE_PIXELS / area)
+    return zoom
+
+
+def render_page_for_ocr(page, clip=None):
+    """Render a PDF page, or the clip region of it, straight to an 8-bit grayscale pixmap for OCR"""
+    zoom = ocr_zoom(clip or page.rect)
+    pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), colorspace=fitz.csGRAY, alpha=False, clip=clip)
+    return PageImage(pix)
+
+
+class OCRBackend:
+    """Base class for OCR engines used by PDF text extraction"""
+    name = None
+    lang = None
+
+    def warm_up(self):
+        """Load the engine ahead of the first page, a no-op by default"""
+
+    def image_to_string(self, image):
+        """Return the text recognised in a PageImage"""
+        raise NotImplementedError
+
+    def recognize(self, image):
+        """Return (text, mean word confidence 0-100 or None) for a PageImage"""
+        return self.image_to_string(image), None
+
+    def close(self):
+        """Release the engine when the worker process exits, a no-op by default"""
+
+
+class PytesseractBackend(OCRBackend):
+    """Runs the tesseract binary once per page through pytesseract"""
+    name = 'pytesseract'
+
+    def __init__(self, lang):
+        self.lang = lang
+
+    def image_to_string(self, image):
+        return pytesseract.image_to_string(image.to_pil(), lang=self.lang, config=f'--psm {PAGE_SEG_MODE}')
+
+    def recognize(self, image):
+        # image_to_data gives word confidences in the same tesseract run, lines are rebuilt from its word layout
+        data = pytesseract.image_to_data(
+            image.to_pil(), lang=self.lang, config=f'--psm {PAGE_SEG_MODE}', output_type=pytesseract.Output.DICT
+        )
+        lines = {}
+        confidences = []
+        for i, word in enumerate(data['text']):
+            if not word.strip():
+                continue
+            lines.setdefault((data['block_num'][i], data['par_num'][i], data['line_num'][i]), []).append(word)
+            if float(data['conf'][i]) >= 0:
+                confidences.append(float(data['conf'][i]))
+        text = "\n".join(" ".join(words) for words in lines.values())
+        return text, (sum(confidences) / len(confidences) if confidences else None)
+
+
+class TesserocrBackend(OCRBackend):
+    """Keeps warm tesseract engines in-process through the C API
+
+    A tesseract engine is not thread-safe, so engines are pooled and each page
+    borrows one. Engines are created on demand (one per concurrent OCR thread at
+    most) and live for the rest of the worker process, so the language model is
+    only loaded once per engine and images never leave memory.
+    """
+    name = 'tesserocr'
+
+    def __init__(self, lang):
+        self.lang = lang
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def _acquire(self):
+        with self._lock:
+            if self._idle:
+                return self._idle.pop()
+        return tesserocr.PyTessBaseAPI(lang=self.lang, psm=PAGE_SEG_MODE)
+
+    def _release(self, api):
+        api.Clear()
+        with self._lock:
+            self._idle.append(api)
+
+    def warm_up(self):
+        self._release(self._acquire())
+
+    def image_to_string(self, image):
+        return self.recognize(image)[0]
+
+    def recognize(self, image):
+        api = self._acquire()
+        try:
+            # SetImageBytes needs a bytes object, so this is the only copy of the grayscale samples
+            api.SetImageBytes(image.pixmap.samples, image.width, image.height, 1, image.stride)
+            return api.GetUTF8Text(), api.MeanTextConf()
+        finally:
+            self._release(api)
+
+    def close(self):
+        """Free the engines, called when the worker process shuts down"""
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for api in idle:
+            api.End()
+
+
+@lru_cache(maxsize=None)
+def get_ocr_backend():
+    """Return this process's OCR backend, chosen by settings.OCR_BACKEND
+
+    'auto' prefers the in-process tesserocr engine and falls back to pytesseract
+    when tesserocr isn't installed or its engine can't be started.
+    """
+    choice = settings.OCR_BACKEND
+    lang = settings.OCR_LANGUAGE
+    if choice in ('auto', TesserocrBackend.name):
+        if tesserocr is not None:
+            backend = TesserocrBackend(lang)
+            try:
+                backend.warm_up()
+                return backend
+            except Exception as e:
+                logger.warning(f"Could not start tesserocr engine, falling back to pytesseract: {e}")
+        elif choice == TesserocrBackend.name:
+            logger.warning("OCR_BACKEND is 'tesserocr' but tesserocr is not installed, falling back to pytesseract")
+    return PytesseractBackend(lang)
+
+
+def recognize_image(image):
+    """OCR a PageImage into (text, confidence), reusing the result for an identical render
+
+    Identical pages (the same printed question sheet or cover page in many
+    submissions) render to identical pixels, so results are cached under a hash
+    of the samples in settings.OCR_CACHE_ALIAS, which all workers share.
+    """
+    backend = get_ocr_backend()
+    key = page_fingerprint(image, backend)
+    cache = caches[settings.OCR_CACHE_ALIAS]
+    try:
+        cached = cache.get(key)
+    except Exception as e:
+        logger.warning(f"OCR cache unavailable: {e}")
+        cached = None
+    if cached is not None:
+        return tuple(cached)
+
+    result = backend.recognize(image)
+    try:
+        cache.set(key, result)
+    except Exception as e:
+        logger.warning(f"OCR cache unavailable: {e}")
+    return result
+
+
+def page_fingerprint(image, backend):
+    """Cache key for a rendered page: its pixels plus the engine settings that affect the text"""
+    digest = hashlib.sha256(image.buffer)
+    digest.update(f'{image.width}x{image.height}:{backend.name}:{backend.lang}:{PAGE_SEG_MODE}'.encode())
+    return f'page:v2:{digest.hexdigest()}'
@@ -0,0 +1,20 @@
+from django.conf import settings
+from rest_framework.pagination import CursorPagination
+
+
+class NewestFirstPagination(CursorPagination):
+    """Cursor pagination, newest first, for lists that keep growing
+
+    Pages are fetched by seeking past the last row of the previous page on an
+    indexed column, so every page costs the same however far back a teacher
+    scrolls, and rows added meanwhile aren't skipped or repeated. The id breaks
+    ties between rows created in the same instant.
+    """
+    ordering = ('-created_at', '-id')
+    page_size = settings.API_PAGE_SIZE
+    page_size_query_param = 'page_size'
+    max_page_size = 200
+
+
+class SubmissionPagination(NewestFirstPagination):
+    ordering = ('-submission_date', '-id')
@@ -0,0 +1,225 @@
+import re
+import zlib
+import hashlib
+import numpy as np
+from django.conf import settings
+from django.db import transaction
+from .embeddings import get_embedding_backend
+from .models import Submission, SubmissionFingerprint, LSHBucket
+
+# Words per shingle; shorter texts become a single shingle
+SHINGLE_SIZE = 5
+# MinHash signature length, split into LSH bands of BAND_ROWS hashes. Pairs are likely to share a
+# bucket from about (1 / LSH_BANDS) ** (1 / BAND_ROWS) ~ 0.42 Jaccard similarity. Changing these
+# invalidates every stored signature.
+NUM_PERM = 128
+LSH_BANDS = 32
+BAND_ROWS = NUM_PERM // LSH_BANDS
+# Shingles hashed per numpy batch, bounding memory to NUM_PERM x this many uint64s
+HASH_BATCH = 4096
+
+MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+MAX_HASH = np.uint64((1 << 32) - 1)
+# Fixed seed so signatures computed by different workers are comparable
+_permutations = np.random.RandomState(1)
+PERM_A = _permutations.randint(1, MERSENNE_PRIME, size=NUM_PERM, dtype=np.uint64)
+PERM_B = _permutations.randint(0, MERSENNE_PRIME, size=NUM_PERM, dtype=np.uint64)
+
+
+def shingle_hashes(text):
+    """Return the sorted, unique 32-bit hashes of the text's word shingles"""
+    words = re.findall(r'\w+', text.lower())
+    if len(words) <= SHINGLE_SIZE:
+        shingles = {' '.join(words)} if words else set()
+    else:
+        shingles = {' '.join(words[i:i + SHINGLE_SIZE]) for i in range(len(words) - SHINGLE_SIZE + 1)}
+    return np.unique(np.fromiter((zlib.crc32(s.encode()) for s in shingles), dtype=np.uint64, count=len(shingles)))
+
+
+def minhash_signature(hashes):
+    """Return the NUM_PERM-value MinHash signature (uint32) of a set of shingle hashes"""
+    signature = np.full(NUM_PERM, MAX_HASH, dtype=np.uint64)
+    for start in range(0, len(hashes), HASH_BATCH):
+        batch = hashes[start:start + HASH_BATCH]
+        permuted = ((PERM_A[:, None] * batch[None, :] + PERM_B[:, None]) % MERSENNE_PRIME) & MAX_HASH
+        np.minimum(signature, permuted.min(axis=1), out=signature)
+    return signature.astype(np.uint32)
+
+
+def band_keys(signature):
+    """Return the LSH bucket key of each band of a signature, as signed 64-bit ints"""
+    return [
+        int.from_bytes(hashlib.blake2b(band.to_bytes(2, 'big') + rows.tobytes(), digest_size=8).digest(), 'big', signed=True)
+        for band, rows in enumerate(signature.reshape(LSH_BANDS, BAND_ROWS))
+    ]
+
+
+def check_submission(submission, text, answers=None):
+    """Index a submission's extracted text and record its near-duplicates and paraphrases
+
+    answers ({question number: answer} when the text aligns with a numbered
+    answer key) are also compared question by question, so one paraphrased
+    answer stands out in an otherwise original paper.
+    """
+    index_submission(submission, text=text)
+    index_embeddings(submission, text, answers)
+
+
+def text_signature(text, boilerplate=''):
+    """Signature of a submission's text, ignoring shingles it shares with boilerplate (e.g. the answer key)
+
+    Returns None for text without any shingles of its own.
+    """
+    hashes = shingle_hashes(text)
+    if boilerplate:
+        hashes = np.setdiff1d(hashes, shingle_hashes(boilerplate), assume_unique=True)
+    return minhash_signature(hashes) if len(hashes) else None
+
+
+def index_submission(submission, text=None, signature=None):
+    """Add a submission to its assignment's plagiarism index and report its near-duplicates
+
+    Candidates are the submissions by other students that share an LSH bucket
+    with it, found through one indexed lookup however many submissions the
+    assignment has. Their estimated Jaccard similarity is computed from the
+    signatures in one numpy comparison, and matches of at least
+    settings.PLAGIARISM_MIN_SIMILARITY are written to the plagiarism_report of
+    both submissions. Pass the text, or the signature of an identical upload.
+    """
+    assignment = submission.assignment
+    if signature is None:
+        signature = text_signature(text, assignment.answer_key_text)
+        if signature is None:
+            return []
+    keys = band_keys(signature)
+
+    # Index first, so of two near-duplicates indexed concurrently the later lookup sees the other
+    with transaction.atomic():
+        SubmissionFingerprint.objects.update_or_create(
+            submission=submission, defaults={'assignment': assignment, 'minhash': signature.tobytes()}
+        )
+        LSHBucket.objects.filter(submission=submission).delete()
+        LSHBucket.objects.bulk_create(LSHBucket(assignment=assignment, key=key, submission=submission) for key in keys)
+
+    candidates = set(
+        LSHBucket.objects
+        .filter(assignment=assignment, key__in=keys)
+        .exclude(submission__student_id=submission.student_id)
+        .values_list('submission_id', flat=True)
+    )
+    matches = []
+    if candidates:
+        rows = list(SubmissionFingerprint.objects.filter(submission_id__in=candidates).values_list('submission_id', 'minhash'))
+        signatures = np.vstack([np.frombuffer(bytes(minhash), dtype=np.uint32) for _, minhash in rows])
+        similarities = (signatures == signature).mean(axis=1)
+        matches = sorted(
+            ((round(float(similarity), 3), submission_id) for (submission_id, _), similarity in zip(rows, similarities)
+             if similarity >= settings.PLAGIARISM_MIN_SIMILARITY),
+            reverse=True,
+        )[:settings.PLAGIARISM_MAX_MATCHES]
+    record_matches(submission.id, 'matches', [
+        {"submission": other_id, "similarity": similarity} for similarity, other_id in matches
+    ])
+    return matches
+
+
+def index_embeddings(submission, text, answers=None):
+    """Embed a submission's text and aligned answers, and report the submissions that paraphrase it"""
+    segments = {0: text, **(answers or {})}
+    # Short answers ("Paris", "x = 4") are alike whenever they are right, only compare ones long enough to paraphrase
+    labels = [label for label, segment in segments.items()
+              if len(re.findall(r'\w+', segment)) >= settings.PLAGIARISM_SEMANTIC_MIN_WORDS]
+    if not labels:
+        return []
+    backend = get_embedding_backend()
+    vectors = backend.embed([segments[label] for label in labels])
+    return index_vectors(submission, vectors, labels, backend.model_id)
+
+
+def index_vectors(submission, vectors, labels, model_id):
+    """Store a submission's embeddings and record its semantic matches
+
+    labels name each row of vectors: 0 for the whole text, otherwise the
+    question it answers. Every stored row of the assignment embedded by the same
+    model is scored against them in one matrix product, rows answering
+    different questions are masked out, and other students' submissions whose
+    best cosine similarity reaches settings.PLAGIARISM_SEMANTIC_THRESHOLD are
+    written to semantic_matches in the plagiarism_report of both submissions.
+    """
+    assignment = submission.assignment
+    # Stored before the lookup, like the MinHash index, so concurrent paraphrases can't miss each other
+    SubmissionFingerprint.objects.update_or_create(
+        submission=submission,
+        defaults={'assignment': assignment, 'embedding': vectors.tobytes(), 'embedding_model': model_id,
+                  'embedding_segments': labels},
+    )
+    rows = list(
+        SubmissionFingerprint.objects
+        .filter(assignment=assignment, embedding_model=model_id, embedding__isnull=False)
+        .exclude(submission__student_id=submission.student_id)
+        .values_list('submission_id', 'embedding', 'embedding_segments')
+    )
+
+    matches = []
+    if rows:
+        stored = np.frombuffer(b''.join(bytes(embedding) for _, embedding, _ in rows), dtype=np.float32)
+        stored = stored.reshape(-1, vectors.shape[1])
+        stored_labels = np.concatenate([np.asarray(segments, dtype=np.int64) for *_, segments in rows])
+        similarities = stored @ vectors.T
+        similarities[stored_labels[:, None] != np.asarray(labels)[None, :]] = -1
+        best_rows = similarities.max(axis=1)
+        best_columns = similarities.argmax(axis=1)
+        # Each submission's rows are contiguous, so its best row is a max over its slice
+        starts = np.cumsum([0] + [len(segments) for *_, segments in rows[:-1]])
+        best = np.maximum.reduceat(best_rows, starts)
+        for index in np.flatnonzero(best >= settings.PLAGIARISM_SEMANTIC_THRESHOLD):
+            row = starts[index] + best_rows[starts[index]:starts[index] + len(rows[index][2])].argmax()
+            match = {"submission": rows[index][0], "similarity": round(float(best[index]), 3)}
+            if labels[best_columns[row]]:
+                match["question"] = labels[best_columns[row]]
+            matches.append(match)
+    record_matches(submission.id, 'semantic_matches', matches)
+    return matches
+
+
+def record_matches(submission_id, key, matches):
+    """Write a submission's matches to its report under key, and add it to the report of each match
+
+    Each match is a dict naming the other submission; the same dict naming
+    this submission goes into the other's report.
+    """
+    with transaction.atomic():
+        ids = sorted({submission_id, *(match["submission"] for match in matches)})
+        # Lock in id order so concurrent updates of overlapping match sets can't deadlock
+        locked = {s.id: s for s in Submission.objects.select_for_update().filter(id__in=ids).order_by('id')}
+        own = locked[submission_id]
+        own.plagiarism_report = _with_matches(own.plagiarism_report, key, matches)
+        for match in matches:
+            other = locked[match["submission"]]
+            entries = [m for m in _report(other.plagiarism_report).get(key, []) if m["submission"] != submission_id]
+            entries.append({**match, "submission": submission_id})
+            other.plagiarism_report = _with_matches(other.plagiarism_report, key, entries)
+        Submission.objects.bulk_update(locked.values(), ['plagiarism_report'])
+
+
+def _report(report):
+    return report if isinstance(report, dict) else {}
+
+
+def _with_matches(report, key, matches):
+    """The report with one match list replaced, ranked by similarity and trimmed to the maximum"""
+    matches = sorted(matches, key=lambda m: m["similarity"], reverse=True)[:settings.PLAGIARISM_MAX_MATCHES]
+    return {**_report(report), key: matches}
+
+
+def index_duplicate(submission, original):
+    """Index a byte-identical re-upload of original without extracting or embedding it again"""
+    fingerprint = SubmissionFingerprint.objects.filter(submission=original).first()
+    if fingerprint is None:
+        return
+    if fingerprint.minhash is not None:
+        index_submission(submission, signature=np.frombuffer(bytes(fingerprint.minhash), dtype=np.uint32))
+    if fingerprint.embedding is not None:
+        vectors = np.frombuffer(bytes(fingerprint.embedding), dtype=np.float32)
+        index_vectors(submission, vectors.reshape(len(fingerprint.embedding_segments), -1),
+                      fingerprint.embedding_segments, fingerprint.embedding_model)
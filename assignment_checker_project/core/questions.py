@@ -0,0 +1,129 @@
+import re
+import unicodedata
+from decimal import Decimal
+
+# A question number at the start of a line: "Q1", "Q.2:", "Question 3 -", "4.", "5)"
+QUESTION_MARKER = re.compile(r'^[ \t]*(?:Q(?:uestion)?[ \t]*\.?[ \t]*(\d{1,3})|(\d{1,3})[ \t]*[.)])[ \t]*[:.)\-]?[ \t]*', re.I | re.M)
+
+# Marks printed next to a question: "(5 marks)", "[2 Marks]", "3 pts"
+MARKS_PATTERN = re.compile(r'[(\[]?[ \t]*(\d+(?:\.\d+)?)[ \t]*(?:marks?|pts?|points?)[ \t]*[)\]]?', re.I)
+
+# Spellings of units mapped to one symbol, so "5 metres" and "5m" normalize alike
+UNIT_ALIASES = {
+    **dict.fromkeys(['meter', 'meters', 'metre', 'metres', 'mtr', 'mtrs'], 'm'),
+    **dict.fromkeys(['centimeter', 'centimeters', 'centimetre', 'centimetres', 'cms'], 'cm'),
+    **dict.fromkeys(['millimeter', 'millimeters', 'millimetre', 'millimetres'], 'mm'),
+    **dict.fromkeys(['kilometer', 'kilometers', 'kilometre', 'kilometres', 'kms'], 'km'),
+    **dict.fromkeys(['gram', 'grams', 'gm', 'gms'], 'g'),
+    **dict.fromkeys(['kilogram', 'kilograms', 'kgs'], 'kg'),
+    **dict.fromkeys(['second', 'seconds', 'sec', 'secs'], 's'),
+    **dict.fromkeys(['minute', 'minutes', 'mins'], 'min'),
+    **dict.fromkeys(['hour', 'hours', 'hr', 'hrs'], 'h'),
+    **dict.fromkeys(['liter', 'liters', 'litre', 'litres'], 'l'),
+    **dict.fromkeys(['percent', 'percentage'], '%'),
+    **dict.fromkeys(['degree', 'degrees', '°'], 'deg'),
+}
+
+NUMBER = re.compile(r'(?<![\w.])\d*\.?\d+(?![\w.]*\d)')
+
+
+def segment_questions(text):
+    """Split text into {question number: text under it}
+
+    Only markers numbered one past the previous question, and written in the
+    same style as the first one ("Q1" or "1."), are taken as questions, so
+    numbered steps or lists inside an answer stay in that answer. Text before
+    the first question (title, name, instructions) is dropped.
+    """
+    segments = {}
+    expected = 1
+    start = number = style = None
+    for match in QUESTION_MARKER.finditer(text):
+        found = int(match.group(1) or match.group(2))
+        found_style = 1 if match.group(1) else 2
+        if found != expected or style not in (None, found_style):
+            continue
+        style = found_style
+        if number is not None:
+            segments[number] = text[start:match.start()].strip()
+        number, start, expected = found, match.end(), found + 1
+    if number is not None:
+        segments[number] = text[start:].strip()
+    return segments
+
+
+def parse_marks(text):
+    """Return the marks printed in a question's text, or None"""
+    match = MARKS_PATTERN.search(text)
+    return float(match.group(1)) if match else None
+
+
+def build_answer_key_questions(answer_key_text, question_text, total_marks):
+    """Segment an answer key, and the question paper when there is one, into a list of questions
+
+    Each question is a dict with its number, question text, model answer and
+    marks. Marks printed on the paper (or key) are scaled to total_marks;
+    without them total_marks is split evenly. Marks are rounded to two decimals
+    and still add up to total_marks. Returns [] when the key isn't
+    numbered into at least two questions.
+    """
+    answers = segment_questions(answer_key_text)
+    if len(answers) < 2:
+        return []
+    questions = segment_questions(question_text) if question_text else {}
+
+    items = []
+    for number, answer in answers.items():
+        question = questions.get(number, '')
+        items.append({
+            'number': number,
+            'question': question,
+            'answer': answer,
+            'marks': parse_marks(question) or parse_marks(answer.split('\n', 1)[0]),
+        })
+
+    printed = [item['marks'] for item in items]
+    weights = printed if all(printed) else [1] * len(items)
+    for item, weight in zip(items, weights):
+        item['marks'] = round(total_marks * weight / sum(weights), 2)
+    # The rounding remainder goes to the last question, so the marks add up to total_marks
+    items[-1]['marks'] = round(total_marks - sum(item['marks'] for item in items[:-1]), 2)
+    return items
+
+
+def align_answers(questions, student_text, min_aligned=0.5):
+    """Return {question number: the student's answer to it}, or None when the text can't be aligned
+
+    Alignment uses the student's own question numbering; it fails when fewer
+    than min_aligned of the answer key's questions are found. Questions the
+    student skipped map to ''.
+    """
+    answers = segment_questions(student_text)
+    numbers = [question['number'] for question in questions]
+    found = sum(1 for number in numbers if answers.get(number))
+    if not numbers or found < len(numbers) * min_aligned:
+        return None
+    return {number: answers.get(number, '') for number in numbers}
+
+
+def normalize_answer(text):
+    """Reduce an answer to a canonical form for spotting identical answers
+
+    Case, whitespace (also around operators and brackets) and punctuation are dropped,
+    thousands separators and redundant zeros removed from numbers ("1,000.50" -> "1000.5")
+    and unit spellings mapped to symbols ("5 Metres" -> "5 m"). Brackets are kept,
+    since they change the meaning of maths: (a+b)/c is not a+b/c.
+    """
+    text = unicodedata.normalize('NFKC', text).lower()
+    text = re.sub(r'(?<=\d),(?=\d{3}\b)', '', text)
+    text = re.sub(r'(\d)\s*(%|°)', r'\1 \2', text)
+    text = re.sub(r'(\d)([a-z]+)\b', r'\1 \2', text)
+    text = re.sub(r'[,;:!?"\'`]', ' ', text)
+    text = re.sub(r'([=+*/<>^()\[\]{}])', r' \1 ', text)
+    text = NUMBER.sub(_normalize_number, text)
+    words = (UNIT_ALIASES.get(word, word) for word in text.split())
+    return ' '.join(words).strip(' .')
+
+
+def _normalize_number(match):
+    return format(Decimal(match.group()).normalize(), 'f')
@@ -0,0 +1,157 @@
+import time
+import threading
+from functools import lru_cache
+import redis
+from celery.utils.log import get_task_logger
+from django.conf import settings
+
+logger = get_task_logger(__name__)
+
+# Refill every bucket atomically from the Redis clock, then take the costs only if every bucket can pay.
+# KEYS: one hash per limit. ARGV: force flag, then capacity, refill per second and cost for each key.
+# Returns the seconds until all costs fit (as a string, Redis truncates Lua numbers), "0" when taken.
+TOKEN_BUCKET_SCRIPT = """
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local force = ARGV[1] == '1'
+local wait = 0
+local levels = {}
+for i, key in ipairs(KEYS) do
+    local capacity = tonumber(ARGV[i * 3 - 1])
+    local rate = tonumber(ARGV[i * 3])
+    local cost = tonumber(ARGV[i * 3 + 1])
+    local state = redis.call('HMGET', key, 'level', 'ts')
+    local level = tonumber(state[1]) or capacity
+    local ts = tonumber(state[2]) or now
+    level = math.min(capacity, level + math.max(0, now - ts) * rate)
+    levels[i] = level
+    if level < cost then
+        wait = math.max(wait, (cost - level) / rate)
+    end
+end
+if wait == 0 or force then
+    for i, key in ipairs(KEYS) do
+        local capacity = tonumber(ARGV[i * 3 - 1])
+        local rate = tonumber(ARGV[i * 3])
+        redis.call('HSET', key, 'level', levels[i] - tonumber(ARGV[i * 3 + 1]), 'ts', now)
+        redis.call('EXPIRE', key, math.ceil(capacity / rate) + 60)
+    end
+    return '0'
+end
+return tostring(wait)
+"""
+
+
+class RateLimited(Exception):
+    """The LLM budget can't cover a request within the allowed wait"""
+
+    def __init__(self, wait):
+        super().__init__(f"LLM rate limit reached, budget frees up in {wait:.1f}s")
+        self.wait = wait
+
+
+class TokenBucketLimiter:
+    """Base class for requests-per-minute and tokens-per-minute budgets on LLM calls
+
+    Each limit is a token bucket refilled at its per-minute budget / 60 every
+    second and holding at most settings.LLM_RATE_LIMIT_BURST_SECONDS of budget,
+    so calls are spread steadily near the quota instead of bursting into it.
+    """
+
+    def __init__(self, requests_per_minute, tokens_per_minute):
+        self.limits = {}
+        for name, per_minute in (('requests', requests_per_minute), ('tokens', tokens_per_minute)):
+            if per_minute:
+                rate = per_minute / 60
+                self.limits[name] = (max(1, rate * settings.LLM_RATE_LIMIT_BURST_SECONDS), rate)
+
+    def take(self, costs, force=False):
+        """Take costs ({limit: amount}) from the buckets, returning 0 or the seconds until they fit
+
+        With force the costs are taken regardless, leaving buckets in debt.
+        """
+        raise NotImplementedError
+
+    def acquire(self, tokens, max_wait=None):
+        """Take one request and tokens from the budget, sleeping up to max_wait seconds (None: no limit)
+
+        Returns the tokens charged, which is capped at the bucket size so an
+        oversized prompt can still go through; raises RateLimited when max_wait
+        runs out first.
+        """
+        costs = {'requests': 1, 'tokens': tokens}
+        costs = {name: min(costs[name], capacity) for name, (capacity, rate) in self.limits.items()}
+        if not costs:
+            return tokens
+        deadline = None if max_wait is None else time.monotonic() + max_wait
+        while True:
+            wait = self.take(costs)
+            if wait <= 0:
+                return costs.get('tokens', tokens)
+            if deadline is not None and time.monotonic() + wait > deadline:
+                raise RateLimited(wait)
+            time.sleep(wait)
+
+    def debit(self, tokens):
+        """Charge tokens used beyond what acquire() charged, e.g. once the real usage is known"""
+        if tokens > 0 and 'tokens' in self.limits:
+            self.take({'tokens': tokens}, force=True)
+
+
+class LocalRateLimiter(TokenBucketLimiter):
+    """Buckets in this process's memory, for tests and single-process development"""
+
+    def __init__(self, requests_per_minute, tokens_per_minute):
+        super().__init__(requests_per_minute, tokens_per_minute)
+        self._levels = {name: capacity for name, (capacity, rate) in self.limits.items()}
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def take(self, costs, force=False):
+        with self._lock:
+            now = time.monotonic()
+            elapsed, self._updated = now - self._updated, now
+            wait = 0
+            for name, cost in costs.items():
+                capacity, rate = self.limits[name]
+                self._levels[name] = min(capacity, self._levels[name] + elapsed * rate)
+                if self._levels[name] < cost:
+                    wait = max(wait, (cost - self._levels[name]) / rate)
+            if wait and not force:
+                return wait
+            for name, cost in costs.items():
+                self._levels[name] -= cost
+            return 0
+
+
+class RedisRateLimiter(TokenBucketLimiter):
+    """Buckets in Redis, shared by every worker process in the cluster"""
+
+    def __init__(self, requests_per_minute, tokens_per_minute, url, prefix='llm-ratelimit'):
+        super().__init__(requests_per_minute, tokens_per_minute)
+        self.prefix = prefix
+        self.client = redis.Redis.from_url(url)
+        self.script = self.client.register_script(TOKEN_BUCKET_SCRIPT)
+
+    def take(self, costs, force=False):
+        keys, args = [], ['1' if force else '0']
+        for name, cost in costs.items():
+            capacity, rate = self.limits[name]
+            keys.append(f'{self.prefix}:{name}')
+            args += [capacity, rate, cost]
+        try:
+            return float(self.script(keys=keys, args=args))
+        except redis.RedisError as e:
+            # Without Redis the broker is down too, so don't hold up the few calls that can still run
+            logger.warning(f"Rate limiter unavailable, not limiting this call: {e}")
+            return 0
+
+
+@lru_cache(maxsize=None)
+def get_rate_limiter():
+    """Return this process's LLM rate limiter, chosen by settings.LLM_RATE_LIMIT_BACKEND"""
+    rpm = settings.GEMINI_REQUESTS_PER_MINUTE
+    tpm = settings.GEMINI_TOKENS_PER_MINUTE
+    if settings.LLM_RATE_LIMIT_BACKEND == 'memory':
+        return LocalRateLimiter(rpm, tpm)
+    return RedisRateLimiter(rpm, tpm, settings.LLM_RATE_LIMIT_REDIS_URL)
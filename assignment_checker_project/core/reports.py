@@ -0,0 +1,64 @@
+import csv
+import io
+import tempfile
+from openpyxl import Workbook
+from .models import Submission
+
+REPORT_HEADER = ['Name', 'Regd No', 'Secured Mark', 'Total Mark']
+XLSX_CONTENT_TYPE = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+# Rows fetched per database round trip, and sent per chunk of a streamed CSV
+REPORT_CHUNK_ROWS = 1000
+# Spreadsheet apps treat text starting with these as a formula
+FORMULA_PREFIXES = ('=', '+', '-', '@', '\t', '\r')
+
+
+def report_rows(assignment):
+    """Yield an assignment's report rows, streamed from a single query without loading model instances"""
+    submissions = (
+        Submission.objects
+        .filter(assignment=assignment)
+        .order_by('submission_date', 'id')
+        .values_list('student__first_name', 'student__last_name', 'student__username', 'student__regdno', 'score')
+    )
+    total_marks = assignment.total_marks
+    for first_name, last_name, username, regdno, score in submissions.iterator(chunk_size=REPORT_CHUNK_ROWS):
+        # What User.get_full_name() returns, falling back to the username
+        name = f'{first_name} {last_name}'.strip() or username
+        score = score if score is not None else 'Pending'
+        yield [spreadsheet_text(name), spreadsheet_text(regdno or 'N/A'), score, total_marks]
+
+
+def spreadsheet_text(text):
+    """Quote text a student typed so Excel or Sheets shows it rather than running it as a formula"""
+    return f"'{text}" if text.startswith(FORMULA_PREFIXES) else text
+
+
+def csv_chunks(rows):
+    """Encode the header and rows as CSV, yielding the header at once and then every REPORT_CHUNK_ROWS rows"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(REPORT_HEADER)
+    for count, row in enumerate(rows):
+        if count % REPORT_CHUNK_ROWS == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+        writer.writerow(row)
+    yield buffer.getvalue()
+
+
+def write_xlsx(rows):
+    """Write the header and rows to an anonymous temporary XLSX file, returned open at its start
+
+    openpyxl's write-only workbook streams each row to disk instead of keeping
+    a cell object per value, so memory doesn't grow with the number of rows.
+    """
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet('Sheet1')
+    sheet.append(REPORT_HEADER)
+    for row in rows:
+        sheet.append(row)
+    file = tempfile.TemporaryFile()
+    workbook.save(file)
+    file.seek(0)
+    return file
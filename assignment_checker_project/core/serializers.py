@@ -25,9 +25,14 @@ class ClassroomSerializer(serializers.ModelSerializer):
         read_only_fields = ['id', 'code', 'created_at']
 
     def get_student_count(self, obj):
+        # Annotated by ClassroomViewSet, only queried for a classroom loaded elsewhere
+        if hasattr(obj, 'student_count'):
+            return obj.student_count
         return obj.students.count()
 
     def get_assignment_count(self, obj):
+        if hasattr(obj, 'assignment_count'):
+            return obj.assignment_count
         return obj.assignments.count()
 
     def create(self, validated_data):
@@ -74,6 +79,9 @@ class AssignmentSerializer(serializers.ModelSerializer):
         read_only_fields = ['id', 'created_at']
 
     def get_submitted_students_count(self, obj):
+        # Annotated by AssignmentViewSet, only queried for an assignment loaded elsewhere
+        if hasattr(obj, 'submitted_students_count'):
+            return obj.submitted_students_count
         return obj.submissions.count()
 
     def __init__(self, *args, **kwargs):
@@ -86,26 +94,44 @@ class AssignmentSerializer(serializers.ModelSerializer):
     def create(self, validated_data):
         # Set the teacher to the current user
         validated_data['teacher'] = self.context['request'].user
-        return super().create(validated_data)
+        assignment = super().create(validated_data)
+        # Extract and segment the answer key once so grading doesn't redo it per submission
+        from .tasks import extract_answer_key
+        extract_answer_key.delay(assignment.id)
+        return assignment
+
+    def update(self, instance, validated_data):
+        assignment = super().update(instance, validated_data)
+        if {'correct_answer_file', 'question_file', 'total_marks'} & validated_data.keys():
+            from .tasks import extract_answer_key
+            extract_answer_key.delay(assignment.id)
+        return assignment
 
 
 class SubmissionSerializer(serializers.ModelSerializer):
     """Serializer for the Submission model"""
     student = UserSerializer(read_only=True)
     assignment = serializers.PrimaryKeyRelatedField(queryset=Assignment.objects.all())
+    grading_details = serializers.SerializerMethodField()
 
     class Meta:
         model = Submission
-        fields = ['id', 'assignment', 'student', 'submission_file', 'submission_date', 'score', 'plagiarism_report']
-        read_only_fields = ['id', 'submission_date', 'score', 'plagiarism_report']
+        fields = ['id', 'assignment', 'student', 'submission_file', 'submission_date', 'status', 'score', 'grading_details', 'plagiarism_report']
+        read_only_fields = ['id', 'submission_date', 'status', 'score', 'plagiarism_report']
+
+    def get_grading_details(self, obj):
+        # Questions come from question_grades, prefetched by SubmissionViewSet
+        return obj.grading_result()
 
     def create(self, validated_data):
+        from .tasks import compute_upload_hash, queue_grading, reuse_previous_grade
         # Set the student to the current user
         validated_data['student'] = self.context['request'].user
+        validated_data['content_hash'] = compute_upload_hash(validated_data['submission_file'])
         submission = super().create(validated_data)
-        # Trigger grading task
-        from .tasks import grade_submission
-        grade_submission.delay(submission.id)
+        # Trigger grading task unless an identical upload has already been graded
+        if not reuse_previous_grade(submission):
+            queue_grading(submission.id)
         return submission
 
 
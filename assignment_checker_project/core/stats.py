@@ -0,0 +1,170 @@
+import math
+from django.db import transaction
+from django.db.models import Count, Sum
+from .models import AssignmentStats, Submission
+
+# Equal slices of the total marks the score histogram is split into (0-10%, 10-20%, ..., 90-100%)
+HISTOGRAM_BUCKETS = 10
+
+
+def stored_grading_result(submission):
+    """Return a saved submission's grading result, {} when it has none"""
+    return submission.grading_result() or {}
+
+
+def counts_in_stats(submission, result):
+    """Whether a grade is counted: grading finished without falling back to a placeholder result"""
+    return submission.score is not None and bool(result) and 'error' not in result
+
+
+def record_grade(assignment, submission, result):
+    """Count a newly saved grade in the assignment's stats in place of the student's previous one
+
+    Call it in the transaction that saves the grade. Only each student's latest
+    submission is counted, so a resubmission supersedes the earlier grade, and an
+    older submission graded late doesn't displace a newer one.
+    """
+    if not counts_in_stats(submission, result):
+        return
+    stats = locked_stats(assignment)
+    counted = Submission.objects.filter(assignment=assignment, student_id=submission.student_id, in_stats=True).first()
+    if counted is not None:
+        if counted.id == submission.id or (counted.submission_date, counted.id) > (submission.submission_date, submission.id):
+            return
+        apply_grade(stats, counted.score, stored_grading_result(counted), -1)
+        Submission.objects.filter(id=counted.id).update(in_stats=False)
+    apply_grade(stats, submission.score, result, 1)
+    Submission.objects.filter(id=submission.id).update(in_stats=True)
+    stats.save()
+
+
+def forget_grade(submission):
+    """Take a submission about to be deleted out of its assignment's stats, counting the student's previous grade again"""
+    if not submission.in_stats:
+        return
+    with transaction.atomic():
+        stats = locked_stats(submission.assignment)
+        apply_grade(stats, submission.score, stored_grading_result(submission), -1)
+        Submission.objects.filter(id=submission.id).update(in_stats=False)
+        previous = latest_grades(submission.assignment, Submission.objects.filter(student_id=submission.student_id).exclude(id=submission.id))
+        for other in previous:
+            apply_grade(stats, other.score, stored_grading_result(other), 1)
+            Submission.objects.filter(id=other.id).update(in_stats=True)
+        stats.save()
+
+
+def get_stats(assignment):
+    """Return the assignment's stats, building them from its existing grades the first time"""
+    try:
+        return AssignmentStats.objects.select_related('assignment__classroom').get(assignment=assignment)
+    except AssignmentStats.DoesNotExist:
+        with transaction.atomic():
+            return locked_stats(assignment)
+
+
+def locked_stats(assignment):
+    """Return the assignment's stats row locked for update, inside a transaction
+
+    An assignment graded before stats existed has them built from its grades first.
+    """
+    stats, created = AssignmentStats.objects.get_or_create(
+        assignment=assignment, defaults={'histogram': [0] * HISTOGRAM_BUCKETS}
+    )
+    stats = AssignmentStats.objects.select_for_update().select_related('assignment').get(id=stats.id)
+    if created:
+        Submission.objects.filter(assignment=assignment, in_stats=True).update(in_stats=False)
+        counted = latest_grades(assignment, Submission.objects.all())
+        for submission in counted:
+            apply_grade(stats, submission.score, stored_grading_result(submission), 1)
+        Submission.objects.filter(id__in=[s.id for s in counted]).update(in_stats=True)
+        stats.save()
+    return stats
+
+
+def latest_grades(assignment, submissions):
+    """Return the latest counted grade of each student among submissions to the assignment"""
+    latest = {}
+    graded = submissions.filter(assignment=assignment, status='completed').order_by('submission_date', 'id')
+    for submission in graded.prefetch_related('question_grades').iterator(chunk_size=500):
+        if counts_in_stats(submission, stored_grading_result(submission)):
+            latest[submission.student_id] = submission
+    return list(latest.values())
+
+
+def apply_grade(stats, score, result, sign):
+    """Add (sign 1) or subtract (sign -1) one grade to the running totals"""
+    stats.graded_count += sign
+    stats.score_sum += sign * score
+    stats.score_sum_squares += sign * score * score
+
+    total_marks = result.get('total_marks_allocated') or stats.assignment.total_marks
+    histogram = stats.histogram or [0] * HISTOGRAM_BUCKETS
+    bucket = min(int(score / total_marks * HISTOGRAM_BUCKETS), HISTOGRAM_BUCKETS - 1) if total_marks else 0
+    histogram[max(bucket, 0)] += sign
+    stats.histogram = histogram
+
+    for question in result.get('questions', []):
+        try:
+            marks = float(question.get('marks_achieved', 0))
+        except (TypeError, ValueError):
+            continue
+        number = str(question.get('question_number'))
+        totals = stats.question_totals.setdefault(
+            number, {'count': 0, 'marks_sum': 0, 'marks_allocated': question.get('marks_allocated')}
+        )
+        totals['count'] += sign
+        totals['marks_sum'] += sign * marks
+        if totals['count'] <= 0:
+            del stats.question_totals[number]
+
+
+def summarize_stats(stats):
+    """Mean, median, spread, histogram and per-question averages from the running totals, in O(1)
+
+    The median is interpolated within its histogram bucket, so it is exact
+    to within a tenth of the total marks.
+    """
+    total_marks = stats.assignment.total_marks
+    graded = stats.graded_count
+    mean = stats.score_sum / graded if graded else None
+    histogram = stats.histogram or [0] * HISTOGRAM_BUCKETS
+    width = total_marks / HISTOGRAM_BUCKETS
+
+    median = None
+    below = 0
+    for i, count in enumerate(histogram):
+        if count and below + count >= graded / 2:
+            median = round(width * (i + (graded / 2 - below) / count), 2)
+            break
+        below += count
+
+    questions = []
+    for number, totals in sorted(stats.question_totals.items(), key=lambda item: int(item[0]) if item[0].isdigit() else math.inf):
+        questions.append({
+            'question_number': int(number) if number.isdigit() else number,
+            'marks_allocated': totals['marks_allocated'],
+            'average': round(totals['marks_sum'] / totals['count'], 2),
+            'graded': totals['count'],
+        })
+
+    return {
+        'total_marks': total_marks,
+        'students': stats.assignment.classroom.students.count(),
+        'graded': graded,
+        'mean': round(mean, 2) if graded else None,
+        'median': median,
+        'std_dev': round(math.sqrt(max(stats.score_sum_squares / graded - mean ** 2, 0)), 2) if graded else None,
+        'histogram': [
+            {'from': round(width * i, 2), 'to': round(width * (i + 1), 2), 'count': count}
+            for i, count in enumerate(histogram)
+        ],
+        'questions': questions,
+    }
+
+
+def answer_memo_stats(assignment):
+    """Return the answer memo's entries, hits and hit rate for an assignment (each entry was one Gemini-graded miss)"""
+    stats = assignment.answer_memos.aggregate(entries=Count('id'), hits=Sum('hits'))
+    hits = stats['hits'] or 0
+    lookups = hits + stats['entries']
+    return {'entries': stats['entries'], 'hits': hits, 'hit_rate': round(hits / lookups, 3) if lookups else 0.0}
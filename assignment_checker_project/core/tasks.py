@@ -1,108 +1,748 @@
 import os
 import json
+import hashlib
+import random
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import ExitStack, closing, contextmanager
+from dataclasses import dataclass, field
+from datetime import timedelta
 import fitz
-import pytesseract
-from PIL import Image
-from celery import shared_task
+from celery import chain, shared_task
+from celery.exceptions import Retry
+from celery.signals import worker_process_init, worker_process_shutdown
 from celery.utils.log import get_task_logger
+from celery.utils.time import get_exponential_backoff_interval
 from django.conf import settings
-from .models import Submission, Assignment
-import google.generativeai as genai
-from dotenv import load_dotenv
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+from google.api_core import exceptions as google_exceptions
+from .models import Submission, Assignment, GradingArtifact, AnswerMemo, QuestionGrade
+from .llm import (
+    create_context_cache,
+    delete_context_cache,
+    discard_cached_response,
+    estimate_tokens,
+    extend_context_cache,
+    generate_text,
+    get_gemini_model,
+)
+from .math_grading import (  # The grading helpers below are also imported from here by callers and tests
+    MIN_WORKED_STEPS,
+    evaluate_stepwise_math,
+    grade_math,
+    grade_math_assignment,
+    is_math_assignment,
+    parse_steps,
+    partial_credit_numeric,
+)
+from .plagiarism import check_submission, index_duplicate
+from .stats import record_grade, stored_grading_result
+from .events import publish_event, user_channel
+from .questions import align_answers, build_answer_key_questions, normalize_answer
+from .ratelimit import RateLimited
+from .ocr import MIN_OCR_REGION_POINTS, OCR_LAYER_MIN_COVERAGE, PageImage, get_ocr_backend, recognize_image, render_page_for_ocr
 
 logger = get_task_logger(__name__)
 
-# Load environment variables from .env file (important for Celery workers)
-load_dotenv()
+# Gemini model used for grading, and a version to bump whenever the grading prompt changes
+# so that grades produced under the old prompt are no longer reused for duplicate uploads
+GEMINI_MODEL = "gemini-1.5-flash"
+GRADING_PROMPT_VERSION = 3
+# Bumped whenever core.questions changes how answer keys are split into questions or marks,
+# so that assignments segmented before are segmented again
+SEGMENTATION_VERSION = 2
+
+# Gemini errors worth retrying: timeouts, rate limits/quota and server-side failures
+TRANSIENT_LLM_ERRORS = (
+    google_exceptions.DeadlineExceeded,
+    google_exceptions.ResourceExhausted,
+    google_exceptions.TooManyRequests,
+    google_exceptions.ServiceUnavailable,
+    google_exceptions.InternalServerError,
+    google_exceptions.GatewayTimeout,
+    ConnectionError,
+    TimeoutError,
+)
+
+# Block type of text (as opposed to image) blocks in fitz's page.get_text("blocks")
+TEXT_BLOCK = 0
+
+
+@worker_process_init.connect
+def warm_ocr_backend(**kwargs):
+    """Start the OCR engine when a worker process boots rather than on its first page"""
+    get_ocr_backend().warm_up()
+
+
+@worker_process_init.connect
+def warm_gemini_client(**kwargs):
+    """Create the worker process's Gemini client once, after the fork"""
+    if settings.GOOGLE_API_KEY:
+        get_gemini_model(GEMINI_MODEL)
+
+
+@worker_process_shutdown.connect
+def close_ocr_backend(**kwargs):
+    get_ocr_backend().close()
+
+
+def queue_grading(submission_id):
+    """Queue the extract -> grade -> persist pipeline for a submission
+
+    Each stage is routed to its own queue (see CELERY_TASK_ROUTES) so CPU-bound
+    extraction and network-bound Gemini calls run on pools sized for them, and
+    stages only pass the submission id, keeping text out of the broker.
+
+    Every stage checkpoints its output on the submission's GradingArtifact and
+    skips work that is already checkpointed, so re-queueing a failed submission
+    or a duplicate delivery resumes from the last finished stage.
+    """
+    return chain(
+        extract_submission.s(submission_id),
+        grade_extracted_submission.s(),
+        persist_grading_result.s(),
+    ).apply_async()
 
-# Configure Gemini once (API key from .env or settings)
-api_key = os.getenv("GOOGLE_API_KEY")
-if not api_key:
-    logger.error("GOOGLE_API_KEY environment variable is not set. Please set it in your .env file.")
-    raise ValueError("GOOGLE_API_KEY environment variable is required for Gemini integration")
-genai.configure(api_key=api_key)
 
 @shared_task
 def grade_submission(submission_id):
-    """Background task to grade a submission using Gemini 1.5 Flash"""
-    # Ensure environment variables are loaded in the Celery worker process
-    load_dotenv()
-    
-    # Reconfigure Gemini with the API key (in case it wasn't loaded at module level)
-    api_key = os.getenv("GOOGLE_API_KEY")
-    if not api_key:
-        logger.error("GOOGLE_API_KEY not found in Celery worker process")
-        raise ValueError("GOOGLE_API_KEY environment variable is required for Gemini integration")
-    
-    # Reconfigure Gemini for this task
-    genai.configure(api_key=api_key)
-    logger.info(f"Gemini configured with API key: {api_key[:10]}...")
-    
-    submission = Submission.objects.get(id=submission_id)
+    """Background task to grade a submission using Gemini 1.5 Flash, running every stage in one worker"""
+    extract_submission(submission_id)
+    grade_extracted_submission(submission_id)
+    return persist_grading_result(submission_id)
+
+
+@shared_task
+def extract_submission(submission_id):
+    """Pipeline stage 1: extract the submission text and make sure the answer key is extracted"""
+    # pending/failed -> processing; a completed submission is never regraded by a duplicate delivery
+    if not Submission.objects.filter(id=submission_id).exclude(status='completed').update(status='processing'):
+        logger.info(f"Submission {submission_id} is already graded, skipping")
+        return submission_id
+    publish_status(submission_id)
+
+    submission = Submission.objects.select_related('assignment').get(id=submission_id)
+    if GradingArtifact.objects.filter(submission=submission).exclude(stage='').exists():
+        logger.info(f"Reusing extracted text of submission {submission_id}")
+        return submission_id
+
+    with grading_stage(submission, 'extracting text'):
+        extraction = extract_pdf(
+            submission.submission_file.path,
+            max_pages=settings.EXTRACTION_MAX_PAGES,
+            max_chars=settings.EXTRACTION_MAX_CHARS,
+        )
+        questions = get_answer_key_questions(submission.assignment, get_answer_key_text(submission.assignment))
+        GradingArtifact.objects.update_or_create(
+            submission=submission,
+            defaults={
+                'extracted_text': extraction.text,
+                'skipped_pages': extraction.skipped_pages,
+                'page_confidences': extraction.page_confidences,
+                'stage': GradingArtifact.STAGE_EXTRACTED,
+            },
+        )
+    try:
+        answers = align_answers(questions, extraction.text, settings.GRADING_MIN_ALIGNED) if questions else None
+        check_submission(submission, extraction.text, answers)
+    except Exception as e:
+        # The plagiarism report is advisory, grading goes ahead without it
+        logger.error(f"Could not check submission {submission_id} for plagiarism: {e}")
+    return submission_id
+
+
+@shared_task(bind=True, max_retries=settings.GRADING_MAX_RETRIES)
+def grade_extracted_submission(self, submission_id):
+    """Pipeline stage 2: grade the extracted text with Gemini
+
+    The prompt and Gemini's raw response are checkpointed before parsing, and
+    transient API errors (timeouts, quota, 5xx) are retried with exponential
+    backoff instead of failing the submission.
+    """
+    submission = Submission.objects.select_related('assignment', 'grading_artifact').get(id=submission_id)
     assignment = submission.assignment
+    artifact = submission.grading_artifact
+    if submission.status == 'completed' or artifact.stage == GradingArtifact.STAGE_GRADED:
+        return submission_id
+
+    with grading_stage(submission, 'grading'):
+        answer_text = get_answer_key_text(assignment)
+        questions = get_answer_key_questions(assignment, answer_text)
+        if (not artifact.prompt or artifact.answer_key_hash != assignment.answer_key_hash
+                or artifact.questions_hash != assignment.answer_key_questions_hash):
+            # First attempt, or the answer key, question paper or total marks changed since the checkpoint
+            artifact.prompt = build_grading_prompt(answer_text, artifact.extracted_text, assignment.total_marks)
+            artifact.model = artifact.cached_content = artifact.raw_response = ''
+            artifact.question_responses = {}
+            artifact.answer_key_hash = assignment.answer_key_hash
+            artifact.questions_hash = assignment.answer_key_questions_hash
+            artifact.save(update_fields=[
+                'prompt', 'model', 'cached_content', 'raw_response', 'question_responses', 'answer_key_hash', 'questions_hash',
+                'updated_at',
+            ])
+
+        student_answers = None
+        if questions:
+            student_answers = align_answers(questions, artifact.extracted_text, settings.GRADING_MIN_ALIGNED)
+        local_grade = None
+        if student_answers is None:
+            local_grade = grade_math_locally(answer_text, artifact.extracted_text, assignment.total_marks)
+
+        if not answer_text.strip() or not artifact.extracted_text.strip():
+            grading_result = grade_with_gemini(answer_text, artifact.extracted_text, assignment.total_marks)
+        elif local_grade is not None:
+            logger.info(f"Graded submission {submission_id} with the local math grader")
+            grading_result = {
+                "questions": [{
+                    "question_number": 1,
+                    "question_text": "Question 1",
+                    "marks_allocated": assignment.total_marks,
+                    "marks_achieved": local_grade.score,
+                    "feedback": local_grade.feedback,
+                }],
+                "total_marks_allocated": assignment.total_marks,
+                "total_score": local_grade.score,
+                "overall_feedback": local_grade.feedback,
+            }
+        else:
+            # A response checkpointed by an earlier run was answered to the request recorded with it
+            request = GeminiRequest(artifact.prompt, artifact.model or GEMINI_MODEL, artifact.cached_content or None)
+            # Inline runs (grade_submission) wait for budget, queued runs give the worker back instead
+            max_wait = None if self.request.called_directly else settings.LLM_RATE_LIMIT_MAX_WAIT
+            try:
+                if student_answers is not None:
+                    request_question_grades(assignment, artifact, questions, student_answers, max_wait)
+                elif not artifact.raw_response:
+                    request = grading_request(assignment, answer_text, artifact)
+                    artifact.raw_response = request_gemini(
+                        request.prompt, max_wait=max_wait, model=request.model, cached_content=request.cached_content
+                    )
+                    artifact.prompt, artifact.model = request.prompt, request.model
+                    artifact.cached_content = request.cached_content or ''
+                    artifact.save(update_fields=['prompt', 'model', 'cached_content', 'raw_response', 'updated_at'])
+            except RateLimited as e:
+                countdown = e.wait + random.uniform(0, settings.LLM_RATE_LIMIT_MAX_WAIT)
+                logger.info(f"Gemini budget exhausted, re-queueing submission {submission_id} in {countdown:.1f}s")
+                raise requeue(self, countdown)
+            except TRANSIENT_LLM_ERRORS as e:
+                countdown = get_exponential_backoff_interval(
+                    settings.GRADING_RETRY_BACKOFF, self.request.retries, settings.GRADING_RETRY_BACKOFF_MAX, True
+                )
+                logger.warning(f"Transient Gemini error for submission {submission_id}, retrying in {countdown}s: {e}")
+                raise self.retry(exc=e, countdown=countdown)
+
+            if student_answers is not None:
+                grading_result = merge_question_grades(questions, student_answers, artifact.question_responses, assignment.total_marks)
+                remember_answer_grades(assignment, questions, student_answers, artifact.question_responses)
+            else:
+                try:
+                    grading_result = parse_grading_response(artifact.raw_response, assignment.total_marks)
+                except Exception as e:
+                    logger.error(f"Error in Gemini grading: {e}")
+                    # Don't hand the same unparseable response to the next identical prompt
+                    discard_cached_response(request.model, request.prompt, cached_content=request.cached_content)
+                    grading_result = grading_error(assignment.total_marks, f"Error in grading: {str(e)}", str(e))
+
+        if artifact.skipped_pages:
+            grading_result['skipped_pages'] = artifact.skipped_pages
+        artifact.grading_result = grading_result
+        artifact.stage = GradingArtifact.STAGE_GRADED
+        artifact.save(update_fields=['grading_result', 'stage', 'updated_at'])
+    return submission_id
+
+
+@shared_task
+def persist_grading_result(submission_id):
+    """Pipeline stage 3: write the grade onto the submission (processing -> completed)"""
+    submission = Submission.objects.select_related('assignment').get(id=submission_id)
+    assignment = submission.assignment
+    with grading_stage(submission, 'saving the grade'):
+        with transaction.atomic():
+            # Lock the row so duplicate deliveries can't both complete the submission
+            submission = Submission.objects.select_for_update().get(id=submission_id)
+            if submission.status == 'completed':
+                return submission.grading_result()
+            artifact = GradingArtifact.objects.get(submission=submission)
+            grading_result = artifact.grading_result
+            submission.score = min(grading_result['total_score'], assignment.total_marks)
+            # The questions go to their own table, grading_details keeps the totals and overall feedback
+            submission.grading_details = {key: value for key, value in grading_result.items() if key != 'questions'}
+            submission.status = 'completed'
+            if 'error' not in grading_result:
+                submission.grading_key = grading_signature(artifact.answer_key_hash, artifact.questions_hash, assignment.total_marks)
+            submission.save()
+            QuestionGrade.objects.filter(submission=submission).delete()
+            QuestionGrade.objects.bulk_create(QuestionGrade.from_result(submission, grading_result))
+            record_grade(assignment, submission, grading_result)
+            transaction.on_commit(lambda: publish_status(submission_id))
+
+    logger.info(f"Grading completed for submission {submission_id}")
+    logger.debug(f"Detailed breakdown: {grading_result}")
+    return grading_result
+
+
+def requeue(task, countdown):
+    """Send the running task again after countdown seconds without using up one of its retries"""
+    task.signature_from_request(countdown=countdown).apply_async()
+    return Retry(when=countdown)
+
+
+@contextmanager
+def grading_stage(submission, stage):
+    """Mark the submission failed if a pipeline stage raises, other than to retry"""
     try:
-        submission_text = extract_text_from_pdf(submission.submission_file.path)
-        answer_text = extract_text_from_pdf(assignment.correct_answer_file.path)
-        grading_result = grade_with_gemini(answer_text, submission_text, assignment.total_marks)
-
-        submission.score = min(grading_result['total_score'], assignment.total_marks)
-        submission.grading_details = json.dumps(grading_result)
-        submission.status = 'completed'
-        submission.save()
-
-        logger.info(f"Grading completed for submission {submission_id}")
-        logger.debug(f"Detailed breakdown: {grading_result}")
-        return grading_result
+        yield
+    except Retry:
+        raise
     except Exception as e:
-        logger.error(f"Error grading submission {submission_id}: {e}")
-        submission.status = 'failed'
-        submission.save()
+        logger.error(f"Error {stage} for submission {submission.id}: {e}")
+        if Submission.objects.filter(id=submission.id).exclude(status='completed').update(status='failed'):
+            publish_status(submission.id)
         raise
 
-def extract_text_from_pdf(file_path):
-    """Extract text from PDF, handling typed and handwritten content"""
+
+def publish_status(submission_id):
+    """Push the submission's status and score to its student and the assignment's teacher"""
+    try:
+        row = (
+            Submission.objects
+            .filter(id=submission_id)
+            .values('id', 'assignment_id', 'assignment__teacher_id', 'student_id', 'status', 'score')
+            .get()
+        )
+        event = {'id': row['id'], 'assignment': row['assignment_id'], 'status': row['status'], 'score': row['score']}
+        channels = {user_channel(row['student_id']), user_channel(row['assignment__teacher_id'])}
+        publish_event(channels, 'submission', event)
+    except Exception as e:
+        # Live updates are a convenience, the status is saved either way
+        logger.warning(f"Could not publish the status of submission {submission_id}: {e}")
+
+
+@shared_task
+def extract_answer_key(assignment_id):
+    """Background task to extract, segment and cache the answer key of an assignment"""
+    assignment = Assignment.objects.get(id=assignment_id)
+    get_answer_key_questions(assignment, get_answer_key_text(assignment))
+
+
+def get_answer_key_text(assignment):
+    """Return the answer key text, extracting it only when correct_answer_file has changed"""
+    file_hash = compute_file_hash(assignment.correct_answer_file.path)
+    if assignment.answer_key_hash == file_hash:
+        return assignment.answer_key_text
+
+    logger.info(f"Extracting answer key for assignment {assignment.id}")
+    assignment.answer_key_text = extract_text_from_pdf(assignment.correct_answer_file.path)
+    assignment.answer_key_hash = file_hash
+    update_fields = ['answer_key_text', 'answer_key_hash']
+    if assignment.answer_key_context_name:
+        # The cached context holds the previous answer key
+        delete_context_cache(assignment.answer_key_context_name)
+        assignment.answer_key_context_name = assignment.answer_key_context_hash = ''
+        assignment.answer_key_context_expires = None
+        update_fields += ['answer_key_context_name', 'answer_key_context_hash', 'answer_key_context_expires']
+    assignment.save(update_fields=update_fields)
+    return assignment.answer_key_text
+
+
+def get_answer_key_questions(assignment, answer_text):
+    """Return the answer key segmented into questions, re-segmenting when the key, question paper or marks change"""
+    signature = questions_signature(assignment, assignment.answer_key_hash)
+    if assignment.answer_key_questions_hash == signature:
+        return assignment.answer_key_questions
+
+    logger.info(f"Segmenting answer key of assignment {assignment.id} into questions")
+    question_text = extract_text_from_pdf(assignment.question_file.path) if assignment.question_file else ''
+    assignment.answer_key_questions = build_answer_key_questions(answer_text, question_text, assignment.total_marks)
+    assignment.answer_key_questions_hash = signature
+    assignment.save(update_fields=['answer_key_questions', 'answer_key_questions_hash'])
+    return assignment.answer_key_questions
+
+
+def questions_signature(assignment, answer_key_hash):
+    """Identify what the segmentation into questions depends on: answer key, question paper, total marks"""
+    question_hash = compute_file_hash(assignment.question_file.path) if assignment.question_file else ''
+    config = f"{answer_key_hash}:{question_hash}:{assignment.total_marks}:{SEGMENTATION_VERSION}"
+    return hashlib.sha256(config.encode()).hexdigest()
+
+
+def get_answer_key_context(assignment, answer_text):
+    """Return the name of the assignment's answer-key context cached on Gemini, or None to send full prompts
+
+    The context is created on first use, renewed while submissions keep using it
+    and replaced when the answer key, total marks, model or prompt change. Keys
+    shorter than Gemini's minimum cacheable size, and API failures, fall back to
+    full prompts. No lock is held during the Gemini calls, so graders racing to
+    create the context may each upload it; only the first one stored is kept.
+    """
+    model = settings.GEMINI_CONTEXT_CACHE_MODEL
+    if not model or estimate_tokens(answer_text) < settings.GEMINI_CONTEXT_CACHE_MIN_TOKENS:
+        return None
+    contents = build_grading_context(answer_text, assignment.total_marks)
+    context_hash = hashlib.sha256(f"{model}\n{contents}".encode()).hexdigest()
+    renew_by = timezone.now() + timedelta(seconds=settings.GEMINI_CONTEXT_CACHE_TTL / 2)
+
+    def is_current(a):
+        return a.answer_key_context_hash == context_hash and a.answer_key_context_expires and a.answer_key_context_expires > renew_by
+
+    if is_current(assignment):
+        return assignment.answer_key_context_name
+
+    fields = ['answer_key_context_name', 'answer_key_context_hash', 'answer_key_context_expires']
+    current = Assignment.objects.only(*fields).get(id=assignment.id)
+    if not is_current(current):
+        # The Gemini calls are made without holding a lock on the assignment; the result is
+        # only written if no other grader replaced the context meanwhile
+        name, expires = current.answer_key_context_name, None
+        try:
+            if name and current.answer_key_context_hash == context_hash:
+                try:
+                    expires = extend_context_cache(name, settings.GEMINI_CONTEXT_CACHE_TTL)
+                except google_exceptions.NotFound:
+                    logger.info(f"Cached answer key of assignment {assignment.id} expired, uploading it again")
+            if expires is None:
+                name, expires = create_context_cache(
+                    model, contents, settings.GEMINI_CONTEXT_CACHE_TTL, display_name=f'assignment-{assignment.id}'
+                )
+        except google_exceptions.GoogleAPIError as e:
+            logger.warning(f"Could not cache the answer key of assignment {assignment.id}, sending full prompts: {e}")
+            return None
+        updated = Assignment.objects.filter(
+            id=assignment.id,
+            answer_key_context_name=current.answer_key_context_name,
+            answer_key_context_hash=current.answer_key_context_hash,
+        ).update(answer_key_context_name=name, answer_key_context_hash=context_hash, answer_key_context_expires=expires)
+        if updated:
+            if current.answer_key_context_name and current.answer_key_context_name != name:
+                delete_context_cache(current.answer_key_context_name)
+            current.answer_key_context_name, current.answer_key_context_hash = name, context_hash
+            current.answer_key_context_expires = expires
+        else:
+            # Another grader stored its context first, use that one
+            if name != current.answer_key_context_name:
+                delete_context_cache(name)
+            current = Assignment.objects.only(*fields).get(id=assignment.id)
+            if current.answer_key_context_hash != context_hash:
+                return None
+
+    assignment.answer_key_context_name = current.answer_key_context_name
+    assignment.answer_key_context_hash = current.answer_key_context_hash
+    assignment.answer_key_context_expires = current.answer_key_context_expires
+    return assignment.answer_key_context_name
+
+
+def compute_file_hash(file_path, chunk_size=1024 * 1024):
+    """Return the SHA-256 hex digest of a file's contents"""
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def compute_upload_hash(uploaded_file):
+    """Return the SHA-256 hex digest of an uploaded file"""
+    digest = hashlib.sha256()
+    for chunk in uploaded_file.chunks():
+        digest.update(chunk)
+    return digest.hexdigest()
+
+
+def grading_signature(answer_key_hash, questions_hash, total_marks):
+    """Identify everything other than the submission itself that determines its grade
+
+    questions_hash is the questions_signature() the grade was made under,
+    which also covers the question paper.
+    """
+    config = f"{answer_key_hash}:{questions_hash}:{total_marks}:{GEMINI_MODEL}:{GRADING_PROMPT_VERSION}"
+    return hashlib.sha256(config.encode()).hexdigest()
+
+
+def reuse_previous_grade(submission):
+    """Copy the grade of an identical, already graded submission to the same assignment
+
+    Returns True when a grade was reused, so re-uploads and replayed uploads
+    skip extraction and the Gemini call entirely.
+    """
+    assignment = submission.assignment
+    answer_key_hash = compute_file_hash(assignment.correct_answer_file.path)
+    signature = grading_signature(answer_key_hash, questions_signature(assignment, answer_key_hash), assignment.total_marks)
+    previous = (
+        Submission.objects
+        .filter(assignment=assignment, content_hash=submission.content_hash, grading_key=signature, status='completed')
+        .exclude(id=submission.id)
+        .order_by('-submission_date')
+        .first()
+    )
+    if previous is None:
+        return False
+
+    logger.info(f"Reusing grade of submission {previous.id} for identical submission {submission.id}")
+    submission.score = previous.score
+    submission.grading_details = previous.grading_details
+    submission.grading_key = signature
+    submission.status = 'completed'
+    with transaction.atomic():
+        submission.save(update_fields=['score', 'grading_details', 'grading_key', 'status'])
+        grades = list(previous.question_grades.all())
+        for grade in grades:
+            grade.pk, grade.submission = None, submission
+        QuestionGrade.objects.bulk_create(grades)
+        record_grade(assignment, submission, stored_grading_result(previous))
+        transaction.on_commit(lambda: publish_status(submission.id))
+    try:
+        index_duplicate(submission, previous)
+    except Exception as e:
+        logger.error(f"Could not check submission {submission.id} for plagiarism: {e}")
+    return True
+
+
+def extract_text_from_pdf(file_path, max_workers=None):
+    """Extract the whole text of a PDF, handling typed and handwritten content"""
+    return extract_pdf(file_path, max_workers=max_workers).text
+
+
+@dataclass
+class ExtractionResult:
+    """Text extracted from a PDF, with the pages (0-based) that didn't make it in"""
+    text: str
+    page_count: int
+    skipped_pages: list = field(default_factory=list)
+    failed_pages: list = field(default_factory=list)
+    # {'page': n, 'confidence': 0-100} for each OCRed page whose engine reports confidence
+    page_confidences: list = field(default_factory=list)
+
+    @property
+    def truncated(self):
+        return bool(self.skipped_pages)
+
+
+def extract_pdf(file_path, max_pages=None, max_chars=None, max_workers=None):
+    """Extract text from a PDF page by page until the page or character budget is spent
+
+    None means unlimited, which answer keys and question papers rely on;
+    submissions pass settings.EXTRACTION_MAX_PAGES and EXTRACTION_MAX_CHARS.
+    Pages past the budget are never rendered or OCRed and are listed in skipped_pages.
+    """
     if not os.path.exists(file_path):
         logger.error(f"PDF file not found: {file_path}")
         raise FileNotFoundError(f"PDF file not found: {file_path}")
-    text = ""
+
+    parts = []
+    chars = 0
+    failed_pages = []
+    page_confidences = []
+    last_page = -1
     with fitz.open(file_path) as doc:
-        for page in doc:
-            page_text = page.get_text()
-            if page_text.strip():
-                text += page_text + "\n"
-            else:
-                try:
-                    pix = page.get_pixmap(matrix=fitz.Matrix(2, 2))
-                    img = Image.frombytes("RGB", [pix.width, pix.height], pix.rgb)
-                    img = img.convert("L")
-                    page_text = pytesseract.image_to_string(img, config='--psm 6')
-                    text += page_text + "\n"
-                except Exception as ocr_error:
-                    logger.warning(f"OCR failed for page {page.number} in {file_path}: {ocr_error}")
+        page_count = doc.page_count
+        page_numbers = range(page_count if max_pages is None else min(max_pages, page_count))
+        with closing(iter_pdf_pages(doc, page_numbers, max_workers=max_workers)) as pages:
+            for page_number, page in pages:
+                last_page = page_number
+                if page is None:
+                    failed_pages.append(page_number)
                     continue
-    return text.strip()
+                if page.confidence is not None:
+                    page_confidences.append({'page': page_number, 'confidence': round(page.confidence, 1)})
+                page_text = page.text
+                if max_chars is not None and chars + len(page_text) > max_chars:
+                    parts.append(page_text[:max_chars - chars])
+                    break
+                parts.append(page_text)
+                chars += len(page_text)
+
+    skipped_pages = list(range(last_page + 1, page_count))
+    if skipped_pages:
+        logger.warning(f"Extraction budget reached for {file_path}, skipped pages {skipped_pages[0]}-{skipped_pages[-1]}")
+    text = "\n".join(parts).strip()
+    return ExtractionResult(
+        text=text,
+        page_count=page_count,
+        skipped_pages=skipped_pages,
+        failed_pages=failed_pages,
+        page_confidences=page_confidences,
+    )
+
+
+@dataclass
+class PageText:
+    """Text read from one page, with the OCR confidence when any of it was OCRed"""
+    text: str
+    confidence: float = None
+
+
+def iter_pdf_pages(doc, page_numbers=None, max_workers=None):
+    """Yield (page_number, PageText) in page order, with None for pages that failed
+
+    Pages without a text layer are rendered in order and OCRed concurrently on a
+    pool of max_workers threads (settings.OCR_MAX_WORKERS by default). At most
+    2 * max_workers rendered pages are held at once, and closing the generator
+    early cancels OCR that hasn't started.
+    """
+    if page_numbers is None:
+        page_numbers = range(doc.page_count)
+    if max_workers is None:
+        max_workers = settings.OCR_MAX_WORKERS
+
+    # (page_number, result) in page order, where result is a PageText, a Future for pending OCR, or None
+    window = deque()
+    with ExitStack() as stack:
+        pool = stack.enter_context(ThreadPoolExecutor(max_workers=max_workers)) if max_workers > 1 else None
+        try:
+            for page_number in page_numbers:
+                window.append((page_number, read_page(doc[page_number], doc.name, pool)))
+                while window and (len(window) >= 2 * max_workers or _is_ready(window[0][1])):
+                    page_number, result = window.popleft()
+                    yield page_number, _resolve(result)
+            while window:
+                page_number, result = window.popleft()
+                yield page_number, _resolve(result)
+        finally:
+            for _, result in window:
+                if isinstance(result, Future):
+                    result.cancel()
+
+
+def read_page(page, file_path, pool=None):
+    """Return a page's PageText, OCRing scanned pages and image regions (on pool, as a Future, when given)
+
+    A page without a text layer is OCRed whole. On a page with one, only the
+    image regions large enough to hold an answer are rendered and OCRed, and
+    their text is merged with the native text blocks in reading order. Regions
+    already covered by native text (searchable scans) aren't OCRed again.
+    """
+    blocks = page.get_text("blocks", sort=True)
+    if not any(block_type == TEXT_BLOCK and text.strip() for *_, text, _, block_type in blocks):
+        try:
+            image = render_page_for_ocr(page)
+        except Exception as render_error:
+            logger.warning(f"OCR failed for page {page.number} in {file_path}: {render_error}")
+            return None
+        return _run(pool, ocr_page_image, image, page.number, file_path)
+
+    # Native text blocks as strings, image regions as PageImages awaiting OCR
+    parts = []
+    text_rects = [fitz.Rect(block[:4]) for block in blocks if block[6] == TEXT_BLOCK and block[4].strip()]
+    for x0, y0, x1, y1, text, _, block_type in blocks:
+        if block_type == TEXT_BLOCK:
+            parts.append(text)
+            continue
+        region = fitz.Rect(x0, y0, x1, y1) & page.rect
+        if min(region.width, region.height) < MIN_OCR_REGION_POINTS or has_text_layer(region, text_rects):
+            continue
+        try:
+            parts.append(render_page_for_ocr(page, clip=region))
+        except Exception as render_error:
+            logger.warning(f"OCR failed for an image region on page {page.number} in {file_path}: {render_error}")
+    if not any(isinstance(part, PageImage) for part in parts):
+        return PageText("".join(parts))
+    return _run(pool, ocr_page_regions, parts, page.number, file_path)
+
+
+def has_text_layer(region, text_rects):
+    """Whether the native text inside an image region spans at least OCR_LAYER_MIN_COVERAGE of it"""
+    inside = [rect & region for rect in text_rects if rect.intersects(region)]
+    if not inside:
+        return False
+    span = fitz.Rect(inside[0])
+    for rect in inside[1:]:
+        span |= rect
+    return span.get_area() >= region.get_area() * OCR_LAYER_MIN_COVERAGE
+
+
+def ocr_page_regions(parts, page_number, file_path):
+    """OCR the image regions of a mixed page and merge them with its native text in order"""
+    texts = []
+    confidences = []
+    for part in parts:
+        if isinstance(part, PageImage):
+            region = ocr_page_image(part, page_number, file_path)
+            if region is None or not region.text.strip():
+                continue
+            if region.confidence is not None:
+                confidences.append(region.confidence)
+            part = region.text.strip() + "\n"
+        texts.append(part)
+    return PageText("".join(texts), sum(confidences) / len(confidences) if confidences else None)
+
+
+def _run(pool, fn, *args):
+    return fn(*args) if pool is None else pool.submit(fn, *args)
+
 
-def grade_with_gemini(teacher_answer, student_answer, total_marks):
+def _is_ready(result):
+    return not isinstance(result, Future) or result.done()
+
+
+def _resolve(result):
+    return result.result() if isinstance(result, Future) else result
+
+
+def ocr_page_image(image, page_number, file_path):
+    """OCR a rendered page into a PageText, returning None so a failed page doesn't affect the others"""
+    try:
+        return PageText(*recognize_image(image))
+    except Exception as ocr_error:
+        logger.warning(f"OCR failed for page {page_number} in {file_path}: {ocr_error}")
+        return None
+
+
+def grade_with_gemini(teacher_answer, student_answer, total_marks, use_cache=True):
     """Grade assignment using Gemini 1.5 Flash with detailed question-wise analysis"""
     if not teacher_answer.strip() or not student_answer.strip():
-        return {
-            "questions": [],
-            "total_marks_allocated": total_marks,
-            "total_score": 0,
-            "overall_feedback": "Error: Empty teacher or student answer",
-            "error": "Empty input"
-        }
+        return grading_error(total_marks, "Error: Empty teacher or student answer", "Empty input")
     try:
-        model = genai.GenerativeModel("gemini-1.5-flash")
+        prompt = build_grading_prompt(teacher_answer, student_answer, total_marks)
+        response_text = request_gemini(prompt, use_cache=use_cache)
+        try:
+            return parse_grading_response(response_text, total_marks)
+        except Exception:
+            discard_cached_response(GEMINI_MODEL, prompt)
+            raise
+    except Exception as e:
+        logger.error(f"Error in Gemini grading: {e}")
+        return grading_error(total_marks, f"Error in grading: {str(e)}", str(e))
 
-        prompt = f"""
-        You are an expert educator grading student assignments. Analyze carefully:
 
-        TEACHER'S ANSWER KEY:
-        {teacher_answer}
+@dataclass
+class GeminiRequest:
+    """A grading call: its prompt and, when the answer key is cached on Gemini, the context it extends"""
+    prompt: str
+    model: str = GEMINI_MODEL
+    cached_content: str = None
+
+
+def grading_request(assignment, answer_text, artifact):
+    """Send only the submission when the answer key is cached on Gemini, else the checkpointed full prompt"""
+    context = get_answer_key_context(assignment, answer_text)
+    if context is None:
+        return GeminiRequest(artifact.prompt)
+    return GeminiRequest(build_submission_prompt(artifact.extracted_text), settings.GEMINI_CONTEXT_CACHE_MODEL, context)
+
+
+def build_grading_prompt(teacher_answer, student_answer, total_marks):
+    """Build the question-wise grading prompt for Gemini: the assignment's shared context, then the submission"""
+    return build_grading_context(teacher_answer, total_marks) + build_submission_prompt(student_answer)
 
+
+def build_submission_prompt(student_answer):
+    """Build the part of the grading prompt that differs between submissions"""
+    return f"""
         STUDENT'S SUBMISSION:
         {student_answer}
+        """
+
+
+def build_grading_context(teacher_answer, total_marks):
+    """Build the part of the grading prompt shared by every submission to an assignment"""
+    return f"""
+        You are an expert educator grading student assignments. Analyze carefully the student's submission
+        that follows against the answer key:
+
+        TEACHER'S ANSWER KEY:
+        {teacher_answer}
 
         TOTAL MARKS AVAILABLE: {total_marks}
 
@@ -130,27 +770,215 @@ def grade_with_gemini(teacher_answer, student_answer, total_marks):
         }}
         """
 
-        response = model.generate_content(prompt)
-        response_text = response.text.strip()
 
-        # Remove markdown fences if present
-        if response_text.startswith("```json"):
-            response_text = response_text[7:]
-        if response_text.endswith("```"):
-            response_text = response_text[:-3]
-        response_text = response_text.strip()
+def request_gemini(prompt, max_wait=None, use_cache=True, model=GEMINI_MODEL, cached_content=None):
+    """Send a prompt to Gemini and return the raw response text, raising on API errors and RateLimited"""
+    return generate_text(model, prompt, max_wait=max_wait, use_cache=use_cache, cached_content=cached_content)
 
-        result = json.loads(response_text)
-        result["total_score"] = sum(q.get("marks_achieved", 0) for q in result.get("questions", []))
-        result["total_marks_allocated"] = total_marks
-        return result
 
-    except Exception as e:
-        logger.error(f"Error in Gemini grading: {e}")
-        return {
-            "questions": [],
-            "total_marks_allocated": total_marks,
-            "total_score": 0,
-            "overall_feedback": f"Error in grading: {str(e)}",
-            "error": str(e)
+def parse_json_response(response_text):
+    """Parse a JSON response from Gemini, which may be wrapped in markdown fences"""
+    response_text = response_text.strip()
+
+    # Remove markdown fences if present
+    if response_text.startswith("```json"):
+        response_text = response_text[7:]
+    if response_text.endswith("```"):
+        response_text = response_text[:-3]
+    return json.loads(response_text.strip())
+
+
+def parse_grading_response(response_text, total_marks):
+    """Parse Gemini's JSON grading response and recompute the totals from the questions"""
+    result = parse_json_response(response_text)
+    result["total_score"] = sum(q.get("marks_achieved", 0) for q in result.get("questions", []))
+    result["total_marks_allocated"] = total_marks
+    return result
+
+
+def request_question_grades(assignment, artifact, questions, student_answers, max_wait=None):
+    """Ask Gemini for the grade of each question not yet in artifact.question_responses, concurrently
+
+    Short answers already graded for another submission are taken from the
+    answer memo, and math the local grader is confident about is graded
+    without Gemini. Responses are checkpointed as they arrive, so when one
+    question fails the retried task only asks again for the questions still
+    missing. The first error is raised once every call in flight has finished.
+    """
+    pending = [q for q in questions if str(q['number']) not in artifact.question_responses]
+    memos = recall_answer_grades(assignment, pending, student_answers)
+    for question in pending:
+        number = question['number']
+        if number in memos:
+            response = {"marks_achieved": memos[number].marks_achieved, "feedback": memos[number].feedback}
+        else:
+            local_grade = grade_math_locally(question['answer'], student_answers[number], question['marks'])
+            if local_grade is None:
+                continue
+            response = {"marks_achieved": local_grade.score, "feedback": local_grade.feedback, "graded_locally": True}
+        artifact.question_responses[str(number)] = json.dumps(response)
+    pending = [q for q in pending if str(q['number']) not in artifact.question_responses]
+    if not pending:
+        artifact.save(update_fields=['question_responses', 'updated_at'])
+        return
+    error = None
+    with ThreadPoolExecutor(max_workers=min(settings.GRADING_MAX_WORKERS, len(pending))) as pool:
+        futures = {
+            pool.submit(request_question_grade, question, student_answers[question['number']], max_wait): question
+            for question in pending
         }
+        for future in futures:
+            try:
+                artifact.question_responses[str(futures[future]['number'])] = future.result()
+            except Exception as e:
+                error = error or e
+    artifact.save(update_fields=['question_responses', 'updated_at'])
+    if error is not None:
+        raise error
+
+
+def grade_math_locally(teacher_answer, student_answer, total_marks):
+    """Grade worked math without Gemini, returning a MathGrade or None when the local grader isn't confident
+
+    Only answer keys showing at least MIN_WORKED_STEPS steps are graded here.
+    """
+    if not student_answer.strip() or len(parse_steps(teacher_answer)) < MIN_WORKED_STEPS:
+        return None
+    if not is_math_assignment(teacher_answer, student_answer):
+        return None
+    grade = grade_math(teacher_answer, student_answer, total_marks)
+    return grade if grade.confident else None
+
+
+def request_question_grade(question, student_answer, max_wait=None):
+    """Return Gemini's raw grade for one question, without a call when the student didn't answer it"""
+    if not student_answer.strip():
+        return json.dumps({"marks_achieved": 0, "feedback": "No answer was found for this question."})
+    return request_gemini(build_question_prompt(question, student_answer), max_wait=max_wait)
+
+
+def build_question_prompt(question, student_answer):
+    """Build the grading prompt for a single question"""
+    return f"""
+        You are an expert educator grading one question of a student's assignment. Analyze carefully:
+
+        QUESTION {question['number']}:
+        {question['question'] or "(see the answer key)"}
+
+        TEACHER'S ANSWER:
+        {question['answer']}
+
+        MARKS AVAILABLE: {question['marks']}
+
+        STUDENT'S ANSWER:
+        {student_answer}
+
+        Respond ONLY in JSON:
+        {{
+            "marks_achieved": <marks between 0 and {question['marks']}>,
+            "feedback": "feedback here"
+        }}
+        """
+
+
+def merge_question_grades(questions, student_answers, responses, total_marks):
+    """Combine per-question responses into the same result shape as parse_grading_response()"""
+    graded = []
+    failed = []
+    for question in questions:
+        try:
+            marks, feedback = parse_question_grade(responses[str(question['number'])], question['marks'])
+        except Exception as e:
+            logger.error(f"Error in Gemini grading of question {question['number']}: {e}")
+            discard_cached_response(GEMINI_MODEL, build_question_prompt(question, student_answers[question['number']]))
+            failed.append(question['number'])
+            marks, feedback = 0, "This question could not be graded automatically."
+        graded.append({
+            "question_number": question['number'],
+            "question_text": question['question'] or f"Question {question['number']}",
+            "marks_allocated": question['marks'],
+            "marks_achieved": marks,
+            "feedback": feedback,
+        })
+
+    total_score = round(sum(q["marks_achieved"] for q in graded), 2)
+    result = {
+        "questions": graded,
+        "total_marks_allocated": total_marks,
+        "total_score": total_score,
+        "overall_feedback": f"Scored {total_score} out of {total_marks} across {len(graded)} questions.",
+    }
+    if failed:
+        result["error"] = f"Could not grade question(s) {', '.join(map(str, failed))}"
+    return result
+
+
+def parse_question_grade(response_text, marks_allocated):
+    """Parse Gemini's grade of one question into (marks achieved, capped to the question's marks, feedback)"""
+    response = parse_json_response(response_text)
+    return min(max(float(response.get("marks_achieved", 0)), 0), marks_allocated), response.get("feedback", "")
+
+
+def answer_memo_keys(questions, student_answers):
+    """Return {question number: (hash, normalized answer)} for the answers short enough to memoize"""
+    keys = {}
+    for question in questions:
+        normalized = normalize_answer(student_answers[question['number']])
+        if normalized and len(normalized) <= settings.ANSWER_MEMO_MAX_CHARS:
+            keys[question['number']] = (hashlib.sha256(normalized.encode()).hexdigest(), normalized)
+    return keys
+
+
+def recall_answer_grades(assignment, questions, student_answers):
+    """Return {question number: AnswerMemo} for answers graded before for this assignment, counting the hits"""
+    keys = answer_memo_keys(questions, student_answers)
+    if not keys:
+        return {}
+    memos = AnswerMemo.objects.filter(
+        assignment=assignment,
+        questions_hash=assignment.answer_key_questions_hash,
+        question_number__in=keys,
+        answer_hash__in=[answer_hash for answer_hash, normalized in keys.values()],
+    )
+    found = {memo.question_number: memo for memo in memos if keys[memo.question_number][0] == memo.answer_hash}
+    if found:
+        AnswerMemo.objects.filter(id__in=[memo.id for memo in found.values()]).update(hits=F('hits') + 1)
+        logger.info(f"Reusing memoized grades for questions {sorted(found)} of assignment {assignment.id}")
+    return found
+
+
+def remember_answer_grades(assignment, questions, student_answers, responses):
+    """Memoize Gemini's grade of each short answer, so identical answers to the question skip Gemini
+
+    Answers graded locally aren't memoized, so each memo entry stands for one Gemini call.
+    """
+    marks_allocated = {question['number']: question['marks'] for question in questions}
+    memos = []
+    for number, (answer_hash, normalized) in answer_memo_keys(questions, student_answers).items():
+        try:
+            if parse_json_response(responses[str(number)]).get("graded_locally"):
+                continue
+            marks, feedback = parse_question_grade(responses[str(number)], marks_allocated[number])
+        except Exception:
+            continue
+        memos.append(AnswerMemo(
+            assignment=assignment,
+            questions_hash=assignment.answer_key_questions_hash,
+            question_number=number,
+            answer_hash=answer_hash,
+            normalized_answer=normalized,
+            marks_achieved=marks,
+            feedback=feedback,
+        ))
+    AnswerMemo.objects.bulk_create(memos, ignore_conflicts=True)
+
+
+def grading_error(total_marks, feedback, error):
+    """Grading result recorded when a submission couldn't be graded"""
+    return {
+        "questions": [],
+        "total_marks_allocated": total_marks,
+        "total_score": 0,
+        "overall_feedback": feedback,
+        "error": error
+    }
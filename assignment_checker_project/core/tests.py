@@ -1,16 +1,57 @@
+import io
+import asyncio
 import os
+import importlib
+import json
+import hashlib
+import math
+import time
+import tempfile
+from datetime import timedelta
 import django
+import fitz
+import numpy as np
+from unittest import mock
 from dotenv import load_dotenv
-from django.test import TestCase
+from django.conf import settings
+from django.core.cache import caches
+from django.utils import timezone
+from google.api_core import exceptions as google_exceptions
+from asgiref.sync import sync_to_async
+from django.test import TestCase, override_settings
 from django.core.files import File
-from .models import User, Classroom, Assignment, Submission
+from django.core.files.uploadedfile import SimpleUploadedFile
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import AccessToken
+from .models import User, Classroom, Assignment, Submission, GradingArtifact, QuestionGrade
+from .serializers import SubmissionSerializer
+from .llm import generate_text, get_gemini_model, get_generative_client, response_cache_key
+from .questions import align_answers, build_answer_key_questions, normalize_answer, segment_questions
+from .plagiarism import check_submission, minhash_signature, shingle_hashes
+from .ratelimit import LocalRateLimiter, RateLimited
+from .stats import answer_memo_stats
+from .math_grading import Expression, parses_as_math
+from .events import get_event_backend
+from .ocr import OCRBackend, PytesseractBackend, get_ocr_backend, ocr_zoom
 from .tasks import (
     is_math_assignment,
     evaluate_stepwise_math,
     partial_credit_numeric,
     parse_steps,
     grade_math_assignment,
-    grade_with_gemini
+    grade_with_gemini,
+    get_answer_key_text,
+    get_answer_key_context,
+    grading_signature,
+    questions_signature,
+    compute_file_hash,
+    extract_text_from_pdf,
+    extract_pdf,
+    grade_submission,
+    extract_submission,
+    grade_extracted_submission,
+    persist_grading_result,
+    ExtractionResult
 )
 
 # Load environment variables
@@ -21,6 +62,27 @@ os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'assignment_checker_project.sett
 django.setup()
 
 
+class AssignmentFixtureMixin:
+    """A teacher with a classroom and a 10-mark assignment, and helpers to add students and submissions"""
+
+    def setUp(self):
+        super().setUp()
+        self.teacher = User.objects.create_user(username='teacher', password='pass', role='teacher')
+        self.classroom = Classroom.objects.create(name='Algebra', teacher=self.teacher)
+        self.assignment = Assignment.objects.create(
+            title='Homework 1', description='Solve for x', teacher=self.teacher, classroom=self.classroom,
+            correct_answer_file=SimpleUploadedFile('key.pdf', b'answer key'), total_marks=10,
+        )
+
+    def create_student(self, username='student', **fields):
+        return User.objects.create_user(username=username, password='pass', role='student', **fields)
+
+    def create_submission(self, student, content=b'%PDF', filename='answer.pdf', **fields):
+        return Submission.objects.create(
+            assignment=self.assignment, student=student, submission_file=SimpleUploadedFile(filename, content), **fields
+        )
+
+
 class GradingTests(TestCase):
     """Test cases for the enhanced grading functionality"""
 
@@ -76,6 +138,19 @@ class GradingTests(TestCase):
         self.assertGreater(score, 0)
         self.assertLessEqual(score, 100)
 
+    def test_nested_powers_overflow_quickly(self):
+        """Test nested powers in a student's answer are undefined at once instead of building huge integers"""
+        start = time.monotonic()
+        self.assertTrue(math.isnan(Expression('(((9^99)^99)^99)^99').evaluate({})))
+        self.assertLess(time.monotonic() - start, 1)
+        self.assertEqual(Expression('2^10 % 3').evaluate({}), 1.0)
+
+    def test_long_step_is_not_math(self):
+        """Test a very long line is left to Gemini instead of overflowing the parser's recursion"""
+        step = 'x = ' + '+'.join(['1'] * 3000)
+        self.assertFalse(parses_as_math(step))
+        self.assertFalse(is_math_assignment('x = 1 + 1\nx = 2', step))
+
     def test_grade_with_gemini_basic(self):
         """Test basic Gemini grading functionality"""
         teacher_answer = """
@@ -161,6 +236,978 @@ class GradingTests(TestCase):
         self.assertEqual(result['total_score'], total_achieved)
 
 
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp())
+class AnswerKeyCacheTests(AssignmentFixtureMixin, TestCase):
+    """Test cases for per-assignment answer key extraction caching"""
+
+    @mock.patch('core.tasks.extract_text_from_pdf', return_value='x = 4')
+    def test_answer_key_extracted_once(self, mock_extract):
+        """Test the answer key is only extracted on the first request"""
+        self.assertEqual(get_answer_key_text(self.assignment), 'x = 4')
+        self.assertEqual(get_answer_key_text(Assignment.objects.get(id=self.assignment.id)), 'x = 4')
+        self.assertEqual(mock_extract.call_count, 1)
+
+    @mock.patch('core.tasks.extract_text_from_pdf', side_effect=['x = 4', 'x = 5'])
+    def test_answer_key_reextracted_when_file_changes(self, mock_extract):
+        """Test a changed answer key file invalidates the cached text"""
+        get_answer_key_text(self.assignment)
+        self.assignment.correct_answer_file = SimpleUploadedFile('key.pdf', b'answer key v2')
+        self.assignment.save()
+        self.assertEqual(get_answer_key_text(self.assignment), 'x = 5')
+        self.assertEqual(mock_extract.call_count, 2)
+
+
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp())
+class SubmissionDeduplicationTests(AssignmentFixtureMixin, TestCase):
+    """Test cases for reusing grades of identical uploads"""
+
+    def setUp(self):
+        super().setUp()
+        self.student = self.create_student(regdno='REG1')
+        with mock.patch('core.tasks.queue_grading'):
+            self.graded = self.submit(b'x = 4')
+        self.graded.score = 8
+        self.graded.grading_details = {'total_score': 8}
+        self.graded.status = 'completed'
+        key_hash = compute_file_hash(self.assignment.correct_answer_file.path)
+        self.graded.grading_key = grading_signature(key_hash, questions_signature(self.assignment, key_hash), 10)
+        self.graded.save()
+
+    def submit(self, content):
+        serializer = SubmissionSerializer(
+            data={'assignment': self.assignment.id, 'submission_file': SimpleUploadedFile('answer.pdf', content)},
+            context={'request': mock.Mock(user=self.student)},
+        )
+        serializer.is_valid(raise_exception=True)
+        return serializer.save()
+
+    @mock.patch('core.tasks.queue_grading')
+    def test_identical_upload_reuses_grade(self, queue_grading):
+        """Test a re-upload of the same file is graded without queueing the task"""
+        submission = self.submit(b'x = 4')
+        queue_grading.assert_not_called()
+        submission.refresh_from_db()
+        self.assertEqual(submission.status, 'completed')
+        self.assertEqual(submission.score, 8)
+        self.assertEqual(submission.grading_details, {'total_score': 8})
+
+    @mock.patch('core.tasks.queue_grading')
+    def test_changed_upload_is_graded(self, queue_grading):
+        """Test a different file is queued for grading"""
+        submission = self.submit(b'x = 5')
+        queue_grading.assert_called_once_with(submission.id)
+
+    @mock.patch('core.tasks.queue_grading')
+    def test_changed_answer_key_is_regraded(self, queue_grading):
+        """Test an identical upload is regraded once the answer key has changed"""
+        self.assignment.correct_answer_file = SimpleUploadedFile('key.pdf', b'corrected answer key')
+        self.assignment.save()
+        submission = self.submit(b'x = 4')
+        queue_grading.assert_called_once_with(submission.id)
+
+    @mock.patch('core.tasks.queue_grading')
+    def test_changed_question_paper_is_regraded(self, queue_grading):
+        """Test an identical upload is regraded once a question paper has been added"""
+        self.assignment.question_file = SimpleUploadedFile('questions.pdf', b'1. Solve for x (10 marks)')
+        self.assignment.save()
+        submission = self.submit(b'x = 4')
+        queue_grading.assert_called_once_with(submission.id)
+
+
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp())
+class GradingPipelineTests(AssignmentFixtureMixin, TestCase):
+    """Test cases for the extract -> grade -> persist grading pipeline"""
+
+    def setUp(self):
+        super().setUp()
+        self.submission = self.create_submission(self.create_student(regdno='REG1'), b'x = 4')
+        extract = mock.patch('core.tasks.extract_pdf', return_value=ExtractionResult(text='x = 4', page_count=1))
+        self.extract = extract.start()
+        self.addCleanup(extract.stop)
+
+    @mock.patch('core.tasks.request_gemini', return_value='```json{"questions": [{"marks_achieved": 12}], "overall_feedback": "Good"}```')
+    def test_pipeline_persists_grade(self, request_gemini):
+        """Test the stages hand over through the artifact and the grade is capped at total marks"""
+        grade_submission(self.submission.id)
+        self.submission.refresh_from_db()
+        self.assertEqual(self.submission.status, 'completed')
+        self.assertEqual(self.submission.score, 10)
+        artifact = GradingArtifact.objects.get(submission=self.submission)
+        self.assertEqual(artifact.stage, GradingArtifact.STAGE_GRADED)
+        self.assertIn('x = 4', artifact.prompt)
+        self.assertTrue(artifact.raw_response.startswith('```json'))
+
+    @mock.patch('core.tasks.get_answer_key_text', side_effect=RuntimeError('boom'))
+    def test_failed_stage_marks_submission_failed(self, get_answer_key_text):
+        """Test a non-transient exception in a stage marks the submission failed"""
+        with self.assertRaises(RuntimeError):
+            grade_submission(self.submission.id)
+        self.submission.refresh_from_db()
+        self.assertEqual(self.submission.status, 'failed')
+
+    def test_retry_resumes_from_checkpoint(self):
+        """Test a run that failed on a Gemini timeout resumes without re-extracting"""
+        with mock.patch('core.tasks.request_gemini', side_effect=google_exceptions.DeadlineExceeded('timeout')):
+            with self.assertRaises(google_exceptions.DeadlineExceeded):
+                grade_submission(self.submission.id)
+        self.submission.refresh_from_db()
+        self.assertEqual(self.submission.status, 'failed')
+
+        with mock.patch('core.tasks.request_gemini', return_value='{"questions": [{"marks_achieved": 7}]}') as request_gemini:
+            grade_submission(self.submission.id)
+            # A duplicate delivery of an already completed submission is a no-op
+            grade_submission(self.submission.id)
+        self.submission.refresh_from_db()
+        self.assertEqual(self.submission.status, 'completed')
+        self.assertEqual(self.submission.score, 7)
+        self.assertEqual(self.extract.call_count, 2)  # Submission once, answer key once
+        # Only the submission is extracted within the budgets
+        self.assertEqual(
+            [(call.kwargs.get('max_pages'), call.kwargs.get('max_chars')) for call in self.extract.call_args_list],
+            [(settings.EXTRACTION_MAX_PAGES, settings.EXTRACTION_MAX_CHARS), (None, None)],
+        )
+        self.assertEqual(request_gemini.call_count, 1)
+
+    @override_settings(GEMINI_CONTEXT_CACHE_MIN_TOKENS=1)
+    @mock.patch('core.tasks.delete_context_cache')
+    @mock.patch('core.tasks.create_context_cache')
+    @mock.patch('core.tasks.request_gemini', return_value='{"questions": [{"marks_achieved": 6}]}')
+    def test_answer_key_context_is_cached_per_assignment(self, request_gemini, create_context_cache, delete_context_cache):
+        """Test submissions send only their own text on top of one cached answer-key context"""
+        create_context_cache.return_value = ('cachedContents/key1', timezone.now() + timedelta(hours=1))
+        assignment = self.submission.assignment
+        other = Submission.objects.create(
+            assignment=assignment,
+            student=User.objects.create_user(username='student2', password='pass', role='student', regdno='REG2'),
+            submission_file=SimpleUploadedFile('answer2.pdf', b'x = 5'),
+        )
+        grade_submission(self.submission.id)
+        grade_submission(other.id)
+
+        create_context_cache.assert_called_once()
+        self.assertIn('x = 4', create_context_cache.call_args.args[1])  # The answer key
+        self.assertEqual(request_gemini.call_args.kwargs['cached_content'], 'cachedContents/key1')
+        self.assertNotIn("TEACHER'S ANSWER KEY", request_gemini.call_args.args[0])
+        # The checkpoint records what was sent, so a bad response is dropped from the response cache under its own key
+        artifact = GradingArtifact.objects.get(submission=other)
+        self.assertEqual(artifact.prompt, request_gemini.call_args.args[0])
+        self.assertEqual(artifact.cached_content, 'cachedContents/key1')
+
+        # A new answer key file drops the cached context of the old one
+        assignment.refresh_from_db()
+        assignment.correct_answer_file = SimpleUploadedFile('key2.pdf', b'new answer key')
+        assignment.save()
+        get_answer_key_text(assignment)
+        delete_context_cache.assert_called_once_with('cachedContents/key1')
+        self.assertEqual(Assignment.objects.get(id=assignment.id).answer_key_context_name, '')
+
+    @override_settings(GEMINI_CONTEXT_CACHE_MIN_TOKENS=1)
+    @mock.patch('core.tasks.delete_context_cache')
+    @mock.patch('core.tasks.create_context_cache')
+    def test_answer_key_context_race_keeps_one_context(self, create_context_cache, delete_context_cache):
+        """Test a grader whose upload loses the race to another grader's drops it and uses the stored context"""
+        assignment = self.submission.assignment
+        expires = timezone.now() + timedelta(hours=1)
+
+        def create(model, contents, *args, **kwargs):
+            # Another grader stores its context while this one is uploading
+            Assignment.objects.filter(id=assignment.id).update(
+                answer_key_context_name='cachedContents/first',
+                answer_key_context_hash=hashlib.sha256(f"{model}\n{contents}".encode()).hexdigest(),
+                answer_key_context_expires=expires,
+            )
+            return 'cachedContents/second', expires
+        create_context_cache.side_effect = create
+
+        self.assertEqual(get_answer_key_context(assignment, 'x = 4'), 'cachedContents/first')
+        delete_context_cache.assert_called_once_with('cachedContents/second')
+
+    def test_numbered_answer_key_is_graded_per_question(self):
+        """Test a numbered key is graded one question per call and a failed question alone is asked again"""
+        def extract(path, *args, **kwargs):
+            if 'answers/' in path:
+                return ExtractionResult(text='Q1. x = 4\nQ2. Paris (4 marks)\nQ3. 12', page_count=1)
+            return ExtractionResult(text='Name: A\n1) x = 4\n2) London', page_count=1)
+        self.extract.side_effect = extract
+
+        def grade(prompt, **kwargs):
+            if 'London' in prompt:
+                raise google_exceptions.ServiceUnavailable('unavailable')
+            return '{"marks_achieved": 99, "feedback": "Correct"}'
+
+        with mock.patch('core.tasks.request_gemini', side_effect=grade) as request_gemini:
+            with self.assertRaises(google_exceptions.ServiceUnavailable):
+                grade_submission(self.submission.id)
+        self.assertEqual(request_gemini.call_count, 2)  # Question 3 is unanswered and never sent
+        self.assertEqual(set(GradingArtifact.objects.get(submission=self.submission).question_responses), {'1', '3'})
+
+        with mock.patch('core.tasks.request_gemini', return_value='{"marks_achieved": 1, "feedback": "Wrong city"}') as request_gemini:
+            grade_submission(self.submission.id)
+        self.assertEqual(request_gemini.call_count, 1)
+        self.assertIn('London', request_gemini.call_args.args[0])
+
+        self.submission.refresh_from_db()
+        details = self.submission.grading_result()
+        self.assertEqual([q['marks_achieved'] for q in details['questions']], [3.33, 1.0, 0])  # Capped at the marks
+        self.assertEqual(self.submission.score, 4.33)
+
+    def test_changed_total_marks_resets_question_responses(self):
+        """Test question responses checkpointed under other total marks are asked for again"""
+        def extract(path, *args, **kwargs):
+            if 'answers/' in path:
+                return ExtractionResult(text='Q1. Newton\nQ2. Paris', page_count=1)
+            return ExtractionResult(text='1) Newton\n2) London', page_count=1)
+        self.extract.side_effect = extract
+
+        with mock.patch('core.tasks.request_gemini', side_effect=['{"marks_achieved": 5}', google_exceptions.ServiceUnavailable('unavailable')]):
+            with self.assertRaises(google_exceptions.ServiceUnavailable):
+                grade_submission(self.submission.id)
+        Assignment.objects.filter(id=self.submission.assignment_id).update(total_marks=20)
+
+        with mock.patch('core.tasks.request_gemini', return_value='{"marks_achieved": 10}') as request_gemini:
+            grade_submission(self.submission.id)
+        self.assertEqual(request_gemini.call_count, 2)
+        self.submission.refresh_from_db()
+        self.assertEqual(self.submission.score, 20)
+
+    def test_repeated_short_answers_are_memoized(self):
+        """Test an answer that normalizes like an earlier one to the same question reuses its grade"""
+        def extract(path, *args, **kwargs):
+            if 'answers/' in path:
+                return ExtractionResult(text='1. Paris\n2. 1000 m', page_count=1)
+            if 'answer2' in path:
+                return ExtractionResult(text='1) paris.\n2) 1,000 Metres', page_count=1)
+            return ExtractionResult(text='1. Paris\n2. 1000m', page_count=1)
+        self.extract.side_effect = extract
+        other = Submission.objects.create(
+            assignment=self.submission.assignment,
+            student=User.objects.create_user(username='student2', password='pass', role='student', regdno='REG2'),
+            submission_file=SimpleUploadedFile('answer2.pdf', b'paris'),
+        )
+
+        with mock.patch('core.tasks.request_gemini', return_value='{"marks_achieved": 5, "feedback": "Correct"}') as request_gemini:
+            grade_submission(self.submission.id)
+            grade_submission(other.id)
+        self.assertEqual(request_gemini.call_count, 2)  # Only the first submission's two questions
+        other.refresh_from_db()
+        self.assertEqual(other.score, 10)
+        self.assertEqual(answer_memo_stats(self.submission.assignment), {'entries': 2, 'hits': 2, 'hit_rate': 0.5})
+
+    @mock.patch('core.tasks.request_gemini', return_value='{"marks_achieved": 2, "feedback": "Good"}')
+    def test_math_is_graded_locally(self, request_gemini):
+        """Test worked math the local grader can check skips Gemini, and the rest still goes to it"""
+        def extract(path, *args, **kwargs):
+            if 'answers/' in path:
+                return ExtractionResult(text='Q1. 2x + 3 = 11 → 2x = 8 → x = 4\nQ2. v = 240 / 4 → v = 60\nQ3. Evaporation', page_count=1)
+            return ExtractionResult(text='1) 2x = 8\nx = 4\n2) 240/4 = 40\n3) Rain', page_count=1)
+        self.extract.side_effect = extract
+
+        grade_submission(self.submission.id)
+        self.assertEqual(request_gemini.call_count, 1)
+        self.assertIn('Rain', request_gemini.call_args.args[0])
+        self.submission.refresh_from_db()
+        details = self.submission.grading_result()
+        # Correct final answer with 2 of 3 steps, a wrong final answer, and Gemini's grade capped at the marks
+        self.assertEqual([q['marks_achieved'] for q in details['questions']], [2.78, 0.0, 2.0])
+        self.assertEqual(answer_memo_stats(self.submission.assignment)['entries'], 1)  # Only Gemini's grade is memoized
+
+    @mock.patch('core.tasks.request_gemini')
+    def test_worked_math_paper_is_graded_locally(self, request_gemini):
+        """Test an unnumbered paper of worked math is graded without Gemini"""
+        def extract(path, *args, **kwargs):
+            if 'answers/' in path:
+                return ExtractionResult(text='2x + 3 = 11\n2x = 8\nx = 4', page_count=1)
+            return ExtractionResult(text='2x + 3 = 11\n2x = 11 - 3\n2x = 8\nx = 4', page_count=1)
+        self.extract.side_effect = extract
+
+        grade_submission(self.submission.id)
+        request_gemini.assert_not_called()
+        self.submission.refresh_from_db()
+        self.assertEqual(self.submission.score, 10)
+        self.assertEqual(GradingArtifact.objects.get(submission=self.submission).raw_response, '')
+
+    def test_rate_limited_grading_requeues(self):
+        """Test a queued grading run re-queues itself when the LLM budget is exhausted instead of failing"""
+        extract_submission(self.submission.id)
+        with mock.patch('core.tasks.request_gemini', side_effect=RateLimited(2.0)) as request_gemini, \
+                mock.patch.object(grade_extracted_submission, 'signature_from_request') as signature:
+            grade_extracted_submission.apply(args=[self.submission.id])
+        self.assertEqual(request_gemini.call_args.kwargs['max_wait'], 5)
+        self.assertGreaterEqual(signature.call_args.kwargs['countdown'], 2.0)
+        signature.return_value.apply_async.assert_called_once()
+        self.submission.refresh_from_db()
+        self.assertEqual(self.submission.status, 'processing')
+
+
+class QuestionSegmentationTests(TestCase):
+    """Test cases for splitting answer keys and submissions into questions"""
+
+    def test_numbered_steps_stay_in_their_answer(self):
+        """Test only consecutive question numbers start a new question"""
+        text = "Physics test\nQ1. Steps:\n1. Draw the diagram\n2. Resolve forces\nQuestion 2: F = ma\nQ 3) 9.8 m/s2"
+        self.assertEqual(segment_questions(text), {
+            1: "Steps:\n1. Draw the diagram\n2. Resolve forces",
+            2: "F = ma",
+            3: "9.8 m/s2",
+        })
+
+    def test_marks_come_from_the_question_paper(self):
+        """Test printed marks are scaled to the total and questions are taken from the question paper"""
+        questions = build_answer_key_questions(
+            "1. Paris\n2. 42", "1. Capital of France? (2 marks)\n2. The answer? (3 marks)", total_marks=10
+        )
+        self.assertEqual([q['marks'] for q in questions], [4.0, 6.0])
+        self.assertEqual(questions[0]['question'], 'Capital of France? (2 marks)')
+        self.assertEqual(questions[1]['answer'], '42')
+
+    def test_answer_normalization(self):
+        """Test case, punctuation, number formats and units don't tell answers apart"""
+        self.assertEqual(normalize_answer(' Paris. '), normalize_answer('paris'))
+        self.assertEqual(normalize_answer('1,000.50 Metres'), '1000.5 m')
+        self.assertEqual(normalize_answer('X=4'), normalize_answer('x = 4'))
+        self.assertEqual(normalize_answer('50 percent'), normalize_answer('50%'))
+        self.assertNotEqual(normalize_answer('5 m'), normalize_answer('5 km'))
+        self.assertNotEqual(normalize_answer('(a+b)/c'), normalize_answer('a+b/c'))
+        self.assertNotEqual(normalize_answer('(a+b)^2'), normalize_answer('a+b^2'))
+        self.assertEqual(normalize_answer('(a+b)/c'), normalize_answer('( a + b ) / c'))
+
+    def test_unnumbered_text_is_not_aligned(self):
+        """Test keys or submissions without question numbers fall back to whole-paper grading"""
+        self.assertEqual(build_answer_key_questions("Paris is the capital of France", "", 10), [])
+        questions = build_answer_key_questions("1. Paris\n2. 42", "", 10)
+        self.assertEqual([q['marks'] for q in questions], [5.0, 5.0])
+        self.assertIsNone(align_answers(questions, "Paris, and the answer is 42"))
+        self.assertEqual(align_answers(questions, "1. Paris"), {1: 'Paris', 2: ''})
+
+    def test_rounded_marks_add_up_to_total(self):
+        """Test marks that don't split evenly still add up to the total, so a perfect paper scores full marks"""
+        questions = build_answer_key_questions("1. Paris\n2. 42\n3. Madrid", "", 10)
+        self.assertEqual([q['marks'] for q in questions], [3.33, 3.33, 3.34])
+        self.assertEqual(round(sum(q['marks'] for q in questions), 2), 10)
+
+
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp())
+class PlagiarismTests(AssignmentFixtureMixin, TestCase):
+    """Test cases for the MinHash/LSH near-duplicate index"""
+
+    ESSAY = (
+        "The industrial revolution began in Britain in the late eighteenth century when new machines "
+        "changed how textiles were produced. Steam engines powered factories and railways, moving people "
+        "from farms into growing cities where working conditions were often harsh and wages were low. "
+        "Reformers campaigned for shorter hours, safer workplaces and schooling for children."
+    )
+
+    def submit(self, username, text):
+        student = User.objects.filter(username=username).first() or self.create_student(username)
+        submission = self.create_submission(student)
+        check_submission(submission, text)
+        submission.refresh_from_db()
+        return submission
+
+    def test_signature_estimates_jaccard_similarity(self):
+        """Test matching signature slots track the true shingle overlap"""
+        first = shingle_hashes(self.ESSAY)
+        second = shingle_hashes(self.ESSAY.replace('harsh', 'dangerous').replace('low', 'poor'))
+        jaccard = len(np.intersect1d(first, second)) / len(np.union1d(first, second))
+        estimate = (minhash_signature(first) == minhash_signature(second)).mean()
+        self.assertAlmostEqual(estimate, jaccard, delta=0.15)
+
+    def test_near_duplicates_are_reported_both_ways(self):
+        """Test a lightly edited copy is matched, ranked, and added to the original's report"""
+        original = self.submit('alice', self.ESSAY)
+        unrelated = self.submit('bob', "Photosynthesis turns light, water and carbon dioxide into sugar and oxygen inside chloroplasts.")
+        exact = self.submit('carol', self.ESSAY)
+        edited = self.submit('dave', self.ESSAY.replace('harsh', 'dangerous'))
+
+        self.assertEqual(original.plagiarism_report['matches'], [])
+        self.assertEqual(unrelated.plagiarism_report['matches'], [])
+        self.assertEqual(exact.plagiarism_report['matches'], [{'submission': original.id, 'similarity': 1.0}])
+        matches = edited.plagiarism_report['matches']
+        self.assertEqual({m['submission'] for m in matches}, {original.id, exact.id})
+        self.assertGreater(matches[0]['similarity'], 0.7)
+
+        original.refresh_from_db()
+        self.assertEqual([m['submission'] for m in original.plagiarism_report['matches']], [exact.id, edited.id])
+        unrelated.refresh_from_db()
+        self.assertEqual(unrelated.plagiarism_report, {'matches': [], 'semantic_matches': []})
+
+    @override_settings(PLAGIARISM_SEMANTIC_THRESHOLD=0.8)
+    def test_reordered_copy_is_a_semantic_match(self):
+        """Test a copy with its sentences and clauses reordered is caught by embeddings, not shingles"""
+        original = self.submit('alice', self.ESSAY)
+        reordered = self.submit('bob', (
+            "Reformers campaigned for safer workplaces, shorter hours and schooling for children. Steam engines "
+            "powered railways and factories, moving people from farms into growing cities where wages were low and "
+            "working conditions were often harsh. In Britain the industrial revolution began in the late eighteenth "
+            "century when new machines changed how textiles were produced."
+        ))
+        self.assertEqual(reordered.plagiarism_report['matches'], [])
+        [match] = reordered.plagiarism_report['semantic_matches']
+        self.assertEqual(match['submission'], original.id)
+        self.assertNotIn('question', match)
+        original.refresh_from_db()
+        self.assertEqual(original.plagiarism_report['semantic_matches'], [{**match, 'submission': reordered.id}])
+
+    def test_copied_answer_is_matched_by_question(self):
+        """Test one copied answer in otherwise different papers is reported against its question"""
+        copied = "Steam engines powered factories and railways, moving people from farms into growing cities"
+        alice = self.create_submission(self.create_student('alice'))
+        bob = self.create_submission(self.create_student('bob'))
+        check_submission(alice, 'Q1 Textiles were made by hand in cottages before the mills. Q2 ' + copied,
+                         {1: 'Textiles were made by hand in cottages before the mills.', 2: copied})
+        check_submission(bob, 'Q1 Britain had coal, capital, colonies and a large navy to protect trade. Q2 ' + copied,
+                         {1: 'Britain had coal, capital, colonies and a large navy to protect trade.', 2: copied})
+        bob.refresh_from_db()
+        self.assertEqual(bob.plagiarism_report['semantic_matches'], [{'submission': alice.id, 'similarity': 1.0, 'question': 2}])
+
+    def test_own_resubmission_is_not_a_match(self):
+        """Test a student's earlier submission isn't reported against their new one"""
+        self.submit('alice', self.ESSAY)
+        resubmission = self.submit('alice', self.ESSAY)
+        self.assertEqual(resubmission.plagiarism_report, {'matches': [], 'semantic_matches': []})
+
+
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp())
+class ListEndpointTests(TestCase):
+    """Test cases for the list endpoints' pagination and the number of queries they make"""
+
+    def setUp(self):
+        self.teacher = User.objects.create_user(username='teacher', password='pass', role='teacher')
+        self.student = User.objects.create_user(username='student', password='pass', role='student', regdno='REG0')
+        for i in range(3):
+            classroom = Classroom.objects.create(name=f'Class {i}', teacher=self.teacher)
+            classroom.students.add(self.student, *(
+                User.objects.create_user(username=f'student{i}-{j}', role='student', regdno=f'REG{i}{j}') for j in range(3)
+            ))
+            for k in range(2):
+                assignment = Assignment.objects.create(
+                    title=f'Homework {k}', description='', teacher=self.teacher, classroom=classroom,
+                    correct_answer_file=SimpleUploadedFile('key.pdf', b'answer key'), total_marks=10,
+                )
+                for student in classroom.students.all():
+                    Submission.objects.create(
+                        assignment=assignment, student=student, submission_file=SimpleUploadedFile('answer.pdf', b'%PDF'),
+                    )
+        self.client = APIClient()
+
+    def get(self, user, url):
+        self.client.force_authenticate(user)
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return response.json()['results']
+
+    def test_classroom_list(self):
+        """Test classrooms are listed with their teacher, students and counts in two queries"""
+        with self.assertNumQueries(2):
+            classrooms = self.get(self.teacher, '/api/classrooms/')
+        self.assertEqual([(c['student_count'], c['assignment_count'], len(c['students'])) for c in classrooms], [(4, 2, 4)] * 3)
+        with self.assertNumQueries(2):
+            classrooms = self.get(self.student, '/api/classrooms/')
+        self.assertEqual([c['student_count'] for c in classrooms], [4] * 3)
+
+    def test_assignment_list(self):
+        """Test assignments are listed with their teacher and submission count in one query"""
+        with self.assertNumQueries(1):
+            assignments = self.get(self.teacher, '/api/assignments/')
+        self.assertEqual([a['submitted_students_count'] for a in assignments], [4] * 6)
+        with self.assertNumQueries(1):
+            self.get(self.student, '/api/assignments/')
+
+    def test_submission_list(self):
+        """Test submissions are listed with their student and question grades in two queries"""
+        with self.assertNumQueries(2):
+            submissions = self.get(self.teacher, '/api/submissions/')
+        self.assertEqual(len(submissions), 24)
+        with self.assertNumQueries(2):
+            self.assertEqual(len(self.get(self.student, '/api/submissions/')), 6)
+
+    def test_cursor_pagination(self):
+        """Test pages walk every submission newest first, without repeats, and filters apply"""
+        self.client.force_authenticate(self.teacher)
+        seen = []
+        url = '/api/submissions/?page_size=5'
+        while url:
+            page = self.client.get(url).json()
+            self.assertLessEqual(len(page['results']), 5)
+            seen += page['results']
+            url = page['next']
+        self.assertEqual(len({s['id'] for s in seen}), 24)
+        dates = [s['submission_date'] for s in seen]
+        self.assertEqual(dates, sorted(dates, reverse=True))
+
+        assignment = Assignment.objects.first()
+        self.assertEqual(
+            {s['assignment'] for s in self.get(self.teacher, f'/api/submissions/?assignment={assignment.id}')}, {assignment.id}
+        )
+        self.assertEqual(
+            {a['classroom'] for a in self.get(self.teacher, f'/api/assignments/?classroom={assignment.classroom_id}')},
+            {assignment.classroom_id},
+        )
+
+
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp())
+class AssignmentReportTests(AssignmentFixtureMixin, TestCase):
+    """Test cases for the streamed assignment report"""
+
+    def setUp(self):
+        super().setUp()
+        for i, score in enumerate([8, 0, None]):
+            student = self.create_student(f's{i}', first_name='Student' if i else '', last_name=str(i), regdno=f'REG{i}' if i else None)
+            self.create_submission(student, score=score, submission_date=timezone.now() + timedelta(minutes=i))
+        self.client = APIClient()
+        self.client.force_authenticate(self.teacher)
+        self.url = f'/api/assignments/{self.assignment.id}/report/'
+
+    def test_csv_is_streamed(self):
+        """Test the CSV report streams every submission in order from one query"""
+        with self.assertNumQueries(2):
+            response = self.client.get(self.url, {'type': 'csv'})
+            self.assertTrue(response.streaming)
+            content = b''.join(response.streaming_content).decode()
+        self.assertEqual(content.splitlines(), [
+            'Name,Regd No,Secured Mark,Total Mark', '0,N/A,8.0,10', 'Student 1,REG1,0.0,10', 'Student 2,REG2,Pending,10',
+        ])
+
+    def test_xlsx_report(self):
+        """Test the default report is a workbook with the same rows"""
+        from openpyxl import load_workbook
+        response = self.client.get(self.url)
+        self.assertEqual(response['Content-Type'], 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
+        rows = list(load_workbook(io.BytesIO(b''.join(response.streaming_content))).active.values)
+        self.assertEqual(rows[0], ('Name', 'Regd No', 'Secured Mark', 'Total Mark'))
+        self.assertEqual(rows[1:], [('0', 'N/A', 8, 10), ('Student 1', 'REG1', 0, 10), ('Student 2', 'REG2', 'Pending', 10)])
+
+    def test_formulas_are_neutralized(self):
+        """Test names that a spreadsheet would run as a formula are written as text"""
+        from openpyxl import load_workbook
+        User.objects.filter(username='s0').update(first_name='=HYPERLINK("http://evil")', last_name='', regdno='+cmd|x')
+        content = b''.join(self.client.get(self.url, {'type': 'csv'}).streaming_content).decode()
+        self.assertEqual(content.splitlines()[1], '"\'=HYPERLINK(""http://evil"")",\'+cmd|x,8.0,10')
+        sheet = load_workbook(io.BytesIO(b''.join(self.client.get(self.url).streaming_content))).active
+        self.assertEqual(sheet['A2'].data_type, 's')
+        self.assertEqual(sheet['A2'].value, '\'=HYPERLINK("http://evil")')
+
+    def test_invalid_requests(self):
+        """Test unknown formats and other teachers' assignments are refused"""
+        self.assertEqual(self.client.get(self.url, {'type': 'pdf'}).status_code, 400)
+        self.client.force_authenticate(User.objects.create_user(username='other', role='teacher'))
+        self.assertEqual(self.client.get(self.url, {'type': 'csv'}).status_code, 404)
+
+
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp())
+class AssignmentStatsTests(AssignmentFixtureMixin, TestCase):
+    """Test cases for the incrementally maintained assignment statistics"""
+
+    def setUp(self):
+        super().setUp()
+        self.students = [self.create_student(f's{i}') for i in range(4)]
+        self.classroom.students.add(*self.students)
+        self.client = APIClient()
+        self.client.force_authenticate(self.teacher)
+        self.url = f'/api/assignments/{self.assignment.id}/stats/'
+
+    def grade(self, student, first, second, minutes=0, error=None):
+        """Run the save stage for a submission graded first + second marks over two 5-mark questions"""
+        submission = self.create_submission(student, status='processing', submission_date=timezone.now() + timedelta(minutes=minutes))
+        result = {
+            'questions': [
+                {'question_number': 1, 'marks_allocated': 5, 'marks_achieved': first},
+                {'question_number': 2, 'marks_allocated': 5, 'marks_achieved': second},
+            ],
+            'total_score': first + second,
+            'total_marks_allocated': 10,
+        }
+        if error:
+            result['error'] = error
+        GradingArtifact.objects.create(submission=submission, stage=GradingArtifact.STAGE_GRADED, grading_result=result)
+        persist_grading_result(submission.id)
+        return submission
+
+    def stats(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_stats_follow_grades(self):
+        """Test mean, median, histogram and question averages are kept up to date as grades are saved"""
+        self.grade(self.students[0], 1, 1)
+        self.grade(self.students[1], 3, 3)
+        self.grade(self.students[2], 4, 5)
+        self.grade(self.students[3], 0, 0, error='Could not grade question(s) 1')
+        # The assignment, its stats, the class size and the answer memo, however many submissions there are
+        with self.assertNumQueries(4):
+            stats = self.stats()
+        self.assertEqual((stats['students'], stats['graded'], stats['mean']), (4, 3, 5.67))
+        self.assertEqual(stats['std_dev'], 2.87)
+        self.assertEqual([bucket['count'] for bucket in stats['histogram']], [0, 0, 1, 0, 0, 0, 1, 0, 0, 1])
+        self.assertTrue(6 <= stats['median'] < 7)
+        self.assertEqual(
+            [(q['question_number'], q['average'], q['graded']) for q in stats['questions']], [(1, 2.67, 3), (2, 3.0, 3)]
+        )
+        self.assertEqual(stats['answer_memo'], {'entries': 0, 'hits': 0, 'hit_rate': 0.0})
+
+    def test_resubmission_supersedes_grade(self):
+        """Test only each student's latest submission counts, even when an older one is graded last"""
+        first = self.grade(self.students[0], 1, 1)
+        self.grade(self.students[0], 5, 5, minutes=10)
+        self.grade(self.students[0], 2, 2, minutes=5)
+        stats = self.stats()
+        self.assertEqual((stats['graded'], stats['mean']), (1, 10.0))
+
+        latest = Submission.objects.get(student=self.students[0], score=10)
+        self.assertEqual(self.client.delete(f'/api/submissions/{latest.id}/').status_code, 204)
+        stats = self.stats()
+        self.assertEqual((stats['graded'], stats['mean']), (1, 4.0))
+        self.assertEqual(sum(bucket['count'] for bucket in stats['histogram']), 1)
+        first.refresh_from_db()
+        self.assertFalse(first.in_stats)
+
+    def test_stats_built_from_existing_grades(self):
+        """Test an assignment graded before its stats existed has them built on first read"""
+        self.grade(self.students[0], 4, 4)
+        self.grade(self.students[1], 2, 2)
+        self.assignment.stats.delete()
+        Submission.objects.update(in_stats=False)
+        stats = self.stats()
+        self.assertEqual((stats['graded'], stats['mean']), (2, 6.0))
+        self.assertEqual(self.client.get('/api/assignments/0/stats/').status_code, 404)
+
+
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp())
+class QuestionGradeTests(AssignmentFixtureMixin, TestCase):
+    """Test cases for storing per-question grades in their own table"""
+
+    RESULT = {
+        'questions': [
+            {'question_number': 1, 'question_text': 'Capital of France', 'marks_allocated': 5, 'marks_achieved': 5, 'feedback': 'Correct'},
+            {'question_number': '2b', 'question_text': 'Why?', 'marks_allocated': 5, 'marks_achieved': 'n/a', 'feedback': ''},
+        ],
+        'total_marks_allocated': 10,
+        'total_score': 5,
+        'overall_feedback': 'Half right',
+    }
+
+    def setUp(self):
+        super().setUp()
+        self.student = self.create_student(regdno='REG1')
+        self.submission = self.create_submission(self.student, status='processing')
+
+    def test_grades_saved_to_table(self):
+        """Test saving a grade writes its questions as rows and the API presents the whole result"""
+        GradingArtifact.objects.create(submission=self.submission, stage=GradingArtifact.STAGE_GRADED, grading_result=self.RESULT)
+        persist_grading_result(self.submission.id)
+        self.submission.refresh_from_db()
+        self.assertEqual(self.submission.grading_details, {'total_marks_allocated': 10, 'total_score': 5, 'overall_feedback': 'Half right'})
+        self.assertEqual(
+            list(QuestionGrade.objects.filter(assignment=self.assignment).values_list('question_number', 'marks_achieved')),
+            [('1', 5.0), ('2b', 0.0)],
+        )
+
+        client = APIClient()
+        client.force_authenticate(self.student)
+        details = client.get(f'/api/submissions/{self.submission.id}/').json()['grading_details']
+        self.assertEqual(details['overall_feedback'], 'Half right')
+        self.assertEqual([(q['question_number'], q['marks_achieved']) for q in details['questions']], [(1, 5.0), ('2b', 0.0)])
+
+    def test_backfill_splits_encoded_details(self):
+        """Test the migration moves the questions out of JSON-encoded grading_details"""
+        from django.apps import apps
+        backfill = importlib.import_module('core.migrations.0018_backfill_question_grades')
+        self.submission.grading_details = json.dumps(self.RESULT)
+        self.submission.save()
+        backfill.split_grading_details(apps, None)
+        self.submission.refresh_from_db()
+        self.assertNotIn('questions', self.submission.grading_details)
+        self.assertEqual(self.submission.grading_details['total_score'], 5)
+        self.assertEqual(
+            [q['question_text'] for q in self.submission.grading_result()['questions']], ['Capital of France', 'Why?']
+        )
+
+
+@override_settings(EVENTS_BACKEND='memory', MEDIA_ROOT=tempfile.mkdtemp())
+class SubmissionEventsTests(AssignmentFixtureMixin, TestCase):
+    """Test cases for pushing submission status changes over server-sent events"""
+
+    def setUp(self):
+        super().setUp()
+        get_event_backend.cache_clear()
+        self.addCleanup(get_event_backend.cache_clear)
+        self.student = self.create_student()
+        self.submission = self.create_submission(self.student, status='processing')
+        GradingArtifact.objects.create(
+            submission=self.submission, stage=GradingArtifact.STAGE_GRADED,
+            grading_result={'questions': [], 'total_marks_allocated': 10, 'total_score': 7, 'overall_feedback': ''},
+        )
+
+    def test_stream_requires_token(self):
+        """Test the stream is refused without a valid access token"""
+        self.assertEqual(self.client.get('/api/events/').status_code, 401)
+        self.assertEqual(self.client.get('/api/events/', {'token': 'not-a-token'}).status_code, 401)
+
+    def grade(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            persist_grading_result(self.submission.id)
+
+    async def test_grade_pushed_to_student_and_teacher(self):
+        """Test saving a grade sends the new status and score to the student's and the teacher's streams"""
+        streams = []
+        for user in (self.student, self.teacher):
+            response = await self.async_client.get('/api/events/', {'token': str(AccessToken.for_user(user))})
+            self.assertEqual(response['Content-Type'], 'text/event-stream')
+            stream = aiter(response.streaming_content)
+            self.assertTrue((await anext(stream)).startswith(b'retry:'))
+            streams.append(stream)
+        events = [asyncio.ensure_future(anext(stream)) for stream in streams]
+        await asyncio.sleep(0.1)  # Let both streams subscribe
+
+        await sync_to_async(self.grade)()
+        for event in await asyncio.wait_for(asyncio.gather(*events), 5):
+            name, data = event.decode().splitlines()[:2]
+            self.assertEqual(name, 'event: submission')
+            self.assertEqual(
+                json.loads(data.removeprefix('data: ')),
+                {'id': self.submission.id, 'assignment': self.assignment.id, 'status': 'completed', 'score': 7.0},
+            )
+
+    def test_failure_published(self):
+        """Test a failing pipeline stage publishes the failed status"""
+        GradingArtifact.objects.filter(submission=self.submission).delete()
+        with mock.patch('core.tasks.publish_event') as publish, self.assertRaises(GradingArtifact.DoesNotExist):
+            persist_grading_result(self.submission.id)
+        channels, name, data = publish.call_args.args
+        self.assertEqual(channels, {f'user:{self.student.id}', f'user:{self.teacher.id}'})
+        self.assertEqual((name, data['status'], data['score']), ('submission', 'failed', None))
+
+
+class RateLimiterTests(TestCase):
+    """Test cases for the LLM token-bucket rate limiter"""
+
+    def test_requests_budget(self):
+        """Test requests beyond the bucket's burst have to wait for the refill"""
+        limiter = LocalRateLimiter(requests_per_minute=60, tokens_per_minute=0)
+        for _ in range(10):  # 10 seconds of budget at one request a second
+            limiter.acquire(100, max_wait=0)
+        with self.assertRaises(RateLimited) as raised:
+            limiter.acquire(100, max_wait=0)
+        self.assertAlmostEqual(raised.exception.wait, 1.0, places=1)
+
+    def test_oversized_request_is_charged_in_full(self):
+        """Test a request larger than the bucket still goes through and later ones pay off its debt"""
+        limiter = LocalRateLimiter(requests_per_minute=0, tokens_per_minute=600)
+        self.assertEqual(limiter.acquire(500, max_wait=0), 100)
+        limiter.debit(400)
+        with self.assertRaises(RateLimited) as raised:
+            limiter.acquire(10, max_wait=0)
+        self.assertGreater(raised.exception.wait, 40)
+
+
+@override_settings(CACHES={'ocr': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'ocr-tests'}})
+class PDFExtractionTests(TestCase):
+    """Test cases for PDF text extraction and OCR"""
+
+    def setUp(self):
+        caches['ocr'].clear()
+
+    def make_pdf(self, pages):
+        """Build a PDF where each entry is page text, or an int marking a scanned page"""
+        path = os.path.join(tempfile.mkdtemp(), 'submission.pdf')
+        with fitz.open() as doc:
+            for content in pages:
+                page = doc.new_page()
+                if isinstance(content, int):
+                    # Scanned page: no text layer, a bar whose width identifies the page
+                    page.draw_rect(fitz.Rect(10, 10, 10 + 20 * (content + 1), 50), color=(0, 0, 0), fill=(0, 0, 0))
+                else:
+                    page.insert_text((72, 72), content)
+            doc.save(path)
+        return path
+
+    class FakeOCRBackend(OCRBackend):
+        """OCR stand-in that recovers the scanned page marker from the bar width"""
+
+        def image_to_string(self, image):
+            left, _, right, _ = image.to_pil().point(lambda p: 255 if p < 128 else 0).getbbox()
+            zoom = image.width / 612  # Default page width in points
+            return PDFExtractionTests.read_marker((right - left) / zoom)
+
+    @staticmethod
+    def read_marker(bar_width):
+        marker = round(bar_width / 20) - 1
+        if marker == 1:
+            raise RuntimeError('tesseract crashed')
+        # Finish later pages first to check page order doesn't depend on completion order
+        time.sleep(0.05 * (4 - marker))
+        return f'scan {marker}'
+
+    def test_parallel_ocr_preserves_page_order(self):
+        """Test pages are OCRed concurrently but returned in page order"""
+        path = self.make_pdf(['typed header', 0, 1, 2, 3])
+        with mock.patch('core.ocr.get_ocr_backend', return_value=self.FakeOCRBackend()):
+            text = extract_text_from_pdf(path, max_workers=4)
+        self.assertEqual(text.split('\n'), ['typed header', '', 'scan 0', 'scan 2', 'scan 3'])
+
+    def test_serial_and_parallel_ocr_match(self):
+        """Test the thread pool gives the same text as serial OCR"""
+        path = self.make_pdf([0, 'typed', 2, 3])
+        with mock.patch('core.ocr.get_ocr_backend', return_value=self.FakeOCRBackend()):
+            self.assertEqual(extract_text_from_pdf(path, max_workers=1), extract_text_from_pdf(path, max_workers=3))
+
+    def test_mixed_page_ocrs_image_regions_in_reading_order(self):
+        """Test photographed answers on a typed page are OCRed and merged in reading order"""
+        path = os.path.join(tempfile.mkdtemp(), 'mixed.pdf')
+        with fitz.open() as doc:
+            page = doc.new_page()
+            page.insert_text((72, 72), 'Q1. Name the capital of France')
+            photo = fitz.Pixmap(fitz.csGRAY, fitz.IRect(0, 0, 40, 40), False)
+            photo.clear_with(255)
+            page.insert_image(fitz.Rect(72, 100, 372, 300), pixmap=photo)
+            page.insert_image(fitz.Rect(500, 20, 520, 40), pixmap=photo)  # Too small to be an answer
+            page.insert_text((72, 340), 'Q2. Name the capital of Spain')
+            doc.save(path)
+
+        backend = mock.Mock(spec=OCRBackend)
+        backend.recognize.return_value = ('Paris\n\f', 91.0)
+        with mock.patch('core.ocr.get_ocr_backend', return_value=backend):
+            result = extract_pdf(path, max_workers=2)
+        self.assertEqual(result.text.split('\n'), ['Q1. Name the capital of France', 'Paris', 'Q2. Name the capital of Spain'])
+        self.assertEqual(result.page_confidences, [{'page': 0, 'confidence': 91.0}])
+        backend.recognize.assert_called_once()
+        region = backend.recognize.call_args.args[0]
+        self.assertAlmostEqual(region.width / region.height, 300 / 200, places=1)
+
+    def test_searchable_scan_is_not_ocred_again(self):
+        """Test a scanned page image under an invisible text layer is read from the layer only"""
+        path = os.path.join(tempfile.mkdtemp(), 'searchable.pdf')
+        with fitz.open() as doc:
+            page = doc.new_page()
+            scan = fitz.Pixmap(fitz.csGRAY, fitz.IRect(0, 0, 60, 80), False)
+            scan.clear_with(255)
+            page.insert_image(page.rect, pixmap=scan)
+            page.insert_text((72, 72), 'Q1. Paris is the capital of France, on the river Seine', render_mode=3)
+            page.insert_text((72, 720), 'Q2. Madrid is the capital of Spain, in its centre', render_mode=3)
+            doc.save(path)
+
+        backend = mock.Mock(spec=OCRBackend)
+        with mock.patch('core.ocr.get_ocr_backend', return_value=backend):
+            result = extract_pdf(path, max_workers=1)
+        self.assertEqual(result.text.split('\n'), [
+            'Q1. Paris is the capital of France, on the river Seine', 'Q2. Madrid is the capital of Spain, in its centre',
+        ])
+        backend.recognize.assert_not_called()
+
+    def test_page_budget_skips_remaining_pages(self):
+        """Test pages past max_pages are never OCRed and are recorded as skipped"""
+        path = self.make_pdf(['typed', 0, 2, 3])
+        backend = self.FakeOCRBackend()
+        with mock.patch('core.ocr.get_ocr_backend', return_value=backend), \
+                mock.patch.object(backend, 'recognize', wraps=backend.recognize) as ocr:
+            result = extract_pdf(path, max_pages=2, max_workers=2)
+        self.assertEqual(result.text.split('\n'), ['typed', '', 'scan 0'])
+        self.assertEqual(result.skipped_pages, [2, 3])
+        self.assertEqual(ocr.call_count, 1)
+
+    def test_character_budget_stops_extraction(self):
+        """Test extraction stops once max_chars of text has been read"""
+        path = self.make_pdf(['first page', 'second page', 'third page'])
+        result = extract_pdf(path, max_chars=15, max_workers=1)
+        self.assertEqual(result.text, 'first page\n\nseco')
+        self.assertEqual(result.skipped_pages, [2])
+        self.assertTrue(result.truncated)
+
+    @override_settings(EXTRACTION_MAX_PAGES=1, EXTRACTION_MAX_CHARS=5)
+    def test_budgets_only_apply_when_passed(self):
+        """Test answer keys and question papers are extracted whole, whatever the submission budgets"""
+        path = self.make_pdf(['first page', 'second page'])
+        self.assertEqual(extract_text_from_pdf(path, max_workers=1).split(), ['first', 'page', 'second', 'page'])
+
+    def test_identical_pages_are_ocred_once(self):
+        """Test a page rendered identically in another submission is served from the OCR cache"""
+        first, second = self.make_pdf([0, 2]), self.make_pdf([2, 3, 0])
+        backend = self.FakeOCRBackend()
+        with mock.patch('core.ocr.get_ocr_backend', return_value=backend), \
+                mock.patch.object(backend, 'recognize', wraps=backend.recognize) as ocr:
+            extract_text_from_pdf(first, max_workers=1)
+            text = extract_text_from_pdf(second, max_workers=1)
+        self.assertEqual(text.split('\n'), ['scan 2', 'scan 3', 'scan 0'])
+        self.assertEqual(ocr.call_count, 3)
+
+    @override_settings(OCR_TARGET_DPI=300, OCR_MAX_PAGE_PIXELS=10_000_000)
+    def test_ocr_zoom_adapts_to_page_size(self):
+        """Test small pages render at the target DPI and large pages are capped"""
+        a4, a3 = fitz.paper_rect('a4'), fitz.paper_rect('a3')
+        self.assertAlmostEqual(ocr_zoom(a4), 300 / 72)
+        self.assertLessEqual(a3.width * a3.height * ocr_zoom(a3) ** 2, 10_000_000 + 1)
+
+    @override_settings(OCR_BACKEND='tesserocr')
+    @mock.patch('core.ocr.tesserocr', None)
+    def test_ocr_backend_falls_back_to_pytesseract(self):
+        """Test pytesseract is used when the in-process engine is unavailable"""
+        get_ocr_backend.cache_clear()
+        self.addCleanup(get_ocr_backend.cache_clear)
+        self.assertIsInstance(get_ocr_backend(), PytesseractBackend)
+
+
+class GeminiClientTests(TestCase):
+    """Test cases for the per-process Gemini client"""
+
+    def setUp(self):
+        get_gemini_model.cache_clear()
+        get_generative_client.cache_clear()
+        self.addCleanup(get_gemini_model.cache_clear)
+        self.addCleanup(get_generative_client.cache_clear)
+
+    @override_settings(GOOGLE_API_KEY='test-key')
+    @mock.patch('core.llm.genai.configure')
+    @mock.patch('core.llm.glm.GenerativeServiceClient')
+    def test_client_is_created_once_per_process(self, client_cls, configure):
+        """Test every model shares one client, created and configured once"""
+        first = get_gemini_model('gemini-1.5-flash')
+        second = get_gemini_model('gemini-1.5-flash')
+        other = get_gemini_model('gemini-1.5-pro')
+
+        self.assertIs(first, second)
+        self.assertIs(first._client, other._client)
+        client_cls.assert_called_once()
+        configure.assert_called_once_with(api_key='test-key')
+
+    @override_settings(GOOGLE_API_KEY=None)
+    def test_missing_api_key_raises_on_first_use(self):
+        """Test a missing API key is reported when the client is first needed"""
+        with self.assertRaises(ValueError):
+            get_gemini_model('gemini-1.5-flash')
+
+
+@override_settings(CACHES={'llm': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'llm-tests'}})
+class ResponseCacheTests(TestCase):
+    """Test cases for the Gemini response cache"""
+
+    def setUp(self):
+        caches['llm'].clear()
+        generate = mock.patch('core.llm.generate_content', return_value=mock.Mock(text='{"questions": []}'))
+        self.generate = generate.start()
+        self.addCleanup(generate.stop)
+
+    def test_repeated_prompt_is_answered_from_cache(self):
+        """Test a prompt differing only in whitespace is served from the cache"""
+        first = generate_text('gemini-1.5-flash', 'Grade this:\n    x = 4\n')
+        second = generate_text('gemini-1.5-flash', '  Grade this:\n\t x  =  4  ')
+        self.assertEqual(first, second)
+        self.generate.assert_called_once()
+
+    def test_key_covers_model_and_generation_config(self):
+        """Test a different model or generation config is a different cache entry"""
+        key = response_cache_key('gemini-1.5-flash', 'prompt')
+        self.assertNotEqual(key, response_cache_key('gemini-1.5-pro', 'prompt'))
+        self.assertNotEqual(key, response_cache_key('gemini-1.5-flash', 'prompt', {'temperature': 0}))
+
+    def test_bypass_always_calls_gemini(self):
+        """Test use_cache=False neither reads nor fills the cache"""
+        generate_text('gemini-1.5-flash', 'prompt', use_cache=False)
+        generate_text('gemini-1.5-flash', 'prompt')
+        generate_text('gemini-1.5-flash', 'prompt', use_cache=False)
+        self.assertEqual(self.generate.call_count, 3)
+
+
 if __name__ == '__main__':
     import unittest
     unittest.main()
@@ -1,18 +1,39 @@
 from rest_framework import viewsets, permissions, status
 from rest_framework.decorators import api_view, permission_classes
 from rest_framework.response import Response
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import AuthenticationFailed, InvalidToken
 from rest_framework_simplejwt.views import TokenObtainPairView
-from django.contrib.auth import authenticate
-from .models import Classroom, Assignment, Submission, User
+from asgiref.sync import sync_to_async
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+from django.http import FileResponse, JsonResponse, StreamingHttpResponse
+from django.views.decorators.http import require_GET
+from .models import Classroom, Assignment, Submission
 from .serializers import ClassroomSerializer, AssignmentSerializer, SubmissionSerializer, UserRegistrationSerializer, UserSerializer
+from .pagination import NewestFirstPagination, SubmissionPagination
+from .stats import answer_memo_stats, forget_grade, get_stats, summarize_stats
+from .reports import XLSX_CONTENT_TYPE, csv_chunks, report_rows, write_xlsx
+from .events import event_stream, user_channel
 from .permissions import IsTeacher, IsStudent, IsOwnerOrTeacher
 
 
+def related_count(model, field):
+    """Count of the model rows whose field points at the outer row, as a correlated subquery
+
+    Unlike Count() over a join, several of these on one queryset don't multiply
+    each other's rows, and they aren't narrowed by filters on the same relation.
+    """
+    counts = model.objects.filter(**{field: OuterRef('pk')}).order_by().values(field).annotate(count=Count('*')).values('count')
+    return Coalesce(Subquery(counts), 0)
+
+
 class AssignmentViewSet(viewsets.ModelViewSet):
     """ViewSet for viewing and editing Assignment instances"""
     queryset = Assignment.objects.all()
     serializer_class = AssignmentSerializer
     permission_classes = [permissions.IsAuthenticated]
+    pagination_class = NewestFirstPagination
 
     def get_permissions(self):
         if self.action == 'create':
@@ -22,10 +43,16 @@ class AssignmentViewSet(viewsets.ModelViewSet):
     def get_queryset(self):
         # Teachers can see all assignments, students can only see assignments assigned to classrooms they joined
         user = self.request.user
+        assignments = Assignment.objects.select_related('teacher').annotate(
+            submitted_students_count=related_count(Submission, 'assignment'),
+        )
+        classroom = self.request.query_params.get('classroom')
+        if classroom and classroom.isdigit():
+            assignments = assignments.filter(classroom_id=classroom)
         if user.role == 'teacher':
-            return Assignment.objects.filter(teacher=user)
+            return assignments.filter(teacher=user)
         else:  # student
-            return Assignment.objects.filter(classroom__students=user)
+            return assignments.filter(classroom__students=user)
 
 
 class SubmissionViewSet(viewsets.ModelViewSet):
@@ -33,6 +60,7 @@ class SubmissionViewSet(viewsets.ModelViewSet):
     queryset = Submission.objects.all()
     serializer_class = SubmissionSerializer
     permission_classes = [permissions.IsAuthenticated]
+    pagination_class = SubmissionPagination
 
     def get_permissions(self):
         if self.action == 'create':
@@ -41,14 +69,22 @@ class SubmissionViewSet(viewsets.ModelViewSet):
             self.permission_classes = [permissions.IsAuthenticated, IsOwnerOrTeacher]
         return super().get_permissions()
 
+    def perform_destroy(self, instance):
+        forget_grade(instance)
+        instance.delete()
+
     def get_queryset(self):
         # Teachers can see all submissions for their assignments
         # Students can only see their own submissions
         user = self.request.user
+        submissions = Submission.objects.select_related('student').prefetch_related('question_grades')
+        assignment = self.request.query_params.get('assignment')
+        if assignment and assignment.isdigit():
+            submissions = submissions.filter(assignment_id=assignment)
         if user.role == 'teacher':
-            return Submission.objects.filter(assignment__teacher=user)
+            return submissions.filter(assignment__teacher=user)
         else:  # student
-            return Submission.objects.filter(student=user)
+            return submissions.filter(student=user)
 
 
 class ClassroomViewSet(viewsets.ModelViewSet):
@@ -56,6 +92,7 @@ class ClassroomViewSet(viewsets.ModelViewSet):
     queryset = Classroom.objects.all()
     serializer_class = ClassroomSerializer
     permission_classes = [permissions.IsAuthenticated]
+    pagination_class = NewestFirstPagination
 
     def get_permissions(self):
         if self.action == 'create':
@@ -67,10 +104,14 @@ class ClassroomViewSet(viewsets.ModelViewSet):
     def get_queryset(self):
         # Teachers can see their own classrooms, students can see classrooms they joined
         user = self.request.user
+        classrooms = Classroom.objects.select_related('teacher').prefetch_related('students').annotate(
+            student_count=related_count(Classroom.students.through, 'classroom'),
+            assignment_count=related_count(Assignment, 'classroom'),
+        )
         if user.role == 'teacher':
-            return Classroom.objects.filter(teacher=user)
+            return classrooms.filter(teacher=user)
         else:  # student
-            return Classroom.objects.filter(students=user)
+            return classrooms.filter(students=user)
 
 
 @api_view(['POST'])
@@ -95,33 +136,40 @@ class LoginView(TokenObtainPairView):
 @api_view(['GET'])
 @permission_classes([permissions.IsAuthenticated, IsTeacher])
 def assignment_report(request, assignment_id):
-    """Generate Excel report for assignment submissions"""
+    """Download an assignment's submissions as ?type=xlsx (the default) or csv
+
+    Rows are streamed from the database, so memory stays flat however many
+    submissions there are: CSV is sent as it is generated, XLSX is written to a
+    temporary file and sent from there.
+    """
+    # Not ?format=, which DRF reserves for choosing a renderer
+    report_format = request.query_params.get('type', 'xlsx')
+    if report_format not in ('xlsx', 'csv'):
+        return Response({'error': "type must be 'xlsx' or 'csv'"}, status=status.HTTP_400_BAD_REQUEST)
     try:
         assignment = Assignment.objects.get(id=assignment_id, teacher=request.user)
-        submissions = Submission.objects.filter(assignment=assignment).select_related('student')
-
-        import pandas as pd
-        from django.http import HttpResponse
-
-        data = []
-        for sub in submissions:
-            # Convert timezone-aware datetime to naive for Excel compatibility
-            submission_date_naive = sub.submission_date.replace(tzinfo=None) if sub.submission_date else None
-            data.append({
-                'Name': sub.student.get_full_name() or sub.student.username,
-                'Regd No': sub.student.regdno or 'N/A',
-                'Secured Mark': sub.score or 'Pending',
-                'Total Mark': sub.assignment.total_marks,
-            })
-
-        df = pd.DataFrame(data)
-        response = HttpResponse(content_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
-        response['Content-Disposition'] = f'attachment; filename="assignment_{assignment_id}_report.xlsx"'
-        df.to_excel(response, index=False)
+    except Assignment.DoesNotExist:
+        return Response({'error': 'Assignment not found'}, status=status.HTTP_404_NOT_FOUND)
+
+    filename = f'assignment_{assignment_id}_report.{report_format}'
+    if report_format == 'csv':
+        response = StreamingHttpResponse(csv_chunks(report_rows(assignment)), content_type='text/csv')
+        response['Content-Disposition'] = f'attachment; filename="{filename}"'
         return response
+    return FileResponse(
+        write_xlsx(report_rows(assignment)), as_attachment=True, filename=filename, content_type=XLSX_CONTENT_TYPE
+    )
+
 
+@api_view(['GET'])
+@permission_classes([permissions.IsAuthenticated, IsTeacher])
+def assignment_stats(request, assignment_id):
+    """Score statistics of an assignment, read from its running totals rather than its submissions"""
+    try:
+        assignment = Assignment.objects.get(id=assignment_id, teacher=request.user)
     except Assignment.DoesNotExist:
         return Response({'error': 'Assignment not found'}, status=status.HTTP_404_NOT_FOUND)
+    return Response({**summarize_stats(get_stats(assignment)), 'answer_memo': answer_memo_stats(assignment)})
 
 
 @api_view(['POST'])
@@ -156,3 +204,33 @@ def current_user_view(request):
     """API for getting current user data"""
     serializer = UserSerializer(request.user)
     return Response(serializer.data)
+
+
+def token_user(request):
+    """The user of the request's JWT access token, from the Authorization header or the token query parameter"""
+    authentication = JWTAuthentication()
+    try:
+        result = authentication.authenticate(request)
+        if result is None and request.GET.get('token'):
+            result = authentication.get_user(authentication.get_validated_token(request.GET['token'])), None
+    except (AuthenticationFailed, InvalidToken):
+        return None
+    return result[0] if result else None
+
+
+@require_GET
+async def submission_events(request):
+    """Server-sent events with the status and score of the user's submissions, as they are graded
+
+    Students get their own submissions, teachers the submissions to their
+    assignments. EventSource can't set headers, so browsers pass the access
+    token as ?token=; an expired token ends the stream at the next reconnect.
+    """
+    user = await sync_to_async(token_user)(request)
+    if user is None:
+        return JsonResponse({'error': 'Authentication credentials were not provided or are invalid'}, status=status.HTTP_401_UNAUTHORIZED)
+    response = StreamingHttpResponse(event_stream(user_channel(user.id)), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    # Stop nginx from buffering the stream
+    response['X-Accel-Buffering'] = 'no'
+    return response
@@ -27,6 +27,31 @@ export interface AssignmentFormData {
   total_marks: number;
 }
 
+export interface QuestionGrade {
+  question_number: number | string;
+  question_text: string;
+  marks_allocated: number | null;
+  marks_achieved: number;
+  feedback: string;
+}
+
+export interface GradingDetails {
+  questions: QuestionGrade[];
+  total_marks_allocated: number;
+  total_score: number;
+  overall_feedback: string;
+  error?: string;
+}
+
+export type SubmissionStatus = 'pending' | 'processing' | 'completed' | 'failed';
+
+export interface SubmissionEvent {
+  id: number;
+  assignment: number;
+  status: SubmissionStatus;
+  score: number | null;
+}
+
 export interface Submission {
   id: number;
   assignment: number;
@@ -41,6 +66,8 @@ export interface Submission {
   };
   submission_file: string;
   submission_date: string;
+  status: SubmissionStatus;
   score: number | null;
+  grading_details: GradingDetails | null;
   plagiarism_report: string | null;
 }
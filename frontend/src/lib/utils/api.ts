@@ -0,0 +1,47 @@
+import type { SubmissionEvent } from '$lib/types/assignment';
+
+interface Page<T> {
+  next: string | null;
+  previous: string | null;
+  results: T[];
+}
+
+/**
+ * Fetch every page of a cursor-paginated list endpoint.
+ * Returns the last response (check `response.ok` as usual) and the results of all pages.
+ */
+export async function fetchAllPages<T>(url: string, init: RequestInit = {}): Promise<{ response: Response; results: T[] }> {
+  const results: T[] = [];
+  let next: string | null = url;
+  let response: Response;
+
+  do {
+    response = await fetch(next, init);
+    if (!response.ok) {
+      return { response, results: [] };
+    }
+    const page: Page<T> = await response.json();
+    results.push(...page.results);
+    // The API builds absolute links to its own host, keep following them through the dev proxy
+    next = page.next ? new URL(page.next).pathname + new URL(page.next).search : null;
+  } while (next);
+
+  return { response, results };
+}
+
+/**
+ * Receive the status changes of the user's submissions as they are graded.
+ * `onOpen` runs on every (re)connect, reload the submissions there to catch changes missed meanwhile.
+ * Returns a function that closes the stream.
+ */
+export function subscribeToSubmissionEvents(
+  token: string,
+  onEvent: (event: SubmissionEvent) => void,
+  onOpen: () => void = () => {}
+): () => void {
+  // EventSource can't send an Authorization header
+  const source = new EventSource(`/api/events/?token=${encodeURIComponent(token)}`);
+  source.addEventListener('submission', (message) => onEvent(JSON.parse((message as MessageEvent).data)));
+  source.addEventListener('open', onOpen);
+  return () => source.close();
+}